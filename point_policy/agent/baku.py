@@ -118,6 +118,9 @@ class BCAgent:
         max_episode_len,
         num_queries,
         use_depth,
+        amp=None,
+        use_compile=False,
+        fused_optimizer=False,
     ):
         self.device = device
         self.lr = lr
@@ -217,16 +220,31 @@ class BCAgent:
         params = list(self.point_encoder.parameters())
         if self.use_depth:
             params += list(self.depth_encoder.parameters())
-        self.encoder_opt = torch.optim.AdamW(params, lr=lr, weight_decay=1e-4)
+        self.encoder_opt = torch.optim.AdamW(
+            params, lr=lr, weight_decay=1e-4, fused=fused_optimizer or None
+        )
+        optimizers = [self.encoder_opt]
         # proprio
         if self.use_proprio:
             self.proprio_opt = torch.optim.AdamW(
-                self.proprio_projector.parameters(), lr=lr, weight_decay=1e-4
+                self.proprio_projector.parameters(),
+                lr=lr,
+                weight_decay=1e-4,
+                fused=fused_optimizer or None,
             )
+            optimizers.append(self.proprio_opt)
         # actor
         self.actor_opt = torch.optim.AdamW(
-            self.actor.parameters(), lr=lr, weight_decay=1e-4
+            self.actor.parameters(),
+            lr=lr,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
         )
+        optimizers.append(self.actor_opt)
+        self.update_step = utils.UpdateStep(optimizers, device, amp)
+        # compiled on the first update
+        self.use_compile = use_compile
+        self._forward_loss = None
 
         # scaling for images at inference
         self.test_aug = T.Compose(
@@ -379,6 +397,27 @@ class BCAgent:
             0, -1, :
         ]  # NOTE: usually returns last action but return all for open loop
 
+    def forward_loss(self, data, stddev, action):
+        features = []
+        for key in self.pixel_keys:
+            features.append(
+                self.point_encoder(
+                    torch.as_tensor(data[key], device=self.device, dtype=torch.float32)
+                )
+            )
+
+        if self.use_proprio:
+            proprio = data[self.proprio_key].float()
+            proprio = self.proprio_projector(proprio)
+            features.append(proprio)
+
+        # concatenate
+        features = torch.cat(features, dim=-1).view(
+            action.shape[0], -1, self.repr_dim
+        )  # (B, T * num_feat_per_step, D)
+
+        return self.actor(features, stddev, action)
+
     def update(self, expert_replay_iter, step):
         metrics = dict()
 
@@ -387,7 +426,6 @@ class BCAgent:
         action = data["actions"].float()
 
         # features
-        features = []
         # for key in self.pixel_keys:
         #     pixel = data[key].float()
         #     shape = pixel.shape
@@ -409,48 +447,30 @@ class BCAgent:
         #         depth = einops.rearrange(depth, "(b t) d -> b t d", t=shape[1])
         #         features.append(depth)
 
-        for key in self.pixel_keys:
-            features.append(
-                self.point_encoder(
-                    torch.tensor(data[key], device=self.device, dtype=torch.float32)
-                )
-            )
-
-        if self.use_proprio:
-            proprio = data[self.proprio_key].float()
-            proprio = self.proprio_projector(proprio)
-            features.append(proprio)
-
-        # concatenate
-        features = torch.cat(features, dim=-1).view(
-            action.shape[0], -1, self.repr_dim
-        )  # (B, T * num_feat_per_step, D)
-
         # rearrange action
         if self.temporal_agg:
             action = einops.rearrange(action, "b t1 t2 d -> b t1 (t2 d)")
 
         # actor loss
         stddev = utils.schedule(self.stddev_schedule, step)
-        _, actor_loss = self.actor(features, stddev, action)
+        if self._forward_loss is None:
+            self._forward_loss = (
+                torch.compile(self.forward_loss)
+                if self.use_compile
+                else self.forward_loss
+            )
+        with self.update_step.forward():
+            _, actor_loss = self._forward_loss(data, stddev, action)
 
         # optimizer step
-        self.encoder_opt.zero_grad(set_to_none=True)
-        if self.use_proprio:
-            self.proprio_opt.zero_grad(set_to_none=True)
-        self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss["actor_loss"].backward()
-        self.encoder_opt.step()
-        if self.use_proprio:
-            self.proprio_opt.step()
-        self.actor_opt.step()
+        self.update_step(actor_loss["actor_loss"])
 
         if self.policy_head == "diffusion" and step % 10 == 0:
             self.actor._action_head.net.ema_step()
 
         if self.use_tb:
             for key, value in actor_loss.items():
-                metrics[key] = value.item()
+                metrics[key] = value.detach()
 
         return metrics
 
@@ -464,7 +484,7 @@ class BCAgent:
         # models
         payload = {k: self.__dict__[k].state_dict() for k in model_keys}
         # optimizers
-        payload.update({k: self.__dict__[k] for k in opt_keys})
+        payload.update({k: self.__dict__[k].state_dict() for k in opt_keys})
 
         others = [
             "use_proprio",
@@ -481,6 +501,15 @@ class BCAgent:
         for k in model_keys:
             self.__dict__[k].load_state_dict(payload[k])
 
+        # optimizers, snapshots from before optimizers were saved as state dicts are skipped
+        if not eval:
+            opt_keys = ["actor_opt", "encoder_opt"]
+            if self.use_proprio:
+                opt_keys += ["proprio_opt"]
+            for k in opt_keys:
+                if isinstance(payload.get(k), dict):
+                    self.__dict__[k].load_state_dict(payload[k])
+
         if eval:
             self.train(False)
         return
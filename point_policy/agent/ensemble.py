@@ -0,0 +1,222 @@
+import copy
+
+import torch
+from agent.p3po import BCAgent as P3POAgent
+from agent.point_policy import BCAgent as PointPolicyAgent
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+
+import utils
+
+
+class MemberLoss(nn.Module):
+    """
+    The forward pass and loss of one point policy or p3po agent, as a module for `functional_call`.
+    `targets` are the tensors returned by the agent's `prepare_batch` after the past tracks (the
+    future tracks and action masks, or the actions).
+    """
+
+    def __init__(self, point_projector, actor):
+        super().__init__()
+        self.point_projector = point_projector
+        self.actor = actor
+
+    def forward(self, past_tracks, stddev, targets):
+        past_tracks = self.point_projector(past_tracks)
+        _, actor_loss = self.actor(past_tracks, stddev, *targets)
+        return actor_loss
+
+
+class EnsembleBCAgent:
+    """
+    Trains a sweep of point policy or p3po agents, which differ in their seed and learning rate, as one
+    vectorized model. The parameters of the members are stacked with `stack_module_state` and a
+    batch is passed through all members at once with `vmap`, so the sweep shares one data stream
+    and one set of kernels.
+
+    A single AdamW steps the stacked parameters with a learning rate of 1, and the update of each
+    member is then scaled by its own learning rate. The AdamW update, including the decoupled
+    weight decay, is linear in the learning rate, so this matches training each member with its
+    own optimizer.
+
+    The member agents hold the weights and optimizer states of the ensemble after `sync_members`,
+    and are used for evaluation and snapshots.
+    """
+
+    def __init__(self, members, amp=None, fused_optimizer=False):
+        """
+        Parameters:
+        -----------
+        members : list
+            The point policy or p3po agents of the sweep, built with their own seed and learning
+            rate.
+
+        amp : str
+            None, bf16 or fp16 autocast in the update.
+
+        fused_optimizer : bool
+            Whether to use fused AdamW steps.
+        """
+        assert isinstance(
+            members[0], (PointPolicyAgent, P3POAgent)
+        ), "ensembles only support the point_policy and p3po agents"
+        assert all(
+            type(member) is type(members[0]) for member in members
+        ), "the members of an ensemble must be the same agent"
+        assert all(
+            member.policy_head == "deterministic" for member in members
+        ), "ensembles only support the deterministic policy head"
+        self.members = members
+        self.device = members[0].device
+        self.stddev_schedule = members[0].stddev_schedule
+        self.use_tb = members[0].use_tb
+        self._act_dim = members[0]._act_dim
+
+        # stacked parameters, the members are the leading dimension
+        self._modules = [
+            MemberLoss(member.point_projector, member.actor) for member in members
+        ]
+        self.params, self.buffers = stack_module_state(self._modules)
+        self._base = copy.deepcopy(self._modules[0]).to("meta")
+
+        def loss_fn(params, buffers, past_tracks, stddev, targets):
+            return functional_call(
+                self._base, (params, buffers), (past_tracks, stddev, targets)
+            )
+
+        # the batch is shared, dropout differs between members
+        self._forward_loss = vmap(
+            loss_fn, in_dims=(0, 0, None, None, None), randomness="different"
+        )
+
+        self.lrs = torch.tensor([member.lr for member in members], device=self.device)
+        self.opt = torch.optim.AdamW(
+            self.params.values(),
+            lr=1.0,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
+        )
+        self.update_step = utils.UpdateStep([self.opt], self.device, amp)
+
+        self.train()
+
+    def __repr__(self):
+        return "bc_ensemble"
+
+    def __len__(self):
+        return len(self.members)
+
+    def train(self, training=True):
+        self.training = training
+        self._base.train(training)
+        for member in self.members:
+            member.train(training)
+
+    def buffer_reset(self):
+        for member in self.members:
+            member.buffer_reset()
+
+    def clear_buffers(self):
+        for member in self.members:
+            member.clear_buffers()
+
+    def update(self, expert_replay_iter, step):
+        """Updates all members on one batch and returns the metrics of each member"""
+        batch = next(expert_replay_iter)
+        data = utils.to_torch(batch, self.device)
+        past_tracks, *targets = self.members[0].prepare_batch(data)
+
+        # actor loss
+        stddev = utils.schedule(self.stddev_schedule, step)
+        with self.update_step.forward():
+            actor_loss = self._forward_loss(
+                self.params,
+                self.buffers,
+                past_tracks,
+                stddev,
+                tuple(targets),
+            )
+
+        # optimize, the members are independent so the sum backpropagates each member's loss
+        params = [param.detach().clone() for param in self.params.values()]
+        self.update_step(actor_loss["actor_loss"].sum())
+        with torch.no_grad():
+            for param, prev in zip(self.params.values(), params):
+                lrs = self.lrs.view((-1,) + (1,) * (param.ndim - 1))
+                param.copy_(torch.lerp(prev, param, lrs))
+
+        metrics = [dict() for _ in self.members]
+        if self.use_tb:
+            for key, value in actor_loss.items():
+                for i in range(len(self.members)):
+                    metrics[i][key] = value[i].detach()
+        return metrics
+
+    def _optimizers(self, member):
+        return [
+            (member.point_opt, "point_projector", member.point_projector),
+            (member.actor_opt, "actor", member.actor),
+        ]
+
+    def sync_members(self):
+        """Copies the weights and optimizer states of the ensemble to the member agents"""
+        with torch.no_grad():
+            for i, (member, module) in enumerate(zip(self.members, self._modules)):
+                for name, param in module.named_parameters():
+                    param.copy_(self.params[name][i])
+                for name, buffer in module.named_buffers():
+                    buffer.copy_(self.buffers[name][i])
+
+                for opt, prefix, submodule in self._optimizers(member):
+                    state_dict = opt.state_dict()
+                    state_dict["state"] = {}
+                    for idx, (name, _) in enumerate(submodule.named_parameters()):
+                        state = self.opt.state.get(self.params[f"{prefix}.{name}"])
+                        if state is None or len(state) == 0:
+                            continue
+                        state_dict["state"][idx] = {
+                            "step": state["step"].clone(),
+                            "exp_avg": state["exp_avg"][i].clone(),
+                            "exp_avg_sq": state["exp_avg_sq"][i].clone(),
+                        }
+                    for group in state_dict["param_groups"]:
+                        group["lr"] = member.lr
+                    opt.load_state_dict(state_dict)
+
+    def _stack_members(self):
+        """Copies the weights and optimizer states of the member agents to the ensemble"""
+        with torch.no_grad():
+            for i, (member, module) in enumerate(zip(self.members, self._modules)):
+                for name, param in module.named_parameters():
+                    self.params[name][i].copy_(param)
+                for name, buffer in module.named_buffers():
+                    self.buffers[name][i].copy_(buffer)
+
+                for opt, prefix, submodule in self._optimizers(member):
+                    for name, param in submodule.named_parameters():
+                        state = opt.state.get(param)
+                        if state is None or len(state) == 0:
+                            continue
+                        stacked = self.params[f"{prefix}.{name}"]
+                        if len(self.opt.state[stacked]) == 0:
+                            self.opt.state[stacked] = {
+                                "step": state["step"].clone(),
+                                "exp_avg": torch.zeros_like(stacked),
+                                "exp_avg_sq": torch.zeros_like(stacked),
+                            }
+                        self.opt.state[stacked]["exp_avg"][i].copy_(state["exp_avg"])
+                        self.opt.state[stacked]["exp_avg_sq"][i].copy_(
+                            state["exp_avg_sq"]
+                        )
+
+    def save_snapshot(self, member):
+        """The snapshot of a member as of the last `sync_members`, loadable by its agent"""
+        return self.members[member].save_snapshot()
+
+    def load_snapshot(self, payload, eval=False):
+        """Loads the same snapshot into every member, e.g. to fine-tune a sweep from one policy"""
+        for member in self.members:
+            member.load_snapshot(payload, eval=eval)
+        self._stack_members()
+        if eval:
+            self.train(False)
@@ -114,6 +114,9 @@ class BCAgent:
         use_object_points,
         num_object_points,
         pred_gripper,
+        amp=None,
+        use_compile=False,
+        fused_optimizer=False,
     ):
         self.device = device
         self.lr = lr
@@ -189,15 +192,29 @@ class BCAgent:
         # optimizers
         # encoder
         params = list(self.encoder.parameters())
-        self.encoder_opt = torch.optim.AdamW(params, lr=lr, weight_decay=1e-4)
+        self.encoder_opt = torch.optim.AdamW(
+            params, lr=lr, weight_decay=1e-4, fused=fused_optimizer or None
+        )
         # point projector
         self.point_opt = torch.optim.AdamW(
-            self.point_projector.parameters(), lr=lr, weight_decay=1e-4
+            self.point_projector.parameters(),
+            lr=lr,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
         )
         # actor
         self.actor_opt = torch.optim.AdamW(
-            self.actor.parameters(), lr=lr, weight_decay=1e-4
+            self.actor.parameters(),
+            lr=lr,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
+        )
+        self.update_step = utils.UpdateStep(
+            [self.encoder_opt, self.point_opt, self.actor_opt], device, amp
         )
+        # compiled on the first update
+        self.use_compile = use_compile
+        self._forward_loss = None
 
         # scaling for images at inference
         self.test_aug = T.Compose([T.ToPILImage(), T.ToTensor()])
@@ -380,6 +397,25 @@ class BCAgent:
 
         return return_dict
 
+    def forward_loss(
+        self, pixels, past_tracks, stddev, future_tracks, action_masks, **kwargs
+    ):
+        # features
+        features = []
+        for key in pixels.keys():
+            pixel = pixels[key].float()
+            shape = pixel.shape
+            pixel = self.encoder(pixel)
+            features.append(pixel)
+        features = torch.stack(features, dim=1)
+
+        # encode past tracks
+        past_tracks = self.point_projector(past_tracks)
+
+        return self.actor(
+            features, past_tracks, stddev, future_tracks, action_masks, **kwargs
+        )
+
     def update(self, expert_replay_iter, step, **kwargs):
         metrics = dict()
 
@@ -416,39 +452,28 @@ class BCAgent:
             past_tracks = torch.cat([past_tracks, past_gripper_states], dim=1)
             future_tracks = torch.cat([future_tracks, future_gripper_states], dim=1)
 
-        # features
-        features = []
-        for key in pixels.keys():
-            pixel = pixels[key].float()
-            shape = pixel.shape
-            pixel = self.encoder(pixel)
-            features.append(pixel)
-        features = torch.stack(features, dim=1)
-
-        # encode past tracks
-        past_tracks = self.point_projector(past_tracks)
-
         # actor loss
         stddev = utils.schedule(self.stddev_schedule, step)
-        pred_action, actor_loss = self.actor(
-            features, past_tracks, stddev, future_tracks, action_masks, **kwargs
-        )
+        if self._forward_loss is None:
+            self._forward_loss = (
+                torch.compile(self.forward_loss)
+                if self.use_compile
+                else self.forward_loss
+            )
+        with self.update_step.forward():
+            pred_action, actor_loss = self._forward_loss(
+                pixels, past_tracks, stddev, future_tracks, action_masks, **kwargs
+            )
 
         # optimize
-        self.encoder_opt.zero_grad(set_to_none=True)
-        self.point_opt.zero_grad(set_to_none=True)
-        self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss["actor_loss"].backward()
-        self.encoder_opt.step()
-        self.point_opt.step()
-        self.actor_opt.step()
+        self.update_step(actor_loss["actor_loss"])
 
         if self.policy_head == "diffusion" and step % 10 == 0:
             self.actor._action_head.net.ema_step()
 
         if self.use_tb:
             for key, value in actor_loss.items():
-                metrics[key] = value.item()
+                metrics[key] = value.detach()
 
         return metrics
 
@@ -459,7 +484,7 @@ class BCAgent:
         payload = {k: self.__dict__[k].state_dict() for k in model_keys}
 
         # optimizers
-        payload.update({k: self.__dict__[k] for k in opt_keys})
+        payload.update({k: self.__dict__[k].state_dict() for k in opt_keys})
 
         others = ["max_episode_len"]
         payload.update({k: self.__dict__[k] for k in others})
@@ -471,6 +496,12 @@ class BCAgent:
         for k in model_keys:
             self.__dict__[k].load_state_dict(payload[k])
 
+        # optimizers, snapshots from before optimizers were saved as state dicts are skipped
+        if not eval:
+            for k in ["actor_opt", "encoder_opt", "point_opt"]:
+                if isinstance(payload.get(k), dict):
+                    self.__dict__[k].load_state_dict(payload[k])
+
         if eval:
             self.train(False)
             return
@@ -119,6 +119,9 @@ class BCAgent:
         use_object_points,
         num_object_points,
         point_dim,
+        amp=None,
+        use_compile=False,
+        fused_optimizer=False,
     ):
         assert point_dim in [2, 3], "Only 2D or 3D points are supported"
 
@@ -191,11 +194,22 @@ class BCAgent:
         # optimizers
         # point projector
         params = list(self.point_projector.parameters())
-        self.point_opt = torch.optim.AdamW(params, lr=lr, weight_decay=1e-4)
+        self.point_opt = torch.optim.AdamW(
+            params, lr=lr, weight_decay=1e-4, fused=fused_optimizer or None
+        )
         # actor
         self.actor_opt = torch.optim.AdamW(
-            self.actor.parameters(), lr=lr, weight_decay=1e-4
+            self.actor.parameters(),
+            lr=lr,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
+        )
+        self.update_step = utils.UpdateStep(
+            [self.point_opt, self.actor_opt], device, amp
         )
+        # compiled on the first update
+        self.use_compile = use_compile
+        self._forward_loss = None
 
         self.train()
         self.buffer_reset()
@@ -297,42 +311,55 @@ class BCAgent:
                 return post_process["actions"](action.cpu().numpy()[0, -1])
             return action.cpu().numpy()[0, -1, :]
 
-    def update(self, expert_replay_iter, step, **kwargs):
-        metrics = dict()
+    def forward_loss(self, past_tracks, stddev, action, **kwargs):
+        # encode past tracks
+        past_tracks = self.point_projector(past_tracks)
 
-        batch = next(expert_replay_iter)
-        data = utils.to_torch(batch, self.device)
+        return self.actor(past_tracks, stddev, action, **kwargs)
 
+    def prepare_batch(self, data):
+        """Returns the past tracks and actions of a batch on the device"""
         past_tracks = data["past_tracks"].float()
         action = data["actions"].float()
 
         # reshape for training
         past_tracks = einops.rearrange(past_tracks, "n t p d-> n t (p d)")
 
-        # encode past tracks
-        past_tracks = self.point_projector(past_tracks)
-
         # rearrange action
         # if self.temporal_agg:
         #     action = einops.rearrange(action, "b t1 t2 d -> b t1 (t2 d)")
 
+        return past_tracks, action
+
+    def update(self, expert_replay_iter, step, **kwargs):
+        metrics = dict()
+
+        batch = next(expert_replay_iter)
+        data = utils.to_torch(batch, self.device)
+        past_tracks, action = self.prepare_batch(data)
+
         # actor loss
         stddev = utils.schedule(self.stddev_schedule, step)
-        pred_action, actor_loss = self.actor(past_tracks, stddev, action, **kwargs)
+        if self._forward_loss is None:
+            self._forward_loss = (
+                torch.compile(self.forward_loss)
+                if self.use_compile
+                else self.forward_loss
+            )
+        with self.update_step.forward():
+            pred_action, actor_loss = self._forward_loss(
+                past_tracks, stddev, action, **kwargs
+            )
 
         # optimize
-        self.point_opt.zero_grad(set_to_none=True)
-        self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss["actor_loss"].backward()
-        self.point_opt.step()
-        self.actor_opt.step()
+        self.update_step(actor_loss["actor_loss"])
 
         if self.policy_head == "diffusion" and step % 10 == 0:
             self.actor._action_head.net.ema_step()
 
         if self.use_tb:
             for key, value in actor_loss.items():
-                metrics[key] = value.item()
+                metrics[key] = value.detach()
 
         return metrics
 
@@ -342,7 +369,7 @@ class BCAgent:
         # models
         payload = {k: self.__dict__[k].state_dict() for k in model_keys}
         # optimizers
-        payload.update({k: self.__dict__[k] for k in opt_keys})
+        payload.update({k: self.__dict__[k].state_dict() for k in opt_keys})
 
         others = ["max_episode_len"]
         payload.update({k: self.__dict__[k] for k in others})
@@ -354,6 +381,12 @@ class BCAgent:
         for k in model_keys:
             self.__dict__[k].load_state_dict(payload[k])
 
+        # optimizers, snapshots from before optimizers were saved as state dicts are skipped
+        if not eval:
+            for k in ["actor_opt", "point_opt"]:
+                if isinstance(payload.get(k), dict):
+                    self.__dict__[k].load_state_dict(payload[k])
+
         if eval:
             self.train(False)
             return
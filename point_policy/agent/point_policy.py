@@ -116,6 +116,9 @@ class BCAgent:
         num_object_points,
         point_dim,
         pred_gripper,
+        amp=None,
+        use_compile=False,
+        fused_optimizer=False,
     ):
         self.device = device
         self.lr = lr
@@ -181,11 +184,22 @@ class BCAgent:
         # optimizers
         # point projector
         params = list(self.point_projector.parameters())
-        self.point_opt = torch.optim.AdamW(params, lr=lr, weight_decay=1e-4)
+        self.point_opt = torch.optim.AdamW(
+            params, lr=lr, weight_decay=1e-4, fused=fused_optimizer or None
+        )
         # actor
         self.actor_opt = torch.optim.AdamW(
-            self.actor.parameters(), lr=lr, weight_decay=1e-4
+            self.actor.parameters(),
+            lr=lr,
+            weight_decay=1e-4,
+            fused=fused_optimizer or None,
+        )
+        self.update_step = utils.UpdateStep(
+            [self.point_opt, self.actor_opt], device, amp
         )
+        # compiled on the first update
+        self.use_compile = use_compile
+        self._forward_loss = None
 
         self.train()
         self.buffer_reset()
@@ -361,12 +375,21 @@ class BCAgent:
 
         return return_dict
 
-    def update(self, expert_replay_iter, step, **kwargs):
-        metrics = dict()
+    def forward_loss(self, past_tracks, stddev, future_tracks, action_masks, **kwargs):
+        # encode past tracks
+        past_tracks = self.point_projector(past_tracks)
 
-        batch = next(expert_replay_iter)
-        data = utils.to_torch(batch, self.device)
+        return self.actor(
+            # features,
+            past_tracks,
+            stddev,
+            future_tracks,
+            action_masks,
+            **kwargs,
+        )
 
+    def prepare_batch(self, data):
+        """Returns the past tracks, future tracks and action masks of a batch on the device"""
         past_tracks = data["past_tracks"].float()
         future_tracks = data["future_tracks"].float()
         action_masks = data["action_mask"].float()
@@ -394,33 +417,37 @@ class BCAgent:
             past_tracks = torch.cat([past_tracks, past_gripper_states], dim=1)
             future_tracks = torch.cat([future_tracks, future_gripper_states], dim=1)
 
-        # encode past tracks
-        past_tracks = self.point_projector(past_tracks)
+        return past_tracks, future_tracks, action_masks
+
+    def update(self, expert_replay_iter, step, **kwargs):
+        metrics = dict()
+
+        batch = next(expert_replay_iter)
+        data = utils.to_torch(batch, self.device)
+        past_tracks, future_tracks, action_masks = self.prepare_batch(data)
 
         # actor loss
         stddev = utils.schedule(self.stddev_schedule, step)
-        pred_action, actor_loss = self.actor(
-            # features,
-            past_tracks,
-            stddev,
-            future_tracks,
-            action_masks,
-            **kwargs,
-        )
+        if self._forward_loss is None:
+            self._forward_loss = (
+                torch.compile(self.forward_loss)
+                if self.use_compile
+                else self.forward_loss
+            )
+        with self.update_step.forward():
+            pred_action, actor_loss = self._forward_loss(
+                past_tracks, stddev, future_tracks, action_masks, **kwargs
+            )
 
         # optimize
-        self.point_opt.zero_grad(set_to_none=True)
-        self.actor_opt.zero_grad(set_to_none=True)
-        actor_loss["actor_loss"].backward()
-        self.point_opt.step()
-        self.actor_opt.step()
+        self.update_step(actor_loss["actor_loss"])
 
         if self.policy_head == "diffusion" and step % 10 == 0:
             self.actor._action_head.net.ema_step()
 
         if self.use_tb:
             for key, value in actor_loss.items():
-                metrics[key] = value.item()
+                metrics[key] = value.detach()
 
         return metrics
 
@@ -432,7 +459,7 @@ class BCAgent:
             k: self.__dict__[k].state_dict() for k in model_keys if k != "encoder"
         }
         # optimizers
-        payload.update({k: self.__dict__[k] for k in opt_keys})
+        payload.update({k: self.__dict__[k].state_dict() for k in opt_keys})
 
         others = ["max_episode_len"]
         payload.update({k: self.__dict__[k] for k in others})
@@ -444,6 +471,12 @@ class BCAgent:
         for k in model_keys:
             self.__dict__[k].load_state_dict(payload[k])
 
+        # optimizers, snapshots from before optimizers were saved as state dicts are skipped
+        if not eval:
+            for k in ["actor_opt", "point_opt"]:
+                if isinstance(payload.get(k), dict):
+                    self.__dict__[k].load_state_dict(payload[k])
+
         if eval:
             self.train(False)
             return
@@ -0,0 +1,161 @@
+"""
+Benchmark for the fast path of the point policy agent update (autocast, torch.compile and fused
+optimizer steps) against the default fp32 update. Both agents start from the same weights and are
+trained on the same synthetic batches, so the loss curves can be compared step by step. Exits
+with a non-zero status if the smoothed loss curves deviate by more than --tolerance, so it doubles
+as a parity test of the fast path on cpu.
+
+Example:
+    cd point_policy/
+    python benchmarks/agent_update.py --device cpu --amp bf16 --use_compile --steps 300
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from agent.point_policy import BCAgent
+
+
+def make_agent(args, **kwargs):
+    return BCAgent(
+        obs_shape={"pixels": (3, 256, 256)},
+        action_shape=(args.point_dim,),
+        device=args.device,
+        lr=1e-4,
+        hidden_dim=args.hidden_dim,
+        stddev_schedule=0.1,
+        use_tb=True,
+        policy_head="deterministic",
+        pixel_keys=["pixels"],
+        history=True,
+        history_len=args.history_len,
+        eval_history_len=args.history_len,
+        temporal_agg=True,
+        max_episode_len=1000,
+        num_queries=args.num_queries,
+        use_robot_points=True,
+        num_robot_points=args.num_points,
+        use_object_points=False,
+        num_object_points=0,
+        point_dim=args.point_dim,
+        pred_gripper=True,
+        **kwargs,
+    )
+
+
+def make_batches(args):
+    """Synthetic batches with the shapes of the point policy dataset"""
+    rng = np.random.default_rng(0)
+    shape = (args.batch_size, args.history_len)
+    batches = []
+    for _ in range(args.num_batches):
+        batches.append(
+            {
+                "past_tracks": rng.random(
+                    shape + (args.num_points, args.point_dim), dtype=np.float32
+                ),
+                "past_gripper_states": rng.random(shape, dtype=np.float32),
+                "future_tracks": rng.random(
+                    shape + (args.num_points, args.num_queries * args.point_dim),
+                    dtype=np.float32,
+                ),
+                "future_gripper_states": rng.random(
+                    shape + (args.num_queries,), dtype=np.float32
+                ),
+                "action_mask": np.ones(
+                    (args.batch_size, args.num_points), dtype=np.float32
+                ),
+            }
+        )
+    return batches
+
+
+def run(agent, batches, steps, device):
+    """Returns the loss curve and the steps per second after the first (warmup) update"""
+    replay_iter = iter(batches[i % len(batches)] for i in range(steps + 1))
+    torch.manual_seed(0)
+    losses = [agent.update(replay_iter, 0)["actor_loss"]]
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        losses.append(agent.update(replay_iter, step)["actor_loss"])
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    speed = steps / (time.perf_counter() - start)
+    return np.array(torch.stack(losses).tolist()), speed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--amp", type=str, default=None, choices=["bf16", "fp16"])
+    parser.add_argument("--use_compile", action="store_true")
+    parser.add_argument("--fused_optimizer", action="store_true")
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--num_batches", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--hidden_dim", type=int, default=256)
+    parser.add_argument("--history_len", type=int, default=10)
+    parser.add_argument("--num_queries", type=int, default=10)
+    parser.add_argument("--num_points", type=int, default=9)
+    parser.add_argument("--point_dim", type=int, default=3)
+    parser.add_argument("--window", type=int, default=20)
+    # max relative deviation of the smoothed loss curves
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    baseline = make_agent(args)
+    fast = make_agent(
+        args,
+        amp=args.amp,
+        use_compile=args.use_compile,
+        fused_optimizer=args.fused_optimizer,
+    )
+    # start from the same weights
+    fast.point_projector.load_state_dict(baseline.point_projector.state_dict())
+    fast.actor.load_state_dict(baseline.actor.state_dict())
+
+    batches = make_batches(args)
+    base_losses, base_speed = run(
+        copy.deepcopy(baseline), batches, args.steps, args.device
+    )
+    fast_losses, fast_speed = run(fast, batches, args.steps, args.device)
+
+    # compare the loss curves smoothed over a window, single steps are noisy under autocast
+    kernel = np.ones(args.window) / args.window
+    base_curve = np.convolve(base_losses, kernel, mode="valid")
+    fast_curve = np.convolve(fast_losses, kernel, mode="valid")
+    deviation = np.abs(fast_curve - base_curve) / np.abs(base_curve)
+
+    print(f"| {'update': <8} | steps/s | first loss | final loss |")
+    for name, losses, speed in [
+        ("fp32", base_losses, base_speed),
+        ("fast", fast_losses, fast_speed),
+    ]:
+        print(
+            f"| {name: <8} | {speed: >7.1f} | {losses[0]: >10.5f} "
+            f"| {losses[-args.window:].mean(): >10.5f} |"
+        )
+    print(f"speedup: {fast_speed / base_speed:.2f}x")
+    print(
+        f"loss curve deviation: mean {100 * deviation.mean():.2f}%, "
+        f"max {100 * deviation.max():.2f}%"
+    )
+    if deviation.max() > args.tolerance:
+        sys.exit(
+            f"parity failed: loss curve deviation above {100 * args.tolerance:.2f}%"
+        )
+    print(f"parity passed: loss curve deviation within {100 * args.tolerance:.2f}%")
+
+
+if __name__ == "__main__":
+    main()
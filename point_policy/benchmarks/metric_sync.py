@@ -0,0 +1,90 @@
+"""
+Benchmark for the device-side metric accumulation in logger.py against converting the metrics of
+every update with .item(). Counts the host-device syncs of the training loop (on cuda) and checks
+that the running averages dumped by the logger are identical.
+
+Example:
+    cd point_policy/
+    python benchmarks/metric_sync.py --device cuda --steps 2000 --log_every 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import warnings
+from pathlib import Path
+
+import torch
+from torch import nn
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from logger import BC_TRAIN_FORMAT, MetersGroup
+
+
+def run(args, materialize):
+    """Returns the dumped averages, the steps per second and the number of syncs"""
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        nn.Linear(args.dim, args.dim), nn.ReLU(), nn.Linear(args.dim, args.dim)
+    ).to(args.device)
+    opt = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    x = torch.randn(args.batch_size, args.dim, device=args.device)
+    meters = MetersGroup(
+        Path(tempfile.mkdtemp()) / "train.csv", formating=BC_TRAIN_FORMAT
+    )
+
+    dumps = []
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.set_sync_debug_mode("warn")
+    start = time.perf_counter()
+    with warnings.catch_warnings(record=True) as syncs:
+        warnings.simplefilter("always")
+        for step in range(args.steps):
+            out = model(x)
+            loss = (out - x).pow(2).mean()
+            opt.zero_grad(set_to_none=True)
+            loss.backward()
+            opt.step()
+
+            # the metrics of an agent update
+            metrics = {"actor_loss": loss.detach(), "out_norm": out.detach().norm()}
+            for key, value in metrics.items():
+                meters.log(f"train/{key}", materialize(value))
+
+            if (step + 1) % args.log_every == 0:
+                dumps.append(meters._prime_meters(meters._meters))
+                meters._meters.clear()
+    if args.device.startswith("cuda"):
+        torch.cuda.set_sync_debug_mode("default")
+        torch.cuda.synchronize()
+    speed = args.steps / (time.perf_counter() - start)
+    return dumps, speed, len(syncs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--log_every", type=int, default=100)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--dim", type=int, default=512)
+    args = parser.parse_args()
+
+    item_dumps, item_speed, item_syncs = run(args, lambda value: value.item())
+    tensor_dumps, tensor_speed, tensor_syncs = run(args, lambda value: value)
+
+    sync_note = (
+        "" if args.device.startswith("cuda") else " (syncs are only counted on cuda)"
+    )
+    print(f"| {'metrics': <8} | steps/s | syncs |{sync_note}")
+    print(f"| {'item': <8} | {item_speed: >7.1f} | {item_syncs: >5} |")
+    print(f"| {'tensor': <8} | {tensor_speed: >7.1f} | {tensor_syncs: >5} |")
+    print(f"speedup: {tensor_speed / item_speed:.2f}x")
+    print(f"dumped averages identical: {item_dumps == tensor_dumps}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Micro-benchmark for the trajectory resampling in read_data/aria.py against the original per-point loops.
+Also checks that the outputs are bit-identical.
+
+Example:
+    cd point_policy/
+    python benchmarks/resample_trajectory.py --data_dir /path/to/preprocess
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from read_data.aria import (
+    MAX_SEGMENT_EPS,
+    MIN_SEGMENT_EPS,
+    break_long_segments,
+    keep_longest_true_segment,
+    load_eeff_in_first_frame,
+    remove_stationary_points,
+)
+
+
+def reference_break_long_segments(trajectory, labels, max_eps):
+    new_traj = []
+    new_labels = []
+    for i in range(len(trajectory) - 1):
+        p1 = trajectory[i]
+        p2 = trajectory[i + 1]
+        n_steps = max(1, int(np.ceil(np.linalg.norm(p2 - p1) / max_eps)))
+        for j in range(n_steps):
+            alpha = j / n_steps
+            new_traj.append((1 - alpha) * p1 + alpha * p2)
+            new_labels.append(labels[i])
+    new_traj.append(trajectory[-1])
+    new_labels.append(labels[-1])
+    return np.array(new_traj), np.array(new_labels, dtype=bool)
+
+
+def reference_remove_stationary_points(points, labels, min_eps, iters=5):
+    for _ in range(iters):
+        labels = np.asarray(labels).squeeze()
+        new_points = [points[0]]
+        new_labels = [labels[0]]
+        last_point = points[0]
+        for i in range(1, len(points)):
+            if np.linalg.norm(points[i] - last_point) > min_eps:
+                new_points.append(points[i])
+                new_labels.append(labels[i])
+                last_point = points[i]
+        points, labels = np.array(new_points), np.array(new_labels)
+    return points, labels
+
+
+def load_trajectories(data_dir):
+    trajectories = []
+    for demonstration_dir in sorted(
+        glob.glob(os.path.join(os.path.expanduser(data_dir), "demonstration_*"))
+    ):
+        if not os.path.exists(os.path.join(demonstration_dir, "grasp.npy")):
+            continue
+        grasp = np.load(os.path.join(demonstration_dir, "grasp.npy")).astype(bool)
+        trajectories.append(
+            (
+                load_eeff_in_first_frame(demonstration_dir),
+                keep_longest_true_segment(grasp),
+            )
+        )
+    return trajectories
+
+
+def random_trajectories(num_demos, length):
+    rng = np.random.default_rng(0)
+    trajectories = []
+    for _ in range(num_demos):
+        # random walk with stationary stretches
+        steps = rng.normal(0, 0.01, (length, 3)) * (rng.random((length, 1)) < 0.7)
+        grasp = np.zeros(length, dtype=bool)
+        grasp[length // 3 : 2 * length // 3] = True
+        trajectories.append((np.cumsum(steps, axis=0), grasp))
+    return trajectories
+
+
+def resample(trajectories, break_fn, remove_fn):
+    outputs = []
+    start = time.perf_counter()
+    for trajectory, grasp in trajectories:
+        trajectory, grasp = break_fn(trajectory, grasp, MAX_SEGMENT_EPS)
+        outputs.append(remove_fn(trajectory, grasp, MIN_SEGMENT_EPS))
+    return time.perf_counter() - start, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default=None)
+    parser.add_argument("--num_demos", type=int, default=100)
+    parser.add_argument("--length", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.data_dir is not None:
+        trajectories = load_trajectories(args.data_dir)
+    else:
+        trajectories = random_trajectories(args.num_demos, args.length)
+
+    reference_time, reference = resample(
+        trajectories, reference_break_long_segments, reference_remove_stationary_points
+    )
+    vectorized_time, vectorized = resample(
+        trajectories,
+        break_long_segments,
+        lambda points, labels, min_eps: remove_stationary_points(
+            points, labels, min_eps=min_eps
+        ),
+    )
+
+    identical = all(
+        np.array_equal(a, b)
+        for (a_points, a_labels), (b_points, b_labels) in zip(reference, vectorized)
+        for a, b in [(a_points, b_points), (a_labels, b_labels)]
+    )
+    print(f"demos: {len(trajectories)}, bit-identical: {identical}")
+    print(f"reference:  {reference_time:.3f}s")
+    print(
+        f"vectorized: {vectorized_time:.3f}s ({reference_time / vectorized_time:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark for the episode-reset latency of the correspondence model under each memory policy.
+
+Example:
+    cd point_policy/
+    python benchmarks/reset_latency.py \
+        --image /path/to/preprocess/label_keypoints.png \
+        --coords /path/to/preprocess/label_keypoints.pkl \
+        --prompts "a bread slice." "a plate."
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from point_utils.correspondence import MEMORY_POLICIES, Correspondence
+
+
+def benchmark(correspondence, image, coords, iters):
+    # first call grows the caching allocator in both modes, so it is reported separately
+    start = time.perf_counter()
+    correspondence.find_correspondence(image, coords)
+    torch.cuda.synchronize()
+    first = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        correspondence.find_correspondence(image, coords)
+        torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - start)
+    return first, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, required=True)
+    parser.add_argument("--coords", type=str, required=True)
+    parser.add_argument("--prompts", type=str, nargs="+", required=True)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--image_size_multiplier", type=float, default=1)
+    parser.add_argument("--no_segmentation", action="store_true")
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    coords = np.array(pickle.load(open(args.coords, "rb")))
+
+    print(f"| {'policy': <12} | first (s) | mean (s) | p90 (s) | peak reserved (GB) |")
+    for memory_policy in MEMORY_POLICIES:
+        correspondence = Correspondence(
+            args.device,
+            image_size_multiplier=args.image_size_multiplier,
+            use_segmentation=not args.no_segmentation,
+            memory_policy=memory_policy,
+        )
+        correspondence.set_expert_correspondence(image, args.prompts)
+        torch.cuda.reset_peak_memory_stats()
+
+        first, latencies = benchmark(correspondence, image, coords, args.iters)
+        peak = torch.cuda.max_memory_reserved() / 1024**3
+        print(
+            f"| {memory_policy: <12} | {first: >9.3f} | {latencies.mean(): >8.3f} "
+            f"| {np.percentile(latencies, 90): >7.3f} | {peak: >18.2f} |"
+        )
+
+        del correspondence
+        Correspondence.release_memory()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Asynchronous, atomic snapshot writing with a retention policy"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import torch
+
+INDEX_FILE = "snapshots.json"
+
+
+def to_cpu(obj):
+    """Copies the tensors of a (nested) payload to cpu, so training can modify the originals"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomic(payload, path):
+    """
+    Writes a payload to a temporary file next to `path`, flushes it to disk and renames it, so
+    `path` holds either the previous or the new snapshot even if the process is killed.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        torch.save(payload, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # persist the rename
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_checkpoint(path):
+    with Path(path).open("rb") as f:
+        return torch.load(f, weights_only=False)
+
+
+def latest_checkpoint(snapshot_dir):
+    """The snapshot of the latest step in a snapshot directory, None if there is none"""
+    snapshots = sorted(
+        Path(snapshot_dir).glob("[0-9]*.pt"), key=lambda path: int(path.stem)
+    )
+    return snapshots[-1] if len(snapshots) > 0 else None
+
+
+class AsyncCheckpointer:
+    """
+    Saves snapshots to {snapshot_dir}/{step}.pt from a background thread. The payload is copied to
+    cpu before `save` returns and at most one write is in flight, so training only waits if the
+    previous snapshot is still being written.
+
+    After each write, all snapshots but the last `keep_last` and the `keep_best` best by a metric
+    are deleted. The steps and metrics of the kept snapshots are stored in snapshots.json, so the
+    policy carries over to a resumed run.
+    """
+
+    def __init__(
+        self, snapshot_dir, keep_last=3, keep_best=1, best_metric=None, mode="min"
+    ):
+        """
+        Parameters:
+        -----------
+        snapshot_dir : str or Path
+            The directory snapshots are saved to.
+
+        keep_last : int
+            The number of most recent snapshots kept, None to keep all.
+
+        keep_best : int
+            The number of best snapshots by `best_metric` kept in addition.
+
+        best_metric : str
+            The metric snapshots are ranked by, None to only keep the most recent snapshots.
+
+        mode : str
+            Whether lower ("min") or higher ("max") values of `best_metric` are better.
+        """
+        assert mode in ["min", "max"], "mode must be min or max"
+        self.snapshot_dir = Path(snapshot_dir)
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.best_metric = best_metric
+        self.mode = mode
+
+        # step -> metric of the kept snapshots
+        self._snapshots = {}
+        index_path = self.snapshot_dir / INDEX_FILE
+        if index_path.exists():
+            with index_path.open("r") as f:
+                self._snapshots = {
+                    int(step): metric for step, metric in json.load(f).items()
+                }
+        self._thread = None
+        self._error = None
+
+    def save(self, payload, step, metrics=None):
+        """
+        Copies a payload to cpu and writes it in the background.
+
+        Parameters:
+        -----------
+        payload : dict
+            The snapshot, a (nested) dict of tensors, state dicts and picklable objects.
+
+        step : int
+            The training step of the snapshot.
+
+        metrics : dict
+            The latest metrics, used to rank the snapshot by `best_metric`.
+        """
+        payload = to_cpu(payload)
+        metric = None
+        if self.best_metric is not None and metrics is not None:
+            metric = metrics.get(self.best_metric)
+            metric = None if metric is None else float(metric)
+
+        self.wait()
+        self._thread = threading.Thread(
+            target=self._write, args=(payload, step, metric), daemon=True
+        )
+        self._thread.start()
+
+    def wait(self):
+        """Blocks until the pending snapshot is written, raising errors of the writer thread"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing a snapshot failed") from error
+
+    def close(self):
+        self.wait()
+
+    def _write(self, payload, step, metric):
+        try:
+            save_atomic(payload, self.snapshot_dir / f"{step}.pt")
+            self._snapshots[step] = metric
+            self._apply_retention()
+        except Exception as e:
+            self._error = e
+
+    def _apply_retention(self):
+        steps = sorted(self._snapshots)
+        keep = set(
+            steps
+            if self.keep_last is None
+            else steps[max(len(steps) - self.keep_last, 0) :]
+        )
+        if self.best_metric is not None and self.keep_best > 0:
+            ranked = [step for step in steps if self._snapshots[step] is not None]
+            sign = 1 if self.mode == "min" else -1
+            ranked.sort(key=lambda step: sign * self._snapshots[step])
+            keep.update(ranked[: self.keep_best])
+
+        for step in steps:
+            if step not in keep:
+                (self.snapshot_dir / f"{step}.pt").unlink(missing_ok=True)
+                del self._snapshots[step]
+
+        index_path = self.snapshot_dir / INDEX_FILE
+        tmp_path = index_path.with_name(f".{INDEX_FILE}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(self._snapshots, f)
+        os.replace(tmp_path, index_path)
+
+    @property
+    def best(self):
+        """The step of the best snapshot by `best_metric`, None if no snapshot has the metric"""
+        ranked = [
+            step for step, metric in self._snapshots.items() if metric is not None
+        ]
+        if len(ranked) == 0:
+            return None
+        fn = min if self.mode == "min" else max
+        return fn(ranked, key=lambda step: self._snapshots[step])
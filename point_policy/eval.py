@@ -14,6 +14,7 @@ import cv2
 import hydra
 import numpy as np
 import torch
+from checkpoint import load_checkpoint
 from franka_env.envs.franka_env import (
     INTERNET_HOST,
     D,
@@ -230,7 +231,7 @@ class WorkspaceIL:
     def save_snapshot(self):
         snapshot = self.work_dir / "snapshot.pt"
         self.agent.clear_buffers()
-        keys_to_save = ["timer", "_global_step", "_global_episode"]
+        keys_to_save = ["timer", "_global_step", "_global_episode", "stats"]
         payload = {k: self.__dict__[k] for k in keys_to_save}
         payload.update(self.agent.save_snapshot())
         with snapshot.open("wb") as f:
@@ -240,13 +241,15 @@ class WorkspaceIL:
 
     def load_snapshot(self, snapshots):
         # bc
-        with snapshots["bc"].open("rb") as f:
-            payload = torch.load(f)
+        payload = load_checkpoint(snapshots["bc"])
         agent_payload = {}
         for k, v in payload.items():
             if k not in self.__dict__:
                 agent_payload[k] = v
         self.agent.load_snapshot(agent_payload, eval=True)
+        # normalize with the statistics the policy was trained with
+        if "stats" in payload:
+            self.stats = payload["stats"]
 
 
 @hydra.main(config_path="cfgs", config_name="config_eval")
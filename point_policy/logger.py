@@ -1,5 +1,11 @@
+import atexit
 import csv
 import datetime
+import os
+import queue
+import threading
+import time
+import traceback
 from collections import defaultdict
 
 import numpy as np
@@ -24,13 +30,99 @@ BC_EVAL_FORMAT = [
 ]
 
 
+def to_python(values):
+    """
+    Converts the tensors among `values` to python floats with a single transfer per device, the
+    other values are returned as is.
+    """
+    values = list(values)
+    by_device = defaultdict(list)
+    for i, value in enumerate(values):
+        if isinstance(value, torch.Tensor):
+            by_device[value.device].append(i)
+    for indices in by_device.values():
+        host = torch.stack([values[i].detach().double() for i in indices]).tolist()
+        for i, value in zip(indices, host):
+            values[i] = value
+    return values
+
+
+class BackgroundWriter:
+    """
+    Runs the file writes of the logger on a background thread, so a dump only hands its values
+    over and never waits for the device or the disk. Files are flushed every `flush_interval`
+    seconds and when the writer is closed, which also happens at exit.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, flush_interval=10.0):
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._flush_fns = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, fn, *args):
+        """Runs fn(*args) on the writer thread, in submission order"""
+        assert not self._closed, "the writer is closed"
+        self._queue.put((fn, args))
+
+    def register_flush(self, fn):
+        self._flush_fns.append(fn)
+
+    def close(self):
+        """Waits for the submitted writes and flushes"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._CLOSE)
+        self._thread.join()
+
+    def _flush(self):
+        for fn in self._flush_fns:
+            self._call(fn)
+
+    @staticmethod
+    def _call(fn, *args):
+        # logging errors are reported, but do not stop training
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(last_flush + self.flush_interval - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._CLOSE:
+                self._flush()
+                return
+            if item is not None:
+                fn, args = item
+                self._call(fn, *args)
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+
+
 class AverageMeter(object):
     def __init__(self):
         self._sum = 0
         self._count = 0
 
     def update(self, value, n=1):
-        self._sum += value
+        # tensors are summed on their device in double precision, which gives the same sum as
+        # python floats without syncing on every update
+        if isinstance(value, torch.Tensor):
+            value = value.detach().double()
+        self._sum = self._sum + value
         self._count += n
 
     def value(self):
@@ -38,19 +130,23 @@ class AverageMeter(object):
 
 
 class MetersGroup(object):
-    def __init__(self, csv_file_name, formating):
+    def __init__(self, csv_file_name, formating, writer=None):
         self._csv_file_name = csv_file_name
         self._formating = formating
         self._meters = defaultdict(AverageMeter)
         self._csv_file = None
         self._csv_writer = None
+        # without a background writer, rows are written and flushed when dumped
+        self._writer = writer
+        if writer is not None:
+            writer.register_flush(self.flush)
 
     def log(self, key, value, n=1):
         self._meters[key].update(value, n)
 
-    def _prime_meters(self):
+    def _prime_meters(self, meters):
         data = dict()
-        for key, meter in self._meters.items():
+        for key, meter in meters.items():
             if key.startswith("train_vq"):
                 key = key[len("train_vq") + 1 :]
             elif key.startswith("train"):
@@ -59,21 +155,44 @@ class MetersGroup(object):
                 key = key[len("eval") + 1 :]
             key = key.replace("/", "_")
             data[key] = meter.value()
-        return data
+        return dict(zip(data.keys(), to_python(data.values())))
 
     def _remove_old_entries(self, data):
-        rows = []
-        with self._csv_file_name.open("r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if float(row["episode"]) >= data["episode"]:
-                    break
-                rows.append(row)
-        with self._csv_file_name.open("w") as f:
-            writer = csv.DictWriter(f, fieldnames=sorted(data.keys()), restval=0.0)
+        """
+        Drops the rows of a previous run from the frame of `data` on. The file is read one row at a
+        time and truncated in place, or copied under a new header if the columns changed.
+        """
+        fieldnames = sorted(data.keys())
+        with self._csv_file_name.open("rb+") as f:
+            header = next(csv.reader([f.readline().decode()]), [])
+            if header == fieldnames:
+                frame_idx = header.index("frame")
+                while True:
+                    offset = f.tell()
+                    line = f.readline()
+                    if len(line) == 0:
+                        return
+                    row = next(csv.reader([line.decode()]))
+                    if float(row[frame_idx]) >= data["frame"]:
+                        f.truncate(offset)
+                        return
+
+        tmp_file_name = self._csv_file_name.with_name(
+            f".{self._csv_file_name.name}.tmp"
+        )
+        with (
+            self._csv_file_name.open("r", newline="") as src,
+            tmp_file_name.open("w", newline="") as dst,
+        ):
+            writer = csv.DictWriter(
+                dst, fieldnames=fieldnames, restval=0.0, extrasaction="ignore"
+            )
             writer.writeheader()
-            for row in rows:
+            for row in csv.DictReader(src):
+                if "frame" in row and float(row["frame"]) >= data["frame"]:
+                    break
                 writer.writerow(row)
+        os.replace(tmp_file_name, self._csv_file_name)
 
     def _dump_to_csv(self, data):
         if self._csv_writer is None:
@@ -90,7 +209,12 @@ class MetersGroup(object):
                 self._csv_writer.writeheader()
 
         self._csv_writer.writerow(data)
-        self._csv_file.flush()
+        if self._writer is None:
+            self._csv_file.flush()
+
+    def flush(self):
+        if self._csv_file is not None:
+            self._csv_file.flush()
 
     def _format(self, key, value, ty):
         if ty == "int":
@@ -114,38 +238,66 @@ class MetersGroup(object):
             pieces.append(self._format(disp_key, value, ty))
         print(" | ".join(pieces))
 
-    def dump(self, step, prefix):
-        if len(self._meters) == 0:
-            return
-        data = self._prime_meters()
+    def _write(self, meters, step, prefix):
+        data = self._prime_meters(meters)
         data["frame"] = step
         self._dump_to_csv(data)
         self._dump_to_console(data, prefix)
-        self._meters.clear()
+
+    def dump(self, step, prefix):
+        if len(self._meters) == 0:
+            return
+        meters, self._meters = self._meters, defaultdict(AverageMeter)
+        if self._writer is None:
+            self._write(meters, step, prefix)
+        else:
+            self._writer.submit(self._write, meters, step, prefix)
 
 
 class Logger(object):
-    def __init__(self, log_dir, use_tb):
+    def __init__(self, log_dir, use_tb, flush_interval=10.0):
         """
         mode: bc, ssl
         """
         self._log_dir = log_dir
-        self._train_mg = MetersGroup(log_dir / "train.csv", formating=BC_TRAIN_FORMAT)
-        self._eval_mg = MetersGroup(log_dir / "eval.csv", formating=BC_EVAL_FORMAT)
+        self._writer = BackgroundWriter(flush_interval)
+        self._train_mg = MetersGroup(
+            log_dir / "train.csv", formating=BC_TRAIN_FORMAT, writer=self._writer
+        )
+        self._eval_mg = MetersGroup(
+            log_dir / "eval.csv", formating=BC_EVAL_FORMAT, writer=self._writer
+        )
 
         if use_tb:
             self._sw = SummaryWriter(str(log_dir / "tb"))
+            self._writer.register_flush(self._sw.flush)
         else:
             self._sw = None
+        # scalars are handed to the writer at the next dump
+        self._sw_pending = []
 
     def _try_sw_log(self, key, value, step):
         if self._sw is not None:
+            self._sw_pending.append((key, value, step))
+
+    def _write_sw(self, pending):
+        values = to_python(value for _, value, _ in pending)
+        for (key, _, step), value in zip(pending, values):
             self._sw.add_scalar(key, value, step)
 
+    def _flush_sw(self):
+        if len(self._sw_pending) > 0:
+            self._writer.submit(self._write_sw, self._sw_pending)
+            self._sw_pending = []
+
+    def close(self):
+        """Writes everything logged so far and flushes the files"""
+        self._flush_sw()
+        self._writer.close()
+
     def log(self, key, value, step):
         assert key.startswith("train") or key.startswith("eval")
-        if type(value) == torch.Tensor:
-            value = value.item()
+        # tensors stay on their device until the next dump
         self._try_sw_log(key, value, step)
         if key.startswith("train_vq"):
             mg = self._train_vq_mg
@@ -158,6 +310,7 @@ class Logger(object):
             self.log(f"{ty}/{key}", value, step)
 
     def dump(self, step, ty=None):
+        self._flush_sw()
         if ty is None or ty == "eval":
             self._eval_mg.dump(step, "eval")
         if ty is None or ty == "train":
@@ -10,6 +10,8 @@ import torchvision.transforms.functional as TF
 from PIL import Image
 from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
 
+MEMORY_POLICIES = ["low-latency", "low-memory"]
+
 
 class Correspondence:
 
@@ -23,6 +25,7 @@ class Correspondence:
         dift_layer=1,
         dift_steps=50,
         use_segmentation=True,
+        memory_policy="low-latency",
     ):
         """
         Initialize the Correspondence class.
@@ -53,7 +56,15 @@ class Correspondence:
 
         use_segmentation: bool
             Whether to use grounded-SAM to restrict DIFT predictions with segmentation mask.
+
+        memory_policy: str
+            Either "low-latency" or "low-memory". "low-latency" keeps the CUDA caching allocator warm between
+            calls to `find_correspondence`, while "low-memory" releases cached blocks back to the driver after
+            every call at the cost of re-growing the allocator on the next call.
         """
+        assert (
+            memory_policy in MEMORY_POLICIES
+        ), f"invalid memory policy: {memory_policy}"
         sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
         from dift.src.models.dift_sd import SDFeaturizer
 
@@ -81,6 +92,7 @@ class Correspondence:
         self.dift_layer = dift_layer
         self.dift_steps = dift_steps
         self.use_segmentation = use_segmentation
+        self.memory_policy = memory_policy
 
         # to be populated later in `set_expert_correspondence`
         self.prompts = None
@@ -221,6 +233,15 @@ class Correspondence:
                 align_corners=True,
             )
 
+            trg_ft = F.interpolate(
+                current_features,
+                size=(self.height, self.width),
+                mode="bilinear",
+                align_corners=True,
+            )
+            trg_vec = trg_ft.view(1, num_channel, -1)  # N, C, HW
+            trg_vec = torch.nn.functional.normalize(trg_vec)  # N, C, HW
+
             for i, coord in enumerate(coords):
                 # crop -> transform -> cossim points (same order as crop -> transform -> dift for image!)
                 # all global coords share the same bbox offset, so subtract this offset and then transform the points
@@ -236,16 +257,7 @@ class Correspondence:
                 )
 
                 src_vec = src_ft[0, :, y, x].view(1, num_channel).clone()
-                trg_ft = F.interpolate(
-                    current_features,
-                    size=(self.height, self.width),
-                    mode="bilinear",
-                    align_corners=True,
-                )
-                trg_vec = trg_ft.view(1, num_channel, -1)  # N, C, HW
-
                 src_vec = torch.nn.functional.normalize(src_vec)  # 1, C
-                trg_vec = torch.nn.functional.normalize(trg_vec)  # N, C, HW
                 cos_map = (
                     torch.matmul(src_vec, trg_vec)
                     .view(1, self.height, self.width)
@@ -263,8 +275,18 @@ class Correspondence:
                     + current_box[1]
                 )
 
-            gc.collect()
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
+            if self.memory_policy == "low-memory":
+                self.release_memory()
 
             return out_coords.cpu().numpy(), current_image
+
+    @staticmethod
+    def release_memory():
+        """
+        Return cached CUDA blocks to the driver. This is called after every `find_correspondence` under the
+        "low-memory" policy, and can be called manually (e.g. before training) under the "low-latency" policy.
+        """
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+            torch.cuda.ipc_collect()
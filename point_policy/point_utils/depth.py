@@ -1,7 +1,20 @@
 import sys
 
 import cv2
+import numpy as np
 import torch
+import torch.nn.functional as F
+
+# image normalization used by Depth Anything
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def constrain_to_multiple_of(x, min_val, multiple_of=14):
+    y = int(np.round(x / multiple_of) * multiple_of)
+    if y < min_val:
+        y = int(np.ceil(x / multiple_of) * multiple_of)
+    return y
 
 
 class Depth:
@@ -72,3 +85,52 @@ class Depth:
         bgr_array = image[:, :, ::-1]
         depth = self.depth.infer_image(bgr_array)
         return depth
+
+    @torch.no_grad()
+    def get_depth_batch(self, images, input_size=518, roi=None):
+        """
+        Get the depth maps for a batch of images in a single forward pass. Preprocessing follows
+        `infer_image` (lower-bound resize to a multiple of 14, ImageNet normalization) but runs on the device.
+
+        Parameters:
+        -----------
+        images : torch.Tensor
+            The images of shape (B, 3, H, W) to find the depth maps for, in RGB format with values in [0, 255].
+
+        input_size : int
+            The size of the shorter image side the images are resized to before inference.
+
+        roi : tuple
+            Optional (x0, y0, x1, y1) region to infer depth in. Depth outside the region is zero.
+
+        Returns:
+        --------
+        depth : torch.Tensor
+            The depth maps of shape (B, H, W) on the device.
+        """
+        images = images.to(self.device)
+        B, _, H, W = images.shape
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, W, H)
+
+        x = images[:, :, y0:y1, x0:x1].float() / 255.0
+        h, w = x.shape[-2:]
+        scale = input_size / min(h, w)
+        size = (
+            constrain_to_multiple_of(h * scale, min_val=input_size),
+            constrain_to_multiple_of(w * scale, min_val=input_size),
+        )
+        x = F.interpolate(x, size, mode="bicubic", align_corners=False).clamp(0, 1)
+        mean = x.new_tensor(MEAN).view(1, 3, 1, 1)
+        std = x.new_tensor(STD).view(1, 3, 1, 1)
+        x = (x - mean) / std
+
+        depth = self.depth(x)
+        depth = F.interpolate(
+            depth[:, None], (h, w), mode="bilinear", align_corners=True
+        )[:, 0]
+
+        if roi is None:
+            return depth
+        out = depth.new_zeros((B, H, W))
+        out[:, y0:y1, x0:x1] = depth
+        return out
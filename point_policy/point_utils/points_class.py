@@ -12,6 +12,26 @@ from point_utils.depth import Depth
 from torchvision import transforms
 
 
+def _roi_contains(outer, inner):
+    """Whether the (x0, y0, x1, y1) region `outer` contains `inner`, None is the whole image"""
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    return (
+        outer[0] <= inner[0]
+        and outer[1] <= inner[1]
+        and outer[2] >= inner[2]
+        and outer[3] >= inner[3]
+    )
+
+
+def _roi_union(a, b):
+    if a is None or b is None:
+        return None
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
 class PointsClass:
     def __init__(
         self,
@@ -31,6 +51,11 @@ class PointsClass:
         num_points,
         object_labels,
         use_gt_depth=True,
+        memory_policy="low-latency",
+        save_debug_images=False,
+        depth_path=None,
+        depth_input_size=518,
+        depth_roi_margin=None,
         **kwargs,
     ):
         """
@@ -64,23 +89,48 @@ class PointsClass:
 
         dift_steps : int
             The number of steps or iterations for feature extraction in the DIFT model.
+
+        memory_policy : str
+            The memory policy of the correspondence model, either "low-latency" or "low-memory".
+
+        save_debug_images : bool
+            Whether to dump the expert and query images used for correspondence to the working directory.
+
+        depth_path : str
+            The path to the Depth Anything source code. Only used if use_gt_depth is False.
+
+        depth_input_size : int
+            The size of the shorter image side for depth inference. Lower values trade accuracy for speed.
+
+        depth_roi_margin : int
+            If set, depth is only inferred in the bounding box around the tracked points grown by this margin
+            (in pixels). Depth outside the box is zero.
         """
 
         self.pixel_keys = pixel_keys
         self.device = device
         self.object_labels = object_labels
+        self.save_debug_images = save_debug_images
 
         self.tracks = {pixel_key: None for pixel_key in self.pixel_keys}
         if "human_hand" in self.object_labels:
             # Do hand tracking with MediaPipe
             import mediapipe as mp
 
-            # Initialize MediaPipe Hands
+            # Initialize MediaPipe Hands in video mode, one per camera so that each
+            # stream is tracked over time and only the newly added frame is processed
             mp_hands = mp.solutions.hands
-            self.hands = mp_hands.Hands(
-                static_image_mode=True, max_num_hands=1, min_detection_confidence=0.5
-            )
+            self.hands = {
+                pixel_key: mp_hands.Hands(
+                    static_image_mode=False,
+                    max_num_hands=1,
+                    min_detection_confidence=0.5,
+                )
+                for pixel_key in self.pixel_keys
+            }
             self.hand_tracks = {pixel_key: None for pixel_key in self.pixel_keys}
+            # hand landmarks per frame, aligned with the image ring buffer
+            self.hand_list = {pixel_key: None for pixel_key in self.pixel_keys}
 
             # remove "human_hand" from object_labels
             self.object_labels.remove("human_hand")
@@ -99,6 +149,7 @@ class PointsClass:
             dift_layer,
             dift_steps,
             use_segmentation,
+            memory_policy,
         )
 
         self.initial_coords, self.expert_correspondence_features = {}, {}
@@ -125,32 +176,39 @@ class PointsClass:
                                 prompts,
                             )
                         )
-                        self.expert_correspondence_features[key].save(
-                            f"expert_image_{key}.png"
-                        )
+                        if self.save_debug_images:
+                            self.expert_correspondence_features[key].save(
+                                f"expert_image_{key}.png"
+                            )
 
         # Set up the depth model
-        if use_gt_depth:
-            # self.depth_model = Depth("/path/to/Depth-Anything-V2/", device)
-            pass
+        self.depth_model = None
+        if not use_gt_depth and depth_path is not None:
+            self.depth_model = Depth(depth_path, device)
+        self.depth_input_size = depth_input_size
+        self.depth_roi_margin = depth_roi_margin
 
         # Set up cotracker
         sys.path.append(root_dir + "/co-tracker/")
         from cotracker.predictor import CoTrackerOnlinePredictor
 
-        # self.cotracker = CoTrackerOnlinePredictor(checkpoint=root_dir + "/co-tracker/checkpoints/scaled_online.pth", window_len=16).to(device)
-        self.cotracker = {}
-        for pixel_key in self.pixel_keys:
-            self.cotracker[pixel_key] = CoTrackerOnlinePredictor(
-                checkpoint=cotracker_checkpoint,
-                window_len=16,
-            ).to(device)
+        # one set of weights is shared by all cameras, the online state of each camera
+        # (or group of cameras tracked together) is swapped in and out in `track_points_all`
+        self.window_len = 16
+        self.cotracker = CoTrackerOnlinePredictor(
+            checkpoint=cotracker_checkpoint,
+            window_len=self.window_len,
+        ).to(device)
+        self.tracker_states = {}
 
         self.transform = transforms.Compose([transforms.PILToTensor()])
-        self.image_list = {
-            f"{pixel_key}": torch.tensor([]).to(self.device)
-            for pixel_key in self.pixel_keys
-        }
+        # uint8 ring buffer of frames on the device, see `add_to_image_list`
+        self.image_list = {f"{pixel_key}": None for pixel_key in self.pixel_keys}
+        self.image_heads = {f"{pixel_key}": None for pixel_key in self.pixel_keys}
+        # id of the image in each slot of the image buffer, and (roi, inferred depth) per image id
+        self.frame_ids = {f"{pixel_key}": None for pixel_key in self.pixel_keys}
+        self.num_frames = {f"{pixel_key}": 0 for pixel_key in self.pixel_keys}
+        self.depth_cache = {f"{pixel_key}": {} for pixel_key in self.pixel_keys}
         self.depth = {
             f"{pixel_key}": torch.tensor([]).to(self.device)
             for pixel_key in self.pixel_keys
@@ -190,40 +248,119 @@ class PointsClass:
 
         key = f"{pixel_key}"
 
-        transformed = (
-            torch.from_numpy(image.astype(np.uint8)).permute(2, 0, 1).float() / 255
-        )
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        frame = torch.from_numpy(image).to(self.device).permute(2, 0, 1)
+        is_first_image = self.image_heads[key] is None
+
+        # Every frame is written twice (at slot i and i + window_len) so that the last
+        # window_len frames are always a contiguous slice, see `get_image_window`
+        buffer = self.image_list[key]
+        if is_first_image:
+            # If it is the first image you want to repeat it until the whole window is full
+            if buffer is None or buffer.shape[1:] != frame.shape:
+                self.image_list[key] = frame[None].repeat(2 * self.window_len, 1, 1, 1)
+            else:
+                buffer[:] = frame
+            self.image_heads[key] = self.window_len - 1
+            self.frame_ids[key] = np.full(self.window_len, self.num_frames[key])
+        else:
+            # Otherwise overwrite the oldest image with the new one
+            head = (self.image_heads[key] + 1) % self.window_len
+            buffer[head] = frame
+            buffer[head + self.window_len] = frame
+            self.image_heads[key] = head
+            self.frame_ids[key][head] = self.num_frames[key]
+        self.num_frames[key] += 1
 
-        # We only want to track the last 16 images so pop the first one off if we have more than 16
-        if self.image_list[key].shape[0] > 0 and self.image_list[key].shape[1] == 16:
-            self.image_list[key] = self.image_list[key][:, 1:]
-
-        # If it is the first image you want to repeat until the whole array is full
-        # Otherwise it will just add the new image to the end of the array
-        while self.image_list[key].shape[0] == 0 or self.image_list[key].shape[1] < 16:
-            self.image_list[key] = torch.cat(
-                (
-                    self.image_list[key],
-                    transformed.unsqueeze(0).unsqueeze(0).clone().to(self.device),
-                ),
-                dim=1,
+        if self.detect_hand:
+            self._add_to_hand_list(image, key, is_first_image)
+
+    def _add_to_hand_list(self, image, pixel_key, is_first_image):
+        # same layout as the image ring buffer, so the image head indexes both
+        head = self.image_heads[pixel_key]
+        if is_first_image:
+            # start a new video stream for the tracker
+            self.hands[pixel_key].reset()
+        hand_track = self._detect_hand(image, pixel_key)
+
+        if is_first_image:
+            if hand_track is None:
+                hand_track = np.zeros((self.num_hand_points, 2), dtype=int)
+            self.hand_list[pixel_key] = np.repeat(
+                hand_track[None], 2 * self.window_len, axis=0
             )
+        else:
+            if hand_track is None:
+                # no hand found, keep the landmarks of the previous frame
+                hand_track = self.hand_list[pixel_key][head - 1 + self.window_len]
+            self.hand_list[pixel_key][head] = hand_track
+            self.hand_list[pixel_key][head + self.window_len] = hand_track
+
+    def _detect_hand(self, image, pixel_key):
+        results = self.hands[pixel_key].process(image)
+        if results.multi_hand_landmarks is None:
+            return None
+
+        hand_track = []
+        for hand_landmarks in results.multi_hand_landmarks:
+            # Wrist landmarks: 0
+            # Index finger landmarks: 5, 6, 7, 8
+            # Thumb landmarks: 1, 2, 3, 4
+            wrist_landmark = hand_landmarks.landmark[0]
+            index_finger_landmarks = [hand_landmarks.landmark[i] for i in [5, 6, 7, 8]]
+            thumb_landmarks = [hand_landmarks.landmark[i] for i in [1, 2, 3, 4]]
+
+            # Draw wrist
+            x = int(wrist_landmark.x * image.shape[1])
+            y = int(wrist_landmark.y * image.shape[0])
+            hand_track.append([x, y])
+
+            # Draw index finger
+            for landmark in index_finger_landmarks:
+                x = int(landmark.x * image.shape[1])
+                y = int(landmark.y * image.shape[0])
+                hand_track.append([x, y])
+
+            # Draw thumb
+            for landmark in thumb_landmarks:
+                x = int(landmark.x * image.shape[1])
+                y = int(landmark.y * image.shape[0])
+                hand_track.append([x, y])
+
+        return np.array(hand_track)
+
+    def get_image_window(self, pixel_key):
+        """
+        Get the last window_len images of the image list in temporal order.
+
+        Returns:
+        --------
+        window : torch.Tensor
+            A uint8 view of shape (window_len, 3, height, width) into the image list, oldest image first.
+        """
+        key = f"{pixel_key}"
+        head = self.image_heads[key]
+        return self.image_list[key][head + 1 : head + 1 + self.window_len]
+
+    def _to_video(self, *windows):
+        # CoTracker takes float videos of shape (B, T, 3, H, W) in [0, 1], one camera per batch element
+        return torch.stack(windows).float() / 255
 
     def reset_episode(self):
         """
         Reset the image list for finding key points.
         """
 
-        self.image_list = {
-            f"{pixel_key}": torch.tensor([]).to(self.device)
-            for pixel_key in self.pixel_keys
-        }
+        # keep the image buffers allocated, the next image refills them
+        self.image_heads = {f"{pixel_key}": None for pixel_key in self.pixel_keys}
+        self.depth_cache = {f"{pixel_key}": {} for pixel_key in self.pixel_keys}
         self.depth = {
             f"{pixel_key}": torch.tensor([]).to(self.device)
             for pixel_key in self.pixel_keys
         }
         self.tracks = {pixel_key: None for pixel_key in self.pixel_keys}
         self.hand_tracks = {pixel_key: None for pixel_key in self.pixel_keys}
+        self.tracker_states = {}
 
     def find_semantic_similar_points(self, pixel_key, object_label=""):
         """
@@ -236,13 +373,14 @@ class PointsClass:
         key = f"{pixel_key}_{object_label}"
         out_coords, query_image = self.correspondence_model.find_correspondence(
             # self.expert_correspondence_features[key],
-            transforms.ToPILImage()(self.image_list[pixel_key][0, -1]),
+            transforms.ToPILImage()(self.get_image_window(pixel_key)[-1].cpu()),
             self.initial_coords[key],
             # pixel_key,
             # object_label,
         )
         self.semantic_similar_points[key] = torch.tensor(out_coords, device=self.device)
-        query_image.save("query_image.png")
+        if self.save_debug_images:
+            query_image.save("query_image.png")
 
     def get_depth(self, pixel_key, last_n_frames=1):
         """
@@ -254,22 +392,61 @@ class PointsClass:
             The number of frames to look back in the episode
         """
         key = f"{pixel_key}"
-
-        self.depth[key] = np.zeros(
-            (
-                last_n_frames,
-                self.image_list[key].shape[3],
-                self.image_list[key].shape[4],
+        window = self.get_image_window(key)
+
+        # ids of the last n images, window position i is stored in buffer slot (head + 1 + i) % window_len
+        positions = np.arange(self.window_len - last_n_frames, self.window_len)
+        slots = (self.image_heads[key] + 1 + positions) % self.window_len
+        frame_ids = self.frame_ids[key][slots]
+
+        # depth is zero outside the roi it was inferred in, so a cached depth is only reused if
+        # its roi contains the current one
+        roi = self._get_depth_roi(key, last_n_frames, window.shape[-2:])
+
+        # drop the depth of images that left the window, and infer depth of new images in one batch
+        cache = {
+            i: entry
+            for i, entry in self.depth_cache[key].items()
+            if i in self.frame_ids[key]
+        }
+        missing = [
+            idx
+            for idx, i in enumerate(frame_ids)
+            if (i not in cache or not _roi_contains(cache[i][0], roi))
+            and i not in frame_ids[:idx]
+        ]
+        if len(missing) > 0:
+            # the roi grows to cover the previous roi of re-inferred images, so an image is only
+            # inferred again if the tracks leave every roi it was inferred in
+            for idx in missing:
+                if frame_ids[idx] in cache:
+                    roi = _roi_union(roi, cache[frame_ids[idx]][0])
+            depths = self.depth_model.get_depth_batch(
+                window[positions[missing]],
+                input_size=self.depth_input_size,
+                roi=roi,
             )
+            for idx, depth in zip(missing, depths):
+                cache[frame_ids[idx]] = (roi, depth)
+        self.depth_cache[key] = cache
+
+        self.depth[key] = torch.stack([cache[i][1] for i in frame_ids]).cpu().numpy()
+
+    def _get_depth_roi(self, pixel_key, last_n_frames, image_size):
+        if self.depth_roi_margin is None or self.tracks[pixel_key] is None:
+            return None
+
+        height, width = image_size
+        points = self.tracks[pixel_key][0, -last_n_frames:, : self.num_points]
+        points = points.reshape(-1, 2)
+        x0, y0 = (points.min(dim=0).values - self.depth_roi_margin).long().tolist()
+        x1, y1 = (points.max(dim=0).values + self.depth_roi_margin).long().tolist()
+        return (
+            min(max(x0, 0), width - 1),
+            min(max(y0, 0), height - 1),
+            min(max(x1 + 1, 1), width),
+            min(max(y1 + 1, 1), height),
         )
-        for frame_num in range(last_n_frames):
-            frame_idx = -1 * (last_n_frames - frame_num)
-            numpy_image = (
-                self.image_list[key][0, frame_idx].cpu().numpy().transpose(1, 2, 0)
-                * 255
-            )
-            depth = self.depth_model.get_depth(numpy_image)
-            self.depth[key][frame_idx] = depth
 
     def set_depth(
         self,
@@ -319,26 +496,55 @@ class PointsClass:
         is_first_step : bool
             Whether or not this is the first step in the episode.
         """
+        self.track_points_all([pixel_key], last_n_frames, is_first_step, one_frame)
+
+    def track_points_all(
+        self, pixel_keys=None, last_n_frames=1, is_first_step=False, one_frame=True
+    ):
+        """
+        Track the key points in the current images of several cameras with a single batched CoTracker
+        forward. The cameras must share the same image size and be tracked together from the first step.
+
+        Parameters:
+        -----------
+        pixel_keys : list
+            The pixel keys to track. Defaults to all pixel keys.
+
+        is_first_step : bool
+            Whether or not this is the first step in the episode.
+        """
+        pixel_keys = self.pixel_keys if pixel_keys is None else list(pixel_keys)
 
         if self.detect_hand:
-            hand_tracks = self.track_points_hand(pixel_key)
-            hand_tracks = torch.tensor(hand_tracks)
+            for pixel_key in pixel_keys:
+                hand_tracks = self.track_points_hand(pixel_key)
+                hand_tracks = torch.tensor(hand_tracks)
+
+                if not is_first_step:
+                    if self.hand_tracks[pixel_key] is None:
+                        self.hand_tracks[pixel_key] = hand_tracks[None]
+                    else:
+                        hand_tracks = hand_tracks[-last_n_frames:]
+                        self.hand_tracks[pixel_key] = torch.cat(
+                            [
+                                self.hand_tracks[pixel_key],
+                                hand_tracks[None].to(
+                                    self.hand_tracks[pixel_key].device
+                                ),
+                            ],
+                            dim=1,
+                        )
 
-            if not is_first_step:
-                if self.hand_tracks[pixel_key] is None:
-                    self.hand_tracks[pixel_key] = hand_tracks[None]
-                else:
-                    hand_tracks = hand_tracks[-last_n_frames:]
-                    self.hand_tracks[pixel_key] = torch.cat(
-                        [
-                            self.hand_tracks[pixel_key],
-                            hand_tracks[None].to(self.hand_tracks[pixel_key].device),
-                        ],
-                        dim=1,
-                    )
+        if len(self.object_labels) == 0:
+            for pixel_key in pixel_keys:
+                self.tracks[pixel_key] = self.hand_tracks[pixel_key]
+            return
 
-        if len(self.object_labels) > 0:
-            if is_first_step:
+        # the online state of the shared tracker is kept per group of cameras tracked together
+        state_key = tuple(pixel_keys)
+        if is_first_step:
+            queries = []
+            for pixel_key in pixel_keys:
                 semantic_similar_points = []
                 for object_label in self.object_labels:
                     semantic_similar_points.append(
@@ -346,81 +552,73 @@ class PointsClass:
                     )
                 semantic_similar_points = torch.cat(semantic_similar_points, dim=0)
 
-                self.cotracker[pixel_key](
-                    video_chunk=self.image_list[pixel_key][0, 0]
-                    .unsqueeze(0)
-                    .unsqueeze(0),
+                self.cotracker(
+                    video_chunk=self._to_video(self.get_image_window(pixel_key)[:1]),
                     is_first_step=True,
                     add_support_grid=True,
                     queries=semantic_similar_points[None].to(self.device),
                 )
+                queries.append(self.cotracker.queries)
                 self.tracks[pixel_key] = semantic_similar_points
-            else:
-                tracks, _ = self.cotracker[pixel_key](
-                    self.image_list[pixel_key], one_frame=one_frame
-                )
-                # Remove the support points
-                tracks = tracks[:, :, 0 : self.num_points, :]
 
+            # batch the queries (with support points) of all cameras
+            self.cotracker.queries = torch.cat(queries, dim=0)
+            self._save_tracker_state(state_key)
+        else:
+            self._load_tracker_state(state_key)
+            tracks, _ = self.cotracker(
+                self._to_video(
+                    *[self.get_image_window(pixel_key) for pixel_key in pixel_keys]
+                ),
+                one_frame=one_frame,
+            )
+            self._save_tracker_state(state_key)
+
+            # Remove the support points
+            tracks = tracks[:, :, 0 : self.num_points, :]
+
+            for idx, pixel_key in enumerate(pixel_keys):
                 if self.detect_hand:
                     self.hand_tracks[pixel_key] = self.hand_tracks[pixel_key].to(
                         tracks.device
                     )
                     self.tracks[pixel_key] = torch.cat(
-                        [self.hand_tracks[pixel_key], tracks], dim=-2
+                        [self.hand_tracks[pixel_key], tracks[idx : idx + 1]], dim=-2
                     )
                 else:
-                    self.tracks[pixel_key] = tracks.clone()
-        else:
-            self.tracks[pixel_key] = self.hand_tracks[pixel_key]
+                    self.tracks[pixel_key] = tracks[idx : idx + 1].clone()
+
+    def _save_tracker_state(self, state_key):
+        # online state lives in the predictor (queries) and in the model (online_*)
+        state = {
+            k: v
+            for k, v in vars(self.cotracker.model).items()
+            if k.startswith("online_")
+        }
+        for k in ["queries", "N"]:
+            if hasattr(self.cotracker, k):
+                state[k] = getattr(self.cotracker, k)
+        self.tracker_states[state_key] = state
+
+    def _load_tracker_state(self, state_key):
+        for k, v in self.tracker_states[state_key].items():
+            if k.startswith("online_"):
+                setattr(self.cotracker.model, k, v)
+            else:
+                setattr(self.cotracker, k, v)
 
     def track_points_hand(self, pixel_key):
-        frames = (
-            self.image_list[pixel_key][0].cpu().numpy().transpose(0, 2, 3, 1) * 255.0
-        )
-        frames = frames.astype(np.uint8)
-
-        hand_tracks = []
-        for frame in frames:
-            results = self.hands.process(frame)
-            if results.multi_hand_landmarks is not None:
-                hand_track = []
-                for hand_landmarks in results.multi_hand_landmarks:
-                    # Wrist landmarks: 0
-                    # Index finger landmarks: 5, 6, 7, 8
-                    # Thumb landmarks: 1, 2, 3, 4
-                    wrist_landmark = hand_landmarks.landmark[0]
-                    index_finger_landmarks = [
-                        hand_landmarks.landmark[i] for i in [5, 6, 7, 8]
-                    ]
-                    thumb_landmarks = [hand_landmarks.landmark[i] for i in [1, 2, 3, 4]]
-
-                    # Draw wrist
-                    x = int(wrist_landmark.x * frame.shape[1])
-                    y = int(wrist_landmark.y * frame.shape[0])
-                    hand_track.append([x, y])
-
-                    # Draw index finger
-                    for landmark in index_finger_landmarks:
-                        x = int(landmark.x * frame.shape[1])
-                        y = int(landmark.y * frame.shape[0])
-                        hand_track.append([x, y])
-
-                    # Draw thumb
-                    for landmark in thumb_landmarks:
-                        x = int(landmark.x * frame.shape[1])
-                        y = int(landmark.y * frame.shape[0])
-                        hand_track.append([x, y])
-
-                hand_track = np.array(hand_track)
-                hand_tracks.append(hand_track)
-            else:
-                hand_tracks.append(
-                    hand_tracks[-1]
-                    if len(hand_tracks) > 0
-                    else self.hand_tracks[pixel_key][0, -1].cpu()
-                )
-        return np.array(hand_tracks)
+        """
+        Get the hand landmarks of the images in the image window. Landmarks are computed once per image
+        when it is added in `add_to_image_list`.
+
+        Returns:
+        --------
+        hand_tracks : np.ndarray
+            The hand landmarks of shape (window_len, num_hand_points, 2), oldest image first.
+        """
+        head = self.image_heads[pixel_key]
+        return self.hand_list[pixel_key][head + 1 : head + 1 + self.window_len].copy()
 
     def get_points(self, pixel_key, last_n_frames=1):
         """
@@ -437,44 +635,35 @@ class PointsClass:
             The list of points for the current frame.
         """
 
-        final_points = torch.zeros((last_n_frames, self.num_points, 3))
-
-        for frame_num in range(last_n_frames):
-            for point in range(self.num_points):
-                frame_idx = -1 * (last_n_frames - frame_num)
-                # try:
-                if self.original_image_size is None:
-                    depth = self.depth[pixel_key][
-                        frame_idx,
-                        int(self.tracks[pixel_key][0, frame_idx, point][1]),
-                        int(self.tracks[pixel_key][0, frame_idx, point][0]),
-                    ]
-                else:
-                    crop_h, crop_w = self.crop_ratios
-                    w_orig, h_orig = self.original_image_size
-                    w_curr, h_curr = self.current_image_size
-
-                    # compute point_h in original image
-                    point_h = self.tracks[pixel_key][0, frame_idx, point][1]
-                    h_orig_cropped = h_orig * (crop_h[1] - crop_h[0])
-                    point_h_orig = int(
-                        (point_h / h_curr) * h_orig_cropped + h_orig * crop_h[0]
-                    )
-
-                    # compute point_w in original image
-                    point_w = int(self.tracks[pixel_key][0, frame_idx, point][0])
-                    w_orig_cropped = w_orig * (crop_w[1] - crop_w[0])
-                    point_w_orig = int(
-                        (point_w / w_curr) * w_orig_cropped + w_orig * crop_w[0]
-                    )
-
-                    depth = self.depth[pixel_key][frame_idx, point_h_orig, point_w_orig]
-
-                x = self.tracks[pixel_key][0, frame_idx, point][0]
-                y = self.tracks[pixel_key][0, frame_idx, point][1]
-
-                final_points[frame_num, point] = torch.tensor([x, y, depth])
+        # (last_n_frames, num_points, 2) in a single device to host copy
+        points = self.tracks[pixel_key][0, -last_n_frames:, : self.num_points].cpu()
+        x, y = points[..., 0], points[..., 1]
 
+        if self.original_image_size is None:
+            point_h, point_w = y.long(), x.long()
+        else:
+            crop_h, crop_w = self.crop_ratios
+            w_orig, h_orig = self.original_image_size
+            w_curr, h_curr = self.current_image_size
+
+            # compute point_h in original image
+            h_orig_cropped = h_orig * (crop_h[1] - crop_h[0])
+            point_h = ((y / h_curr) * h_orig_cropped + h_orig * crop_h[0]).long()
+
+            # compute point_w in original image (x is truncated before rescaling)
+            w_orig_cropped = w_orig * (crop_w[1] - crop_w[0])
+            point_w = x.long().double()
+            point_w = ((point_w / w_curr) * w_orig_cropped + w_orig * crop_w[0]).long()
+
+        # gather the depth of every point of every frame at once
+        depth = np.asarray(self.depth[pixel_key])[-last_n_frames:]
+        frame_idx = np.arange(len(depth))[:, None]
+        depth = depth[frame_idx, point_h.numpy(), point_w.numpy()]
+
+        final_points = torch.stack(
+            [x.float(), y.float(), torch.as_tensor(depth, dtype=torch.float32)],
+            dim=-1,
+        )
         return final_points
 
     def get_points_on_image(self, pixel_key, last_n_frames=1):
@@ -492,15 +681,8 @@ class PointsClass:
             The list of points for the current frame.
         """
 
-        final_points = torch.zeros((last_n_frames, self.num_points, 2))
-
-        for frame_num in range(last_n_frames):
-            for point in range(self.num_points):
-                frame_idx = -1 * (last_n_frames - frame_num)
-
-                x = self.tracks[pixel_key][0, frame_idx, point][0]
-                y = self.tracks[pixel_key][0, frame_idx, point][1]
-                final_points[frame_num, point] = torch.tensor([x, y])
+        final_points = self.tracks[pixel_key][0, -last_n_frames:, : self.num_points]
+        final_points = final_points.to("cpu", torch.float32, copy=True)
 
         return final_points
 
@@ -524,11 +706,10 @@ class PointsClass:
         for frame_num in range(last_n_frames):
             frame_idx = -1 * (last_n_frames - frame_num)
             curr_image = (
-                self.image_list[pixel_key][0, frame_idx]
+                self.get_image_window(pixel_key)[frame_idx]
                 .cpu()
                 .numpy()
                 .transpose(1, 2, 0)
-                * 255
             )
 
             fig, ax = plt.subplots(1)
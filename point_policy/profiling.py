@@ -0,0 +1,163 @@
+"""torch.profiler traces of training steps and evaluations, with a summary of the named phases"""
+
+import contextlib
+from pathlib import Path
+
+import torch
+from torch.profiler import ProfilerActivity, profile, schedule
+
+# record_function ranges of the training loop, the agents, the loader and the env wrappers
+PHASES = [
+    "data_wait",
+    "h2d_copy",
+    "augment",
+    "forward",
+    "backward",
+    "all_reduce",
+    "optimizer_step",
+    "logging",
+    "snapshot",
+    "eval",
+    "policy_act",
+    "env_reset",
+    "env_step",
+    "point_tracking",
+]
+
+
+def _activities():
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return activities
+
+
+def _device_time(event):
+    # renamed from cuda_time_total in newer versions of torch
+    return getattr(event, "device_time_total", getattr(event, "cuda_time_total", 0))
+
+
+def summarize(prof, num_steps=None):
+    """
+    Returns a table of the time spent in each phase of `PHASES` that was recorded by `prof`.
+
+    Parameters:
+    -----------
+    prof : torch.profiler.profile
+        A profiler whose trace is ready.
+
+    num_steps : int
+        The number of profiled steps, to report the time per step. None reports the time per call.
+    """
+    events = {event.key: event for event in prof.key_averages()}
+    per = f"cpu per {'step' if num_steps is not None else 'call'} (ms)"
+    lines = [f"| {'phase': <16} | calls | cpu total (ms) | {per} | device total (ms) |"]
+    for phase in PHASES:
+        if phase not in events:
+            continue
+        event = events[phase]
+        cpu_total = event.cpu_time_total / 1000
+        count = num_steps if num_steps is not None else event.count
+        lines.append(
+            f"| {phase: <16} | {event.count: >5} | {cpu_total: >14.2f} "
+            f"| {cpu_total / count: >{len(per)}.3f} "
+            f"| {_device_time(event) / 1000: >17.2f} |"
+        )
+    return "\n".join(lines)
+
+
+def export(prof, out_dir, name, num_steps=None):
+    """Writes {name}_trace.json (for chrome://tracing or Perfetto) and {name}_summary.txt"""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    prof.export_chrome_trace(str(out_dir / f"{name}_trace.json"))
+    summary = summarize(prof, num_steps)
+    sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+    with (out_dir / f"{name}_summary.txt").open("w") as f:
+        f.write(summary + "\n\n")
+        f.write(prof.key_averages().table(sort_by=sort_by, row_limit=30))
+    print(f"{name} profile: {out_dir}\n{summary}")
+
+
+class TrainProfiler:
+    """
+    Profiles a window of training steps, the first `wait` steps are skipped and the next `warmup`
+    steps are traced but discarded. The trace of the following `active` steps and the first
+    evaluation after them are exported to `out_dir`.
+
+    A disabled profiler (e.g. on ranks other than 0) does nothing, so the training loop calls it
+    unconditionally.
+    """
+
+    def __init__(self, out_dir, wait=10, warmup=5, active=20, enabled=True):
+        """
+        Parameters:
+        -----------
+        out_dir : str or Path
+            The directory the traces and summaries are written to.
+
+        wait : int
+            The number of training steps before the profiler starts tracing.
+
+        warmup : int
+            The number of traced steps discarded before the profiled window.
+
+        active : int
+            The number of profiled training steps.
+
+        enabled : bool
+            Whether to profile at all.
+        """
+        assert active > 0, "the profiled window needs at least one step"
+        self.out_dir = Path(out_dir)
+        self.enabled = enabled
+        self._skipped = wait + warmup
+        self._active = active
+        self._steps = 0
+        self._train_done = False
+        self._eval_done = False
+        self._prof = None
+        if enabled:
+            self._prof = profile(
+                activities=_activities(),
+                schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=self._on_train_ready,
+            )
+
+    def _on_train_ready(self, prof):
+        num_steps = min(max(self._steps - self._skipped, 1), self._active)
+        export(prof, self.out_dir, "train", num_steps)
+        self._train_done = True
+
+    def start(self):
+        if self._prof is not None:
+            self._prof.start()
+
+    def step(self):
+        """Marks the end of a training step"""
+        if self._prof is None:
+            return
+        self._steps += 1
+        self._prof.step()
+        # the eval profiler can only start once this one is stopped
+        if self._train_done:
+            self.stop()
+
+    def stop(self):
+        """Stops the profiler, a window cut short by the end of training is exported as it is"""
+        if self._prof is not None:
+            self._prof.stop()
+            self._prof = None
+
+    @contextlib.contextmanager
+    def eval(self):
+        """Profiles the first evaluation after the training window, which has its own trace"""
+        if not self.enabled or not self._train_done or self._eval_done:
+            yield
+            return
+        with profile(
+            activities=_activities(),
+            on_trace_ready=lambda prof: export(prof, self.out_dir, "eval"),
+        ):
+            yield
+        self._eval_done = True
@@ -1,6 +1,7 @@
 """Implements an IterableDataset for Aria data"""
 
 import glob
+import hashlib
 import json
 import os
 import random
@@ -12,10 +13,35 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torchvision.transforms as transforms
+from read_data.sampler import ResumableSampler
+from read_data.shared_arena import share_arrays
 from scipy.spatial.transform import Rotation
 from scipy.stats import median_abs_deviation, truncnorm
 from torch.utils.data import IterableDataset
 
+# bump whenever the processing in `compile_demonstrations` changes to invalidate existing caches
+CACHE_VERSION = 1
+# files read from each demonstration directory
+SOURCE_FILES = [
+    "triangulation.json",
+    "index.npy",
+    "thumb.npy",
+    "pose.npy",
+    "first_frame_g2w.npy",
+    "grasp.npy",
+]
+# processing parameters
+MAX_SEGMENT_EPS = 0.04
+MIN_SEGMENT_EPS = 0.01
+
+
+def _norm(vectors: np.ndarray):
+    """
+    Row-wise L2 norm of an (N, D) array. Computed as a batched dot product so that each norm is
+    bit-identical to `np.linalg.norm` of the row, which `np.linalg.norm(vectors, axis=1)` is not.
+    """
+    return np.sqrt((vectors[:, None, :] @ vectors[:, :, None])[:, 0, 0])
+
 
 def break_long_segments(trajectory: np.ndarray, labels: np.ndarray, max_eps: float):
     """
@@ -30,54 +56,74 @@ def break_long_segments(trajectory: np.ndarray, labels: np.ndarray, max_eps: flo
         new_traj (np.ndarray): Resampled trajectory with all segment lengths <= max_eps.
         new_labels (np.ndarray): Resampled boolean labels for the new trajectory.
     """
-    new_traj = []
-    new_labels = []
+    trajectory = np.asarray(trajectory)
+    labels = np.asarray(labels)
 
-    for i in range(len(trajectory) - 1):
-        p1 = trajectory[i]
-        p2 = trajectory[i + 1]
-        l1 = labels[i]
+    # number of equally spaced points each segment is split into
+    dists = _norm(trajectory[1:] - trajectory[:-1])
+    n_steps = np.maximum(1, np.ceil(dists / max_eps).astype(int))
 
-        seg = p2 - p1
-        dist = np.linalg.norm(seg)
-        n_steps = max(1, int(np.ceil(dist / max_eps)))
+    # segment index and fractional offset of every new point
+    seg_idx = np.repeat(np.arange(len(n_steps)), n_steps)
+    starts = np.cumsum(n_steps) - n_steps
+    alpha = (np.arange(len(seg_idx)) - starts[seg_idx]) / n_steps[seg_idx]
 
-        for j in range(n_steps):
-            alpha = j / n_steps
-            point = (1 - alpha) * p1 + alpha * p2
-            new_traj.append(point)
-            new_labels.append(l1)
+    # interpolate in the trajectory dtype, like python float scalars would
+    alpha = alpha[:, None]
+    one_minus_alpha = (1 - alpha).astype(trajectory.dtype, copy=False)
+    alpha = alpha.astype(trajectory.dtype, copy=False)
+    new_traj = one_minus_alpha * trajectory[seg_idx] + alpha * trajectory[seg_idx + 1]
 
     # Include the last point and its label
-    new_traj.append(trajectory[-1])
-    new_labels.append(labels[-1])
+    new_traj = np.concatenate([new_traj, trajectory[-1:]], axis=0)
+    new_labels = np.concatenate([labels[seg_idx], labels[-1:]]).astype(bool)
 
-    return np.array(new_traj), np.array(new_labels, dtype=bool)
+    return new_traj, new_labels
 
 
-def _remove_stationary_points(points, labels, min_eps=0.01):
+def _remove_stationary_points(points, labels, min_eps=0.01, window=16):
     points = np.asarray(points)
     labels = np.asarray(labels).squeeze()
 
-    # merge small segments (less than `eps` distance)
-    new_points = [points[0]]
-    new_labels = [labels[0]]
-    last_point = points[0]
-    for i in range(1, len(points)):
-        # if the current segment is too small, merge it with the previous one
-        if np.linalg.norm(points[i] - last_point) > min_eps:
-            new_points.append(points[i])
-            new_labels.append(labels[i])
-            last_point = points[i]
-
-    new_points = np.array(new_points)
-    new_labels = np.array(new_labels)
+    # merge small segments (less than `eps` distance): a point is kept if it is further than
+    # `eps` from the last kept point. A point far from its kept predecessor is always kept, so
+    # only the points following a close step need to be scanned against the last kept point.
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = True
+    close = np.flatnonzero(~(_norm(points[1:] - points[:-1]) > min_eps)) + 1
+
+    i = 1
+    while i < n:
+        # keep the run of points up to the next close step
+        next_close = np.searchsorted(close, i)
+        j = close[next_close] if next_close < len(close) else n
+        keep[i:j] = True
+
+        # scan for the first point after the close step that is far from the last kept point
+        i = n
+        for k in range(j, n, window):
+            far = np.flatnonzero(
+                _norm(points[k : k + window] - points[j - 1]) > min_eps
+            )
+            if len(far) > 0:
+                i = k + far[0]
+                keep[i] = True
+                i += 1
+                break
+
+    new_points = points[keep]
+    new_labels = labels[keep]
     return new_points, new_labels
 
 
 def remove_stationary_points(points, labels, min_eps=0.01, iters=5):
     for _ in range(iters):
+        num_points = len(points)
         points, labels = _remove_stationary_points(points, labels, min_eps=min_eps)
+        # consecutive kept points are further than `eps` apart, so later passes keep everything
+        if len(points) == num_points:
+            break
 
     return points, labels
 
@@ -333,6 +379,23 @@ class Random3DAugmentation:
         # uniform
         return np.random.uniform(low=self.lower, high=self.upper, size=size)
 
+    def _sample_torch(self, batch_size, device):
+        mean, lower, upper = (
+            torch.as_tensor(x, dtype=torch.float32, device=device)
+            for x in (self.mean, self.lower, self.upper)
+        )
+        u = torch.rand(batch_size, 3, device=device)
+
+        # gaussian, by inverse transform sampling of the truncated normal
+        if self.std > 0:
+            a = torch.special.ndtr((lower - mean) / self.std)
+            b = torch.special.ndtr((upper - mean) / self.std)
+            x = mean + self.std * torch.special.ndtri(a + (b - a) * u)
+            return torch.minimum(torch.maximum(x, lower), upper)
+
+        # uniform
+        return lower + (upper - lower) * u
+
     @abstractmethod
     def __call__(self, states_and_actions):
         raise NotImplementedError
@@ -360,6 +423,14 @@ class RandomTranslation(Random3DAugmentation):
         actions = _translate(actions)
         return states, actions
 
+    def batch(self, points):
+        """Applies an independent translation to each (n, 3) set of points in a (b, n, 3) batch"""
+        d = self._sample(size=(points.shape[0], 3))
+        mask = points[..., 2] == 0
+        points = points + d[:, None]
+        points[mask] = 0
+        return points
+
 
 class RandomRotation(Random3DAugmentation):
     """Applies a fixed 3D rotation to all input keypoints wrt states centroid"""
@@ -386,6 +457,133 @@ class RandomRotation(Random3DAugmentation):
         actions = _rotate(actions)
         return states, actions
 
+    def rotation_matrices(self, batch_size, device):
+        """Samples (b, 3, 3) rotation matrices, matching `Rotation.from_euler("xyz", d, degrees=True)`"""
+        x, y, z = torch.deg2rad(self._sample_torch(batch_size, device)).unbind(-1)
+        cx, cy, cz = torch.cos(x), torch.cos(y), torch.cos(z)
+        sx, sy, sz = torch.sin(x), torch.sin(y), torch.sin(z)
+        # extrinsic xyz rotation, i.e. Rz @ Ry @ Rx
+        return torch.stack(
+            [
+                torch.stack(
+                    [cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx], -1
+                ),
+                torch.stack(
+                    [sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx], -1
+                ),
+                torch.stack([-sy, cy * sx, cy * cx], -1),
+            ],
+            dim=-2,
+        )
+
+    def batch(self, points):
+        """Applies an independent rotation to each (n, 3) set of points in a (b, n, 3) batch"""
+        d = self._sample(size=(points.shape[0], 3))
+        r = Rotation.from_euler("xyz", d, degrees=True).as_matrix()  # (b, 3, 3)
+        mask = points[..., 2] == 0
+        points = points @ r.transpose(0, 2, 1)
+        points[mask] = 0
+        return points
+
+
+class Random3DBatchAugmentation:
+    """
+    Applies the random rotation, translation and point noise of `BCDataset` to collated batches on
+    the training device, so the DataLoader workers only have to index the data.
+    """
+
+    def __init__(
+        self,
+        rotation: RandomRotation = None,
+        translation: RandomTranslation = None,
+        point_aug_prob: float = 0.0,
+        num_points: int = None,
+        relative_actions: bool = False,
+    ):
+        """
+        Parameters:
+        -----------
+        relative_actions : bool
+            Whether the actions of a batch are deltas, which only the history mode of `BCDataset`
+            produces. Deltas are rotated but not translated.
+        """
+        self.rotation = rotation
+        self.translation = translation
+        self.point_aug_prob = point_aug_prob
+        self.num_points = num_points
+        self.relative_actions = relative_actions
+
+    @staticmethod
+    def _transform(points, r=None, t=None, keep_zeros=True):
+        # points: (b, ..., 3), with `keep_zeros` zero'd out points stay zero'd out
+        shape = points.shape
+        points = points.reshape(shape[0], -1, 3)
+        mask = points[..., 2] == 0 if keep_zeros else None
+        if r is not None:
+            points = torch.einsum("bij,bnj->bni", r.to(points.dtype), points)
+        if t is not None:
+            points = points + t.to(points.dtype)[:, None]
+        if mask is not None:
+            points = points.masked_fill(mask[..., None], 0)
+        return points.reshape(shape)
+
+    def __call__(self, batch):
+        """
+        Parameters:
+        -----------
+        batch : dict
+            Batch with "past_tracks" of shape (b, history_len, num_points(+2), 3), where the optional last
+            two points are the proprio position and the repeated gripper state, and "actions" whose last
+            dim is (x, y, z, gripper).
+
+        Returns:
+        --------
+        batch : dict
+            The augmented batch.
+        """
+        past_tracks, actions = batch["past_tracks"], batch["actions"]
+        batch_size, device = past_tracks.shape[0], past_tracks.device
+
+        r = t = None
+        if self.rotation is not None:
+            r = self.rotation.rotation_matrices(batch_size, device)
+        if self.translation is not None:
+            t = self.translation._sample_torch(batch_size, device)
+
+        # object points and proprio position share the transformation, the gripper state does not
+        num_points = self.num_points
+        num_positions = min(num_points + 1, past_tracks.shape[2])
+        positions = self._transform(past_tracks[:, :, :num_positions], r, t)
+
+        # add noise to some object points randomly, shared over the history
+        selection_mask = (
+            torch.rand(batch_size, 1, num_points, 1, device=device)
+            < self.point_aug_prob
+        )
+        noise = torch.randn(batch_size, 1, num_points, 3, device=device) * 0.01
+        objects = positions[:, :, :num_points] + noise * selection_mask
+        past_tracks = torch.cat(
+            [objects, positions[:, :, num_points:], past_tracks[:, :, num_positions:]],
+            dim=2,
+        )
+
+        # relative actions are invariant to the translation, and a delta with dz == 0 is not a
+        # zero'd out point (padded deltas are zero and stay zero under the rotation)
+        if self.relative_actions:
+            actions = torch.cat(
+                [
+                    self._transform(actions[..., :3], r, keep_zeros=False),
+                    actions[..., 3:],
+                ],
+                dim=-1,
+            )
+        else:
+            actions = torch.cat(
+                [self._transform(actions[..., :3], r, t), actions[..., 3:]], dim=-1
+            )
+
+        return {**batch, "past_tracks": past_tracks, "actions": actions}
+
 
 def get_relative_action(actions, action_after_steps):
     """
@@ -415,6 +613,243 @@ def get_relative_action(actions, action_after_steps):
     return relative_actions.astype(np.float32)
 
 
+def _hash_sources(preprocessed_data_dirs: List[str]):
+    """Hash the path, size and modification time of every file read by `compile_demonstrations`"""
+    sha = hashlib.sha1()
+    for preprocessed_data_dir in preprocessed_data_dirs:
+        preprocessed_data_dir = os.path.abspath(
+            os.path.expanduser(preprocessed_data_dir)
+        )
+        for demonstration_dir in sorted(
+            glob.glob(os.path.join(preprocessed_data_dir, "demonstration_*"))
+        ):
+            for name in SOURCE_FILES:
+                path = os.path.join(demonstration_dir, name)
+                if not os.path.exists(path):
+                    continue
+                stat = os.stat(path)
+                sha.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+def compile_demonstrations(
+    preprocessed_data_dirs: List[str],
+    history: bool,
+    num_queries: int,
+    min_demo_length: int,
+):
+    """
+    Load and process all demonstrations in the preprocessed data directories.
+
+    Returns:
+        compiled (dict): Arrays describing the dataset
+            - states: (N, num_points, 3) object points
+            - actions: (sum of T_i, 4) actions of all demonstrations, concatenated
+            - action_offsets: (N + 1,) start of each demonstration in `actions`
+            - anchors: (N, 2) first and last grasp index of each demonstration
+            - outlier_demos: (N,) whether each demonstration is an outlier
+            - dirs: (N,) demonstration directories
+    """
+    # for open loop, we want the dataset to be in pairs of (image, trajectory)
+    states, actions, anchors, grasp2dists, grasp2depths, dirs = (
+        [],
+        [],
+        [],
+        [],
+        [],
+        [],
+    )
+    for preprocessed_data_dir in preprocessed_data_dirs:
+        preprocessed_data_dir = os.path.abspath(
+            os.path.expanduser(preprocessed_data_dir)
+        )
+        demonstration_dirs = sorted(
+            glob.glob(os.path.join(preprocessed_data_dir, "demonstration_*"))
+        )
+        demonstration_dirs = demonstration_dirs[:-1]
+        for demonstration_dir in demonstration_dirs:
+            if demonstration_dir.endswith("_00000"):
+                continue
+
+            # load rgb image
+            # image = Image.open(os.path.join(demonstration_dir, "first_frame.png"))
+
+            # load the object points in first frame
+            triangulation_json = os.path.join(demonstration_dir, "triangulation.json")
+            if not os.path.exists(triangulation_json):
+                continue
+            with open(triangulation_json, "r") as f:
+                state = np.array(json.load(f)["t*"])
+
+            # load eeff trajectory in first frame
+            t_eeff_to_w = load_eeff_in_first_frame(demonstration_dir)
+            grasp = np.load(os.path.join(demonstration_dir, "grasp.npy")).astype(bool)
+
+            # remove spurious grasps (this can hurt gripper loss -> overall convergence)
+            grasp = keep_longest_true_segment(grasp)
+            t_eeff_to_w, grasp = break_long_segments(
+                t_eeff_to_w, grasp, max_eps=MAX_SEGMENT_EPS
+            )
+            # resample so that the trajectory is uniform in space
+            first_grasp_idx = np.nonzero(grasp.astype(int))[0][0].item()
+            last_grasp_idx = np.nonzero(grasp.astype(int))[0][-1].item()
+            t_eeff_to_w, grasp = remove_stationary_points(
+                t_eeff_to_w,
+                grasp,
+                min_eps=MIN_SEGMENT_EPS,
+            )
+            first_grasp_idx = np.nonzero(grasp.astype(int))[0][0].item()
+            last_grasp_idx = np.nonzero(grasp.astype(int))[0][-1].item()
+
+            # filter out bad examples
+            dists = np.linalg.norm(t_eeff_to_w[first_grasp_idx, None] - state, axis=-1)
+
+            # process action sequences for open/closed loop
+            action = np.concatenate(
+                [t_eeff_to_w, 2 * grasp.reshape(-1, 1) - 1], axis=-1
+            )
+
+            # Compute distance of all frames *before* the first grasp frame to the first grasp position
+            first_grasp_pos = t_eeff_to_w[first_grasp_idx]
+            pre_positions = t_eeff_to_w[:first_grasp_idx]
+            pre_grasp_dists = np.linalg.norm(pre_positions - first_grasp_pos, axis=1)
+            candidates = np.where(pre_grasp_dists >= 0.30)[0]
+
+            if len(candidates) > 0:
+                start = candidates[-1]  # last frame satisfying the condition
+            else:
+                start = max(
+                    0, first_grasp_idx - 15
+                )  # fallback: 15 frames if no such point found
+
+            n_post = min(15, len(action) - last_grasp_idx)
+            end = last_grasp_idx + n_post
+
+            if history:
+                action = action[start:end]
+                anchor = [first_grasp_idx - start, last_grasp_idx - start]
+            else:
+                total = end - start
+                stride = total // num_queries
+                indices = np.linspace(start, end - 1, num=num_queries, dtype=int)
+                action = action[indices]
+                anchor = [
+                    int(np.ceil((first_grasp_idx - start) / stride)),
+                    int(np.ceil((last_grasp_idx - start) / stride)),
+                ]
+
+            # throw out demonstrations that are too short
+            if history and len(action) < min_demo_length:
+                continue
+
+            states.append(state)
+            actions.append(action)
+            anchors.append(anchor)
+            grasp2dists.append(dists)
+            grasp2depths.append(
+                abs(t_eeff_to_w[first_grasp_idx, None, 2] - state[:, 2])
+            )
+            dirs.append(demonstration_dir)
+
+    grasp2depths = np.array(grasp2depths)
+    grasp2dists = np.array(grasp2dists)  # shape (num_examples, num_points)
+    medians = np.median(grasp2dists, axis=0)
+    mads = median_abs_deviation(grasp2dists, axis=0, scale="normal")
+    thresholds = medians + 1 * mads  # shape (num_points,)
+    outlier_mask = grasp2dists > thresholds  # shape (num_examples, num_points)
+    num_outliers_per_demo = outlier_mask.sum(axis=1)
+    outlier_demos = num_outliers_per_demo >= 2
+    print(f"median distance to grasp per point: {medians}")
+
+    for i in range(len(actions)):
+        if outlier_demos[i]:
+            print(f"skipping {dirs[i]}")
+            continue
+
+        if i % 10 > 0:
+            continue
+
+        plot_consecutive_distances_with_bools(
+            actions[i],
+            f"{i}_{os.path.basename(dirs[i])}.png",
+            anchors=anchors[i],
+            reference_points=states[i],
+        )
+
+    plot_scalar_boxplots(
+        grasp2dists[~outlier_demos].T,
+        grasp2depths[~outlier_demos].T,
+        "triangulate_depth.png",
+        labels=[
+            "L2 distance",
+            "Depth distance",
+        ],
+    )
+
+    return {
+        "states": np.stack(states),
+        "actions": np.concatenate(actions),
+        "action_offsets": np.cumsum([0] + [len(action) for action in actions]),
+        "anchors": np.array(anchors),
+        "outlier_demos": outlier_demos,
+        "dirs": np.array(dirs),
+    }
+
+
+def load_or_compile_demonstrations(
+    preprocessed_data_dirs: List[str],
+    history: bool,
+    num_queries: int,
+    min_demo_length: int,
+    cache_dir: str = None,
+):
+    """
+    Load the compiled demonstrations from `cache_dir`, compiling and caching them if the
+    source files or processing parameters changed since the cache was written.
+    """
+    if cache_dir is None:
+        return compile_demonstrations(
+            preprocessed_data_dirs, history, num_queries, min_demo_length
+        )
+
+    params = {
+        "version": CACHE_VERSION,
+        "dirs": [
+            os.path.abspath(os.path.expanduser(d)) for d in preprocessed_data_dirs
+        ],
+        "history": bool(history),
+        "num_queries": num_queries,
+        "min_demo_length": min_demo_length,
+        "max_segment_eps": MAX_SEGMENT_EPS,
+        "min_segment_eps": MIN_SEGMENT_EPS,
+    }
+    key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    sources = _hash_sources(preprocessed_data_dirs)
+
+    cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+    cache_path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if cache["sources"].item() == sources:
+                print(f"loaded compiled demonstrations from {cache_path}")
+                return {k: cache[k] for k in cache.files}
+
+    compiled = compile_demonstrations(
+        preprocessed_data_dirs, history, num_queries, min_demo_length
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        params=np.array(json.dumps(params, sort_keys=True)),
+        sources=np.array(sources),
+        **compiled,
+    )
+    os.replace(tmp_path, cache_path)
+    print(f"saved compiled demonstrations to {cache_path}")
+    return compiled
+
+
 class BCDataset(IterableDataset):
     def __init__(
         self,
@@ -441,6 +876,9 @@ class BCDataset(IterableDataset):
         random_rotation_upper: Union[float, List[float]] = [30, 30, 30],
         point_aug_prob: float = 0.1,
         history_aug_prob: float = 0.2,
+        cache_dir: str = "~/.cache/egozero/aria",  # None to always recompile
+        sample_batch_size: int = None,  # if set, yield whole batches instead of examples
+        augment_on_device: bool = False,  # if set, augment collated batches with `batch_augmentation`
         **kwargs,
     ):
         super().__init__()
@@ -454,6 +892,7 @@ class BCDataset(IterableDataset):
         self._subsample = subsample
         self._point_aug_prob = point_aug_prob
         self._history_aug_prob = history_aug_prob
+        self.sample_batch_size = sample_batch_size
         assert action_type in ["absolute", "delta"]
 
         if isinstance(path, str):
@@ -467,141 +906,17 @@ class BCDataset(IterableDataset):
         )
         min_demo_length = num_actions * subsample + 1
 
-        # for open loop, we want the dataset to be in pairs of (image, trajectory)
-        states, actions, anchors, grasp2dists, grasp2depths, dirs = (
-            [],
-            [],
-            [],
-            [],
-            [],
-            [],
+        compiled = load_or_compile_demonstrations(
+            preprocessed_data_dirs,
+            history=history,
+            num_queries=num_queries,
+            min_demo_length=min_demo_length,
+            cache_dir=cache_dir,
         )
-        for i, preprocessed_data_dir in enumerate(preprocessed_data_dirs):
-            preprocessed_data_dir = os.path.abspath(
-                os.path.expanduser(preprocessed_data_dir)
-            )
-            demonstration_dirs = sorted(
-                glob.glob(os.path.join(preprocessed_data_dir, "demonstration_*"))
-            )
-            demonstration_dirs = demonstration_dirs[:-1]
-            for demonstration_dir in demonstration_dirs:
-                if demonstration_dir.endswith("_00000"):
-                    continue
+        outlier_demos = compiled["outlier_demos"]
+        actions = np.split(compiled["actions"], compiled["action_offsets"][1:-1])
 
-                # load rgb image
-                # image = Image.open(os.path.join(demonstration_dir, "first_frame.png"))
-
-                # load the object points in first frame
-                triangulation_json = os.path.join(
-                    demonstration_dir, "triangulation.json"
-                )
-                if not os.path.exists(triangulation_json):
-                    continue
-                with open(triangulation_json, "r") as f:
-                    state = np.array(json.load(f)["t*"])
-
-                # load eeff trajectory in first frame
-                t_eeff_to_w = load_eeff_in_first_frame(demonstration_dir)
-                grasp = np.load(os.path.join(demonstration_dir, "grasp.npy")).astype(
-                    bool
-                )
-
-                # remove spurious grasps (this can hurt gripper loss -> overall convergence)
-                grasp = keep_longest_true_segment(grasp)
-                t_eeff_to_w, grasp = break_long_segments(
-                    t_eeff_to_w, grasp, max_eps=0.04
-                )
-                # resample so that the trajectory is uniform in space
-                first_grasp_idx = np.nonzero(grasp.astype(int))[0][0].item()
-                last_grasp_idx = np.nonzero(grasp.astype(int))[0][-1].item()
-                t_eeff_to_w, grasp = remove_stationary_points(
-                    t_eeff_to_w,
-                    grasp,
-                    min_eps=0.01,
-                )
-                first_grasp_idx = np.nonzero(grasp.astype(int))[0][0].item()
-                last_grasp_idx = np.nonzero(grasp.astype(int))[0][-1].item()
-
-                # filter out bad examples
-                dists = np.linalg.norm(
-                    t_eeff_to_w[first_grasp_idx, None] - state, axis=-1
-                )
-
-                # process action sequences for open/closed loop
-                action = np.concatenate(
-                    [t_eeff_to_w, 2 * grasp.reshape(-1, 1) - 1], axis=-1
-                )
-
-                # Compute distance of all frames *before* the first grasp frame to the first grasp position
-                first_grasp_pos = t_eeff_to_w[first_grasp_idx]
-                pre_positions = t_eeff_to_w[:first_grasp_idx]
-                pre_grasp_dists = np.linalg.norm(
-                    pre_positions - first_grasp_pos, axis=1
-                )
-                candidates = np.where(pre_grasp_dists >= 0.30)[0]
-
-                if len(candidates) > 0:
-                    start = candidates[-1]  # last frame satisfying the condition
-                else:
-                    start = max(
-                        0, first_grasp_idx - 15
-                    )  # fallback: 15 frames if no such point found
-
-                n_post = min(15, len(action) - last_grasp_idx)
-                end = last_grasp_idx + n_post
-
-                if history:
-                    action = action[start:end]
-                    anchor = [first_grasp_idx - start, last_grasp_idx - start]
-                else:
-                    total = end - start
-                    stride = total // num_queries
-                    indices = np.linspace(start, end - 1, num=num_queries, dtype=int)
-                    action = action[indices]
-                    anchor = [
-                        int(np.ceil((first_grasp_idx - start) / stride)),
-                        int(np.ceil((last_grasp_idx - start) / stride)),
-                    ]
-
-                # throw out demonstrations that are too short
-                if history and len(action) < min_demo_length:
-                    continue
-
-                states.append(state)
-                actions.append(action)
-                anchors.append(anchor)
-                grasp2dists.append(dists)
-                grasp2depths.append(
-                    abs(t_eeff_to_w[first_grasp_idx, None, 2] - state[:, 2])
-                )
-                dirs.append(demonstration_dir)
-
-        grasp2depths = np.array(grasp2depths)
-        grasp2dists = np.array(grasp2dists)  # shape (num_examples, num_points)
-        medians = np.median(grasp2dists, axis=0)
-        mads = median_abs_deviation(grasp2dists, axis=0, scale="normal")
-        thresholds = medians + 1 * mads  # shape (num_points,)
-        outlier_mask = grasp2dists > thresholds  # shape (num_examples, num_points)
-        num_outliers_per_demo = outlier_mask.sum(axis=1)
-        outlier_demos = num_outliers_per_demo >= 2
-        print(f"median distance to grasp per point: {medians}")
-
-        for i in range(len(actions)):
-            if outlier_demos[i]:
-                print(f"skipping {dirs[i]}")
-                continue
-
-            if i % 10 > 0:
-                continue
-
-            plot_consecutive_distances_with_bools(
-                actions[i],
-                f"{i}_{os.path.basename(dirs[i])}.png",
-                anchors=anchors[i],
-                reference_points=states[i],
-            )
-
-        self.states = np.stack(states)[~outlier_demos]
+        self.states = compiled["states"][~outlier_demos]
         self.actions = [
             action
             for action, is_outlier in zip(actions, outlier_demos)
@@ -613,15 +928,16 @@ class BCDataset(IterableDataset):
         self.states = self.states[:num_demos_per_task]
         self.actions = self.actions[:num_demos_per_task]
 
-        plot_scalar_boxplots(
-            grasp2dists[~outlier_demos].T,
-            grasp2depths[~outlier_demos].T,
-            "triangulate_depth.png",
-            labels=[
-                "L2 distance",
-                "Depth distance",
-            ],
+        # ragged actions packed into one array for batched sampling
+        self._packed_actions = np.concatenate(self.actions)
+        self._action_lengths = np.array([len(action) for action in self.actions])
+        self._action_offsets = np.cumsum(self._action_lengths) - self._action_lengths
+
+        # keep the arrays in shared memory so forked workers don't duplicate them
+        (self.states, self._packed_actions), self._arena = share_arrays(
+            (self.states, self._packed_actions)
         )
+        self.actions = np.split(self._packed_actions, self._action_offsets[1:])
 
         self.stats = {
             "past_tracks": {
@@ -642,27 +958,48 @@ class BCDataset(IterableDataset):
         self._max_state_dim = self.states.shape[-2] * self.states.shape[-1]
         self.envs_till_idx = len(self.actions)
 
+        # seeded, resumable sample stream, each sample is a whole batch with sample_batch_size
+        epoch_size = len(self)
+        if self.sample_batch_size is not None:
+            epoch_size = -(-epoch_size // self.sample_batch_size)
+        self.sampler = ResumableSampler(epoch_size)
+
         # random 3d transformations
-        self.random_transforms = []
+        random_rotation = random_translation = None
         if random_rotation_std is not None:
-            self.random_transforms.append(
-                RandomRotation(
-                    random_rotation_std,
-                    random_rotation_mean,
-                    random_rotation_lower,
-                    random_rotation_upper,
-                )
+            random_rotation = RandomRotation(
+                random_rotation_std,
+                random_rotation_mean,
+                random_rotation_lower,
+                random_rotation_upper,
             )
         if random_translation_std is not None:
-            self.random_transforms.append(
-                RandomTranslation(
-                    random_translation_std,
-                    random_translation_mean,
-                    random_translation_lower,
-                    random_translation_upper,
-                )
+            random_translation = RandomTranslation(
+                random_translation_std,
+                random_translation_mean,
+                random_translation_lower,
+                random_translation_upper,
             )
-        self.random_transforms = transforms.Compose(self.random_transforms)
+
+        # augmentations are either applied in the workers, or to collated batches on the
+        # training device by `batch_augmentation`
+        self.batch_augmentation = None
+        if augment_on_device:
+            self.batch_augmentation = Random3DBatchAugmentation(
+                random_rotation,
+                random_translation,
+                point_aug_prob=point_aug_prob,
+                num_points=self.states.shape[1],
+                # without history the sampled actions stay absolute
+                relative_actions=history and action_type == "delta",
+            )
+            random_rotation = random_translation = None
+            self._point_aug_prob = 0.0
+
+        self.batch_transforms = [
+            t for t in [random_rotation, random_translation] if t is not None
+        ]
+        self.random_transforms = transforms.Compose(self.batch_transforms)
 
     def _sample(self):
         idx = random.sample(range(len(self)), k=1)[0]
@@ -754,9 +1091,132 @@ class BCDataset(IterableDataset):
             "actions": torch.tensor(action),
         }
 
+    def _sample_batch(self, batch_size):
+        """
+        Vectorized version of `_sample` that draws a whole batch at once. Action chunks are gathered
+        from the packed actions with precomputed indices and each example gets its own random rigid
+        3d transformation and point noise, as in `_sample`.
+        """
+        idx = np.random.randint(0, len(self), size=batch_size)
+        states = self.states[idx]  # (b, num_points, 3)
+        lengths = self._action_lengths[idx]
+        offsets = self._action_offsets[idx]
+
+        # subsample actions: actions[s::subsample] has ceil((length - s) / subsample) entries
+        if self._history:
+            subsample_idx = np.random.randint(0, self._subsample, size=batch_size)
+        else:
+            # without history each example is the whole (subsampled) demo, so the offset is shared
+            # to keep the chunks the same length
+            subsample_idx = np.full(batch_size, np.random.randint(0, self._subsample))
+        num_subsampled = -(-(lengths - subsample_idx) // self._subsample)
+
+        def _gather(positions):
+            # map (b, k) positions in the subsampled sequence (with history_len-1 copies of the
+            # first action prepended) to rows of the packed actions
+            positions = np.clip(positions, 0, num_subsampled[:, None] - 1)
+            return self._packed_actions[
+                offsets[:, None] + subsample_idx[:, None] + self._subsample * positions
+            ]
+
+        if self._history:
+            num_padded = num_subsampled + self._history_len - 1
+            sample_idx = (
+                np.random.rand(batch_size) * (num_padded - self._history_len)
+            ).astype(int)
+            history_positions = (
+                sample_idx[:, None]
+                + np.arange(self._history_len)
+                - (self._history_len - 1)
+            )
+            if self._temporal_agg:
+                num_actions = self._history_len + self._num_queries - 1
+                action_positions = sample_idx[:, None] + np.arange(num_actions)
+            else:
+                action_positions = sample_idx[:, None] + np.arange(
+                    1, self._history_len + 1
+                )
+            # padded positions past the end of the demo, which are filled with the last action
+            # (absolute) or zeros (delta)
+            beyond = action_positions >= num_padded[:, None]
+            action_positions = action_positions - (self._history_len - 1)
+            proprio = _gather(history_positions)
+            num_proprio = proprio.shape[1]
+            if self._action_type == "delta":
+                current = _gather(action_positions)
+                actions = _gather(action_positions + 1)
+                points = np.concatenate(
+                    [states, proprio[..., :3], current[..., :3], actions[..., :3]],
+                    axis=1,
+                )
+            else:
+                actions = _gather(action_positions)
+                points = np.concatenate(
+                    [states, proprio[..., :3], actions[..., :3]], axis=1
+                )
+        else:
+            actions = _gather(np.arange(num_subsampled.max())[None])
+            points = np.concatenate([states, actions[..., :3]], axis=1)
+
+        # random rigid 3d transformations, shared by the states and actions of each example
+        for transform in self.batch_transforms:
+            points = transform.batch(points)
+        num_points = states.shape[1]
+        states = points[:, :num_points]
+        if self._history:
+            proprio = np.concatenate(
+                [points[:, num_points : num_points + num_proprio], proprio[..., 3:]],
+                axis=-1,
+            )
+            points = points[:, num_points + num_proprio :]
+            if self._action_type == "delta":
+                num_actions = actions.shape[1]
+                current, points = points[:, :num_actions], points[:, num_actions:]
+                actions = np.concatenate([points - current, actions[..., 3:]], axis=-1)
+                actions[beyond] = 0
+            else:
+                actions = np.concatenate([points, actions[..., 3:]], axis=-1)
+
+            # prepare action chunking + temporal aggregation
+            if self._temporal_agg:
+                # (b, history_len, num_queries, action_dim)
+                actions = np.lib.stride_tricks.sliding_window_view(
+                    actions, self._num_queries, axis=1
+                ).transpose(0, 1, 3, 2)
+        else:
+            actions = np.concatenate(
+                [points[:, num_points:], actions[..., 3:]], axis=-1
+            )
+            actions = actions[:, None]
+
+        # add noise to some points randomly
+        selection_mask = np.random.rand(*states.shape[:2]) < self._point_aug_prob
+        states = (
+            states + np.random.randn(*states.shape) * 0.01 * selection_mask[..., None]
+        )
+
+        states = np.repeat(
+            states[:, None], self._history_len, axis=1
+        )  # (b, history_len, num_points, dim_points)
+
+        if self._history:
+            gripper = np.repeat(proprio[:, :, None, -1:], 3, axis=-1)
+            states = np.concatenate(
+                [states, proprio[:, :, None, :3], gripper], axis=2
+            )  # (b, history_len, num_points+2, dim_points)
+
+        return {
+            "past_tracks": torch.from_numpy(states.astype(np.float32)),
+            "actions": torch.from_numpy(actions.astype(np.float32)),
+        }
+
     def __iter__(self):
-        while True:
-            yield self._sample()
+        if self.sample_batch_size is not None:
+            yield from self.sampler.samples(
+                lambda: self._sample_batch(self.sample_batch_size)
+            )
+        else:
+            yield from self.sampler.samples(self._sample)
 
     def __len__(self):
         return len(self.states)
@@ -1,12 +1,16 @@
-import pickle as pkl
 from pathlib import Path
 
 import numpy as np
 import torch
 import torchvision.transforms as transforms
+from read_data.episode_store import load_episodes
+from read_data.sampler import ResumableSampler
+from read_data.shared_arena import share_arrays
+from read_data.statistics import load_or_compute_statistics
 from scipy.spatial.transform import Rotation as R
 from torch.utils.data import IterableDataset
 
+import utils
 from robot_utils.franka.utils import matrix_to_rotation_6d
 
 
@@ -65,6 +69,77 @@ def get_quaternion_orientation(cartesian):
     return np.array(new_cartesian, dtype=np.float32)
 
 
+class BatchImageAugmentation:
+    """
+    Applies the random shift, color jitter and scaling of `BCDataset.aug` to collated batches of
+    uint8 frames on the training device, so the DataLoader workers only have to gather raw frames.
+    """
+
+    def __init__(
+        self,
+        pixel_keys,
+        pad=4,
+        brightness=0.3,
+        contrast=0.3,
+        saturation=0.2,
+        depth_stats=None,
+    ):
+        self.pixel_keys = pixel_keys
+        self.shift = utils.RandomShiftsAug(pad)
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.depth_stats = depth_stats
+
+    @staticmethod
+    def _factor(strength, n, device):
+        # uniform in [1 - strength, 1 + strength], one factor per image
+        return 1 + strength * (2 * torch.rand(n, 1, 1, 1, device=device) - 1)
+
+    @staticmethod
+    def _grayscale(x):
+        r, g, b = x.unbind(dim=1)
+        return (0.299 * r + 0.587 * g + 0.114 * b)[:, None]
+
+    def _color_jitter(self, x):
+        n, device = x.shape[0], x.device
+        x = (x * self._factor(self.brightness, n, device)).clamp(0, 1)
+        mean = self._grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+        x = (mean + (x - mean) * self._factor(self.contrast, n, device)).clamp(0, 1)
+        gray = self._grayscale(x)
+        x = (gray + (x - gray) * self._factor(self.saturation, n, device)).clamp(0, 1)
+        return x
+
+    def __call__(self, batch):
+        """
+        Parameters:
+        -----------
+        batch : dict
+            Batch with uint8 frames of shape (b, history_len, h, w, c) for each pixel key and, if
+            depth statistics are given, raw depth frames of shape (b, history_len, h, w).
+
+        Returns:
+        --------
+        batch : dict
+            The batch with float frames of shape (b, history_len, c, h, w) in [0, 1] and depth frames
+            of shape (b, history_len, 1, h, w) scaled with the depth statistics.
+        """
+        for key in self.pixel_keys:
+            frames = batch[key]
+            b, t = frames.shape[:2]
+            frames = frames.flatten(0, 1).permute(0, 3, 1, 2).float() / 255.0
+            frames = self._color_jitter(self.shift(frames))
+            batch[key] = frames.unflatten(0, (b, t))
+
+            if self.depth_stats is not None:
+                depth = batch[f"depth_{key}"].float()
+                batch[f"depth_{key}"] = (
+                    (depth - self.depth_stats["min"])
+                    / (self.depth_stats["max"] - self.depth_stats["min"] + 1e-5)
+                )[:, :, None]
+        return batch
+
+
 class BCDataset(IterableDataset):
     def __init__(
         self,
@@ -82,6 +157,7 @@ class BCDataset(IterableDataset):
         skip_first_n,
         action_type,
         gt_depth,
+        augment_on_device=False,
     ):
         tasks = [tasks]  # NOTE: single task for now
 
@@ -92,6 +168,7 @@ class BCDataset(IterableDataset):
         self._pixel_keys = pixel_keys
         self._action_type = action_type
         self._gt_depth = gt_depth
+        self._augment_on_device = augment_on_device
 
         # temporal aggregation
         self._temporal_agg = temporal_agg
@@ -125,9 +202,31 @@ class BCDataset(IterableDataset):
         for _path_idx in self._paths:
             print(f"Loading {str(self._paths[_path_idx])}")
             # read
-            data = pkl.load(open(str(self._paths[_path_idx]), "rb"))
+            data = load_episodes(self._paths[_path_idx])
             observations = data["observations"]
 
+            # depth range from the min and max depth of each episode,
+            # computed once and cached next to the data
+            if self._gt_depth:
+                depth_keys = [f"depth_{key}" for key in self._pixel_keys]
+                statistics = load_or_compute_statistics(
+                    self._paths[_path_idx],
+                    observations[:num_demos_per_task],
+                    depth_keys,
+                    feature_ndim=0,
+                    skip_first_n=skip_first_n,
+                    subsample=subsample,
+                )
+                for key in depth_keys:
+                    mean = statistics[key]["episode_min"]
+                    std = statistics[key]["episode_max"]
+                    if min_depth is None:
+                        min_depth = np.nanmin(mean - 3 * std)
+                        max_depth = np.nanmax(mean + 3 * std)
+                    else:
+                        min_depth = np.minimum(min_depth, np.nanmin(mean - 3 * std))
+                        max_depth = np.maximum(max_depth, np.nanmax(mean + 3 * std))
+
             # store
             self._episodes[_path_idx] = []
             for i in range(min(num_demos_per_task, len(observations))):
@@ -175,7 +274,10 @@ class BCDataset(IterableDataset):
                     observations[i]["cartesian_states"]
                 )
                 # Repeat last dimension of each observation for history_len times
+                # (memory-mapped frames are not copied, they are clamped to the last frame when sampled)
                 for key in observations[i].keys():
+                    if isinstance(observations[i][key], np.memmap):
+                        continue
                     observations[i][key] = np.concatenate(
                         [
                             observations[i][key],
@@ -210,10 +312,10 @@ class BCDataset(IterableDataset):
                     (
                         len(observations[i])
                         if not isinstance(observations[i], dict)
-                        else len(observations[i][self._pixel_keys[0]])
+                        else len(observations[i]["gripper_states"])
                     ),
                 )
-                self._num_samples += len(observations[i][self._pixel_keys[0]])
+                self._num_samples += len(observations[i]["gripper_states"])
 
                 # max, min action
                 if min_act is None:
@@ -223,17 +325,6 @@ class BCDataset(IterableDataset):
                     min_act = np.minimum(min_act, np.min(actions, axis=0))
                     max_act = np.maximum(max_act, np.max(actions, axis=0))
 
-                if self._gt_depth:
-                    for key in self._pixel_keys:
-                        mean = np.min(observations[i][f"depth_{key}"])
-                        std = np.max(observations[i][f"depth_{key}"])
-                        if min_depth is None:
-                            min_depth = mean - 3 * std
-                            max_depth = mean + 3 * std
-                        else:
-                            min_depth = np.minimum(min_depth, mean - 3 * std)
-                            max_depth = np.maximum(max_depth, mean + 3 * std)
-
             # keep record of max and min stat
             max_cartesian = data["max_cartesian"]
             min_cartesian = data["min_cartesian"]
@@ -290,9 +381,23 @@ class BCDataset(IterableDataset):
             ]
         )
 
+        # uint8 frames are augmented and scaled on the training device by `batch_augmentation`
+        self.batch_augmentation = None
+        if self._augment_on_device:
+            self.batch_augmentation = BatchImageAugmentation(
+                self._pixel_keys,
+                depth_stats=self.stats["depth"] if self._gt_depth else None,
+            )
+
+        # keep the episodes in shared memory so forked workers don't duplicate them
+        self._episodes, self._arena = share_arrays(self._episodes)
+
         # Samples from envs
         self.envs_till_idx = len(self._episodes)
 
+        # seeded, resumable sample stream
+        self.sampler = ResumableSampler(len(self))
+
     def _sample_episode(self, env_idx=None):
         idx = (
             np.random.choice(list(self._episodes.keys()))
@@ -309,15 +414,22 @@ class BCDataset(IterableDataset):
 
         # Sample obs, action
         sample_idx = np.random.randint(
-            0, len(observations[self._pixel_keys[0]]) - self._history_len
+            0, len(observations["gripper_states"]) - self._history_len
         )
         sampled_pixel = {}
         if self._gt_depth:
             sampled_depth = {}
         for key in self._pixel_keys:
-            sampled_pixel[key] = observations[key][
-                sample_idx : sample_idx + self._history_len
-            ]
+            frame_idx = np.minimum(
+                np.arange(sample_idx, sample_idx + self._history_len),
+                len(observations[key]) - 1,
+            )
+            sampled_pixel[key] = observations[key][frame_idx]
+            if self._gt_depth:
+                sampled_depth[key] = observations[f"depth_{key}"][frame_idx]
+            if self._augment_on_device:
+                continue
+
             sampled_pixel[key] = torch.stack(
                 [
                     self.aug(sampled_pixel[key][i])
@@ -325,9 +437,6 @@ class BCDataset(IterableDataset):
                 ]
             )
             if self._gt_depth:
-                sampled_depth[key] = observations[f"depth_{key}"][
-                    sample_idx : sample_idx + self._history_len
-                ]
                 sampled_depth[key] = torch.stack(
                     [
                         torch.tensor(self.preprocess["depth"](sampled_depth[key][i]))[
@@ -388,8 +497,7 @@ class BCDataset(IterableDataset):
         return actions
 
     def __iter__(self):
-        while True:
-            yield self._sample()
+        yield from self.sampler.samples(self._sample)
 
     def __len__(self):
         return self._num_samples
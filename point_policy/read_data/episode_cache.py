@@ -0,0 +1,78 @@
+"""Bounded LRU cache of processed episodes for lazily loaded datasets"""
+
+import multiprocessing as mp
+from collections import OrderedDict
+from collections.abc import Sequence
+
+
+class EpisodeCache:
+    """
+    Loads episodes on first access and keeps the most recently used ones. Each DataLoader worker
+    holds its own cache of up to `capacity` episodes, the hit and miss counters are shared between
+    the workers so the trainer can report the hit rate.
+    """
+
+    def __init__(self, load_fn, capacity):
+        """
+        Parameters:
+        -----------
+        load_fn : callable
+            Loads the episode for a key.
+
+        capacity : int
+            The maximum number of episodes kept per process.
+        """
+        self._load_fn = load_fn
+        self.capacity = capacity
+        self._episodes = OrderedDict()
+        self._hits = mp.Value("q", 0)
+        self._misses = mp.Value("q", 0)
+
+    def get(self, key):
+        if key in self._episodes:
+            self._episodes.move_to_end(key)
+            with self._hits.get_lock():
+                self._hits.value += 1
+            return self._episodes[key]
+
+        with self._misses.get_lock():
+            self._misses.value += 1
+        episode = self._load_fn(key)
+        self._episodes[key] = episode
+        if len(self._episodes) > self.capacity:
+            self._episodes.popitem(last=False)
+        return episode
+
+    def __len__(self):
+        return len(self._episodes)
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+class LazyEpisodes(Sequence):
+    """The episodes of one task, loaded through an `EpisodeCache` when indexed"""
+
+    def __init__(self, cache, task_idx, num_episodes):
+        self._cache = cache
+        self._task_idx = task_idx
+        self._num_episodes = num_episodes
+
+    def __len__(self):
+        return self._num_episodes
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._num_episodes
+        if not 0 <= idx < self._num_episodes:
+            raise IndexError(f"episode index {idx} out of range")
+        return self._cache.get((self._task_idx, idx))
@@ -0,0 +1,179 @@
+"""Memory-mapped episode store, an alternative to the monolithic {task}.pkl files"""
+
+import json
+import os
+import pickle as pkl
+import shutil
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+STORE_VERSION = 1
+INDEX_FILE = "index.json"
+
+
+def is_frame_key(key):
+    """Whether an observation key holds image or depth frames, e.g. pixels1 or depth_pixels1"""
+    return key.startswith("pixels") or key.startswith("depth_")
+
+
+def get_store_path(pkl_path):
+    """The episode store next to a {task}.pkl file"""
+    return Path(pkl_path).with_suffix(".store")
+
+
+def write_episode_store(path, observations, **metadata):
+    """
+    Write episodes to a directory with one .npy file per observation key, holding the arrays of all
+    episodes concatenated along the time axis, and an index with the offset of each episode.
+
+    Parameters:
+    -----------
+    path : str
+        The directory to write the store to. An existing store is replaced.
+
+    observations : list
+        The episodes, each a dict of arrays with the same keys and a leading time axis.
+
+    metadata : dict
+        Additional arrays stored in the index, e.g. max_cartesian and min_cartesian.
+    """
+    path = Path(path)
+    keys = list(observations[0].keys()) if len(observations) > 0 else []
+    for observation in observations:
+        assert set(observation.keys()) == set(keys), "All episodes need the same keys"
+
+    # write to a temporary directory first so readers never see a partial store
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    index = {"version": STORE_VERSION, "num_episodes": len(observations), "keys": {}}
+    for key in keys:
+        arrays = [np.asarray(observation[key]) for observation in observations]
+        lengths = [len(array) for array in arrays]
+        memmap = open_memmap(
+            tmp_path / f"{key}.npy",
+            mode="w+",
+            dtype=arrays[0].dtype,
+            shape=(sum(lengths),) + arrays[0].shape[1:],
+        )
+        offset = 0
+        for array in arrays:
+            memmap[offset : offset + len(array)] = array
+            offset += len(array)
+        memmap.flush()
+        del memmap
+
+        index["keys"][key] = {
+            "dtype": arrays[0].dtype.str,
+            "shape": list(arrays[0].shape[1:]),
+            "offsets": np.cumsum([0] + lengths).tolist(),
+        }
+
+    index["metadata"] = {
+        key: None if value is None else np.asarray(value).tolist()
+        for key, value in metadata.items()
+    }
+    with open(tmp_path / INDEX_FILE, "w") as f:
+        json.dump(index, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+class EpisodeStore:
+    """Reads episodes from a store written by `write_episode_store` without loading them into memory"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / INDEX_FILE, "r") as f:
+            self._index = json.load(f)
+        assert (
+            self._index["version"] == STORE_VERSION
+        ), f"Unsupported episode store version {self._index['version']}"
+        self._memmaps = {}
+
+    def __len__(self):
+        return self._index["num_episodes"]
+
+    @property
+    def keys(self):
+        return list(self._index["keys"].keys())
+
+    @property
+    def metadata(self):
+        return {
+            key: None if value is None else np.array(value)
+            for key, value in self._index["metadata"].items()
+        }
+
+    def _memmap(self, key):
+        # opened on first use, the data is only read from disk when it is indexed
+        if key not in self._memmaps:
+            self._memmaps[key] = np.load(self.path / f"{key}.npy", mmap_mode="r")
+        return self._memmaps[key]
+
+    def episode(self, idx, keys=None):
+        """
+        Returns a dict of read-only memory-mapped arrays for one episode.
+
+        Parameters:
+        -----------
+        idx : int
+            The index of the episode.
+
+        keys : list
+            The observation keys to return. If None, all keys are returned.
+        """
+        keys = self.keys if keys is None else keys
+        episode = {}
+        for key in keys:
+            offsets = self._index["keys"][key]["offsets"]
+            episode[key] = self._memmap(key)[offsets[idx] : offsets[idx + 1]]
+        return episode
+
+
+def load_episodes(pkl_path, load_frames=True, mmap=False):
+    """
+    Load the data of a {task}.pkl file, from its episode store if one exists.
+
+    Parameters:
+    -----------
+    pkl_path : str
+        The path to the {task}.pkl file.
+
+    load_frames : bool
+        Whether to return the image and depth frames. From a store, the frames are memory-mapped and
+        only read when indexed, all other keys are loaded into memory.
+
+    mmap : bool
+        Whether to keep all keys of a store memory-mapped, for datasets that load episodes lazily.
+
+    Returns:
+    --------
+    data : dict
+        The data in the format of the pickle file, with the episodes under "observations".
+    """
+    store_path = get_store_path(pkl_path)
+    if store_path.exists():
+        store = EpisodeStore(store_path)
+        observations = []
+        for idx in range(len(store)):
+            episode = store.episode(idx)
+            observations.append(
+                {
+                    key: value if mmap or is_frame_key(key) else np.array(value)
+                    for key, value in episode.items()
+                    if load_frames or not is_frame_key(key)
+                }
+            )
+        return {"observations": observations, **store.metadata}
+
+    data = pkl.load(open(str(pkl_path), "rb"))
+    if not load_frames:
+        for observation in data["observations"]:
+            for key in [key for key in observation if is_frame_key(key)]:
+                del observation[key]
+    return data
@@ -1,9 +1,11 @@
-import pickle as pkl
 import random
 from pathlib import Path
 
-import einops
 import numpy as np
+from read_data.episode_store import load_episodes
+from read_data.sampler import ResumableSampler
+from read_data.shared_arena import share_arrays
+from read_data.statistics import load_or_compute_statistics
 from scipy.spatial.transform import Rotation as R
 from torch.utils.data import IterableDataset
 
@@ -132,9 +134,35 @@ class BCDataset(IterableDataset):
         for _path_idx in self._paths:
             print(f"Loading {str(self._paths[_path_idx])}")
             # read
-            data = pkl.load(open(str(self._paths[_path_idx]), "rb"))
+            # image frames are not needed for point tracks
+            data = load_episodes(self._paths[_path_idx], load_frames=False)
             observations = data["observations"]
 
+            # min, max track, computed once and cached next to the data
+            track_keys = []
+            for pixel_key in self._pixel_keys:
+                if self._use_robot_points:
+                    track_keys.append(f"{self._robot_points_key}_{pixel_key}")
+                if self._use_object_points:
+                    track_keys.append(f"{self._object_points_key}_{pixel_key}")
+            statistics = load_or_compute_statistics(
+                self._paths[_path_idx],
+                observations[:num_demos_per_task],
+                track_keys,
+                skip_first_n=skip_first_n,
+            )
+            for track_key in track_keys:
+                min_track = (
+                    np.minimum(min_track, statistics[track_key]["min"])
+                    if min_track is not None
+                    else statistics[track_key]["min"]
+                )
+                max_track = (
+                    np.maximum(max_track, statistics[track_key]["max"])
+                    if max_track is not None
+                    else statistics[track_key]["max"]
+                )
+
             # store
             self._episodes[_path_idx] = []
             self._num_demos[_path_idx] = min(num_demos_per_task, len(observations))
@@ -215,11 +243,11 @@ class BCDataset(IterableDataset):
                     (
                         len(observations[i])
                         if not isinstance(observations[i], dict)
-                        else len(observations[i][self._pixel_keys[0]])
+                        else len(observations[i]["gripper_states"])
                     ),
                 )
                 self._max_state_dim = self._num_robot_points * self._point_dim
-                self._num_samples += len(observations[i][self._pixel_keys[0]])
+                self._num_samples += len(observations[i]["gripper_states"])
 
                 # max, min action
                 if min_act is None:
@@ -229,37 +257,6 @@ class BCDataset(IterableDataset):
                     min_act = np.minimum(min_act, np.min(actions, axis=0))
                     max_act = np.maximum(max_act, np.max(actions, axis=0))
 
-                # min, max track
-                for pixel_key in self._pixel_keys:
-                    if self._use_robot_points:
-                        track_key = f"{self._robot_points_key}_{pixel_key}"
-                        track = observations[i][track_key]
-                        track = einops.rearrange(track, "t n d -> (t n) d")
-                        min_track = (
-                            np.minimum(min_track, np.min(track, axis=0))
-                            if min_track is not None
-                            else np.min(track, axis=0)
-                        )
-                        max_track = (
-                            np.maximum(max_track, np.max(track, axis=0))
-                            if max_track is not None
-                            else np.max(track, axis=0)
-                        )
-                    if self._use_object_points:
-                        track_key = f"{self._object_points_key}_{pixel_key}"
-                        track = observations[i][track_key]
-                        track = einops.rearrange(track, "t n d -> (t n) d")
-                        min_track = (
-                            np.minimum(min_track, np.min(track, axis=0))
-                            if min_track is not None
-                            else np.min(track, axis=0)
-                        )
-                        max_track = (
-                            np.maximum(max_track, np.max(track, axis=0))
-                            if max_track is not None
-                            else np.max(track, axis=0)
-                        )
-
         self.stats = {
             "actions": {
                 "min": min_act,
@@ -282,9 +279,15 @@ class BCDataset(IterableDataset):
             ),
         }
 
+        # keep the episodes in shared memory so forked workers don't duplicate them
+        self._episodes, self._arena = share_arrays(self._episodes)
+
         # Samples from envs
         self.envs_till_idx = len(self._episodes)
 
+        # seeded, resumable sample stream
+        self.sampler = ResumableSampler(len(self))
+
     def _sample_episode(self, env_idx=None):
         if env_idx is not None:
             idx = env_idx
@@ -301,7 +304,7 @@ class BCDataset(IterableDataset):
 
         # Sample obs, action
         sample_idx = np.random.randint(
-            0, len(observations[self._pixel_keys[0]]) - self._history_len
+            0, len(observations["gripper_states"]) - self._history_len
         )
         pixel_key = np.random.choice(self._pixel_keys)
 
@@ -371,8 +374,7 @@ class BCDataset(IterableDataset):
         return episode["action"]
 
     def __iter__(self):
-        while True:
-            yield self._sample()
+        yield from self.sampler.samples(self._sample)
 
     def __len__(self):
         return self._num_samples
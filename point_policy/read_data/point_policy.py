@@ -1,9 +1,13 @@
-import pickle as pkl
 import random
 from pathlib import Path
 
 import einops
 import numpy as np
+from read_data.episode_cache import EpisodeCache, LazyEpisodes
+from read_data.episode_store import load_episodes
+from read_data.sampler import ResumableSampler
+from read_data.shared_arena import share_arrays
+from read_data.statistics import load_or_compute_statistics
 from scipy.spatial.transform import Rotation as R
 from torch.utils.data import IterableDataset
 
@@ -29,8 +33,10 @@ class BCDataset(IterableDataset):
         subsample,
         skip_first_n,
         gt_depth,
+        lazy_loading=False,
+        episode_cache_size=256,
     ):
-        tasks = [tasks]  # NOTE: single task for now
+        tasks = [tasks] if isinstance(tasks, str) else list(tasks)
 
         self._history = history
         self._history_len = history_len if history else 1
@@ -38,6 +44,7 @@ class BCDataset(IterableDataset):
         self._action_after_steps = action_after_steps
         self._pixel_keys = pixel_keys
         self._subsample = subsample
+        self._skip_first_n = skip_first_n
 
         # track points
         self._use_robot_points = use_robot_points
@@ -76,6 +83,11 @@ class BCDataset(IterableDataset):
         # read data
         self._episodes = {}
         self._num_demos = {}
+        # raw observations of lazily loaded tasks, processed when an episode is sampled
+        self._observations = {}
+        self.episode_cache = None
+        if lazy_loading:
+            self.episode_cache = EpisodeCache(self._load_episode, episode_cache_size)
         self._max_episode_len = 0
         self._max_state_dim = 0
         self._num_samples = 0
@@ -83,74 +95,64 @@ class BCDataset(IterableDataset):
         for _path_idx in self._paths:
             print(f"Loading {str(self._paths[_path_idx])}")
             # read
-            data = pkl.load(open(str(self._paths[_path_idx]), "rb"))
-            observations = data["observations"]
+            # image frames are not needed for point tracks, with lazy loading the episodes stay
+            # memory-mapped until they are sampled
+            data = load_episodes(
+                self._paths[_path_idx], load_frames=False, mmap=lazy_loading
+            )
+            self._num_demos[_path_idx] = min(
+                num_demos_per_task, len(data["observations"])
+            )
+            observations = data["observations"][: self._num_demos[_path_idx]]
 
-            # store
-            self._episodes[_path_idx] = []
-            self._num_demos[_path_idx] = min(num_demos_per_task, len(observations))
-            for i in range(min(num_demos_per_task, len(observations))):
-                # skip first n
-                if skip_first_n is not None:
-                    for key in observations[i].keys():
-                        observations[i][key] = observations[i][key][skip_first_n:]
-
-                # Repeat last dimension of each observation for history_len times
-                for key in observations[i].keys():
-                    observations[i][key] = np.concatenate(
-                        [
-                            observations[i][key],
-                            [observations[i][key][-1]] * self._history_len,
-                        ],
-                        axis=0,
-                    )
-
-                # store
-                episode = dict(
-                    observation=observations[i],
+            # min, max track, computed once and cached next to the data
+            track_keys = []
+            for pixel_key in self._pixel_keys:
+                if self._use_robot_points:
+                    track_keys.append(f"{self._robot_points_key}_{pixel_key}")
+                if self._use_object_points:
+                    track_keys.append(f"{self._object_points_key}_{pixel_key}")
+            statistics = load_or_compute_statistics(
+                self._paths[_path_idx],
+                observations,
+                track_keys,
+                skip_first_n=skip_first_n,
+            )
+            for track_key in track_keys:
+                min_track = (
+                    np.minimum(min_track, statistics[track_key]["min"])
+                    if min_track is not None
+                    else statistics[track_key]["min"]
                 )
-                self._episodes[_path_idx].append(episode)
-                self._max_episode_len = max(
-                    self._max_episode_len,
-                    (
-                        len(observations[i])
-                        if not isinstance(observations[i], dict)
-                        else len(observations[i][self._pixel_keys[0]])
-                    ),
+                max_track = (
+                    np.maximum(max_track, statistics[track_key]["max"])
+                    if max_track is not None
+                    else statistics[track_key]["max"]
                 )
-                self._max_state_dim = self._num_robot_points * self._point_dim
-                self._num_samples += len(observations[i][self._pixel_keys[0]])
-
-                # min, max track
-                for pixel_key in self._pixel_keys:
-                    if self._use_robot_points:
-                        track_key = f"{self._robot_points_key}_{pixel_key}"
-                        track = observations[i][track_key]
-                        track = einops.rearrange(track, "t n d -> (t n) d")
-                        min_track = (
-                            np.minimum(min_track, np.min(track, axis=0))
-                            if min_track is not None
-                            else np.min(track, axis=0)
-                        )
-                        max_track = (
-                            np.maximum(max_track, np.max(track, axis=0))
-                            if max_track is not None
-                            else np.max(track, axis=0)
-                        )
-                    if self._use_object_points:
-                        track_key = f"{self._object_points_key}_{pixel_key}"
-                        track = observations[i][track_key]
-                        track = einops.rearrange(track, "t n d -> (t n) d")
-                        min_track = (
-                            np.minimum(min_track, np.min(track, axis=0))
-                            if min_track is not None
-                            else np.min(track, axis=0)
-                        )
-                        max_track = (
-                            np.maximum(max_track, np.max(track, axis=0))
-                            if max_track is not None
-                            else np.max(track, axis=0)
-                        )
+
+            # store
+            if lazy_loading:
+                self._observations[_path_idx] = observations
+                self._episodes[_path_idx] = LazyEpisodes(
+                    self.episode_cache, _path_idx, len(observations)
+                )
+                # episode lengths after skipping the first n and repeating the last frame
+                episode_lens = [
+                    len(observation["gripper_states"][skip_first_n:])
+                    + self._history_len
+                    for observation in observations
+                ]
+            else:
+                self._episodes[_path_idx] = [
+                    self._process_episode(observation) for observation in observations
+                ]
+                episode_lens = [
+                    len(episode["observation"]["gripper_states"])
+                    for episode in self._episodes[_path_idx]
+                ]
+            self._max_episode_len = max([self._max_episode_len] + episode_lens)
+            self._max_state_dim = self._num_robot_points * self._point_dim
+            self._num_samples += sum(episode_lens)
 
         self.stats = {
             "past_tracks": {
@@ -192,9 +194,41 @@ class BCDataset(IterableDataset):
             ),
         }
 
+        # keep the episodes in shared memory so forked workers don't duplicate them
+        (self._episodes, self._observations), self._arena = share_arrays(
+            (self._episodes, self._observations)
+        )
+
         # Samples from envs
         self.envs_till_idx = len(self._episodes)
 
+        # seeded, resumable sample stream
+        self.sampler = ResumableSampler(len(self))
+
+    def _process_episode(self, observation):
+        observation = dict(observation)
+
+        # skip first n
+        if self._skip_first_n is not None:
+            for key in observation.keys():
+                observation[key] = observation[key][self._skip_first_n :]
+
+        # Repeat last dimension of each observation for history_len times
+        for key in observation.keys():
+            observation[key] = np.concatenate(
+                [
+                    observation[key],
+                    [observation[key][-1]] * self._history_len,
+                ],
+                axis=0,
+            )
+
+        return dict(observation=observation)
+
+    def _load_episode(self, key):
+        task_idx, episode_idx = key
+        return self._process_episode(self._observations[task_idx][episode_idx])
+
     def _sample_episode(self, env_idx=None):
         if env_idx is not None:
             idx = env_idx
@@ -207,11 +241,11 @@ class BCDataset(IterableDataset):
     def _sample(self):
         episodes, env_idx = self._sample_episode()
         observations = episodes["observation"]
-        traj_len = len(observations[self._pixel_keys[0]])
+        traj_len = len(observations["gripper_states"])
 
         # Sample obs, action
         sample_idx = np.random.randint(
-            0, len(observations[self._pixel_keys[0]]) - self._history_len
+            0, len(observations["gripper_states"]) - self._history_len
         )
         pixel_key = np.random.choice(self._pixel_keys)
 
@@ -371,8 +405,7 @@ class BCDataset(IterableDataset):
         return actions
 
     def __iter__(self):
-        while True:
-            yield self._sample()
+        yield from self.sampler.samples(self._sample)
 
     def __len__(self):
         return self._num_samples
@@ -0,0 +1,130 @@
+"""Seeded, resumable sample streams for the iterable BCDatasets"""
+
+import contextlib
+import random
+
+import numpy as np
+import torch
+
+
+def seed_sample(seed, worker_id, epoch, index):
+    """Seeds the global random, numpy and torch generators for one sample"""
+    state = np.random.SeedSequence([seed, worker_id, epoch, index]).generate_state(4)
+    np.random.seed(state[:2])
+    random.seed(int(state[2]))
+    torch.manual_seed(int(state[3]))
+
+
+@contextlib.contextmanager
+def preserve_rng_state():
+    """Restores the global random, numpy and torch (cpu and cuda) generators on exit"""
+    random_state = random.getstate()
+    np_state = np.random.get_state()
+    devices = (
+        list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+    )
+    with torch.random.fork_rng(devices=devices):
+        try:
+            yield
+        finally:
+            random.setstate(random_state)
+            np.random.set_state(np_state)
+
+
+class ResumableSampler:
+    """
+    Drives the sampling loop of a BCDataset. Every sample is drawn after seeding the global random
+    generators from (seed, worker id, epoch, index within the epoch), so the sample stream of each
+    DataLoader worker is reproducible, independent of the other workers and can be restarted at any
+    position without replaying the samples before it. When sampling in the main process
+    (num_workers=0) the generators are restored after every sample, so the trainer's seed is kept.
+
+    The DataLoader fetches batches from its workers in round-robin order, so the number of batches
+    consumed by the trainer determines the position of every worker. That count is the state stored
+    in snapshots.
+
+    In a data-parallel run the workers of all processes are numbered globally, so every process
+    draws its own share of the samples.
+    """
+
+    def __init__(self, epoch_size, seed=0):
+        """
+        Parameters:
+        -----------
+        epoch_size : int
+            The number of samples in one epoch of a worker.
+
+        seed : int
+            The base seed of the sample streams.
+        """
+        self.epoch_size = max(int(epoch_size), 1)
+        self.seed = seed
+        # set by `make_expert_replay_loader`
+        self.batch_size = 1
+        self.num_workers = 0
+        # set by the trainer in a data-parallel run
+        self.rank = 0
+        self.world_size = 1
+        # batches consumed by the trainer
+        self.num_batches = 0
+
+    @property
+    def epoch(self):
+        """The epoch of the samples consumed so far"""
+        num_samples = self.num_batches * self.batch_size
+        return num_samples // (self.epoch_size * max(self.num_workers, 1))
+
+    def state_dict(self):
+        return {
+            "seed": self.seed,
+            "batch_size": self.batch_size,
+            "num_workers": self.num_workers,
+            "world_size": self.world_size,
+            "num_batches": self.num_batches,
+        }
+
+    def load_state_dict(self, state):
+        world_size = state.get("world_size", 1)
+        if (state["batch_size"], state["num_workers"], world_size) != (
+            self.batch_size,
+            self.num_workers,
+            self.world_size,
+        ):
+            print(
+                f"sampler state is from {world_size} loaders with batch size "
+                f"{state['batch_size']} and {state['num_workers']} workers, the sample order will "
+                "differ"
+            )
+        self.seed = state["seed"]
+        self.num_batches = state["num_batches"]
+
+    def _start_position(self, worker_id, num_workers):
+        # batches are fetched from the workers in round-robin order
+        num_batches = max(0, self.num_batches - worker_id + num_workers - 1)
+        return num_batches // num_workers * self.batch_size
+
+    def samples(self, sample_fn):
+        """Yields the samples drawn by `sample_fn` from the seeded generators"""
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        # a new loader fetches from worker 0 first, which takes over the stream of the worker
+        # whose batch was due next
+        worker_id = (worker_id + self.num_batches) % num_workers
+        position = self._start_position(worker_id, num_workers)
+        while True:
+            with (
+                preserve_rng_state()
+                if worker_info is None
+                else contextlib.nullcontext()
+            ):
+                seed_sample(
+                    self.seed,
+                    self.rank * num_workers + worker_id,
+                    position // self.epoch_size,
+                    position % self.epoch_size,
+                )
+                sample = sample_fn()
+            yield sample
+            position += 1
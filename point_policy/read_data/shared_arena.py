@@ -0,0 +1,114 @@
+"""Flat shared-memory arena for the arrays of a dataset"""
+
+import os
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# alignment of each array in the arena, in bytes
+ALIGNMENT = 64
+
+
+def _unlink(shm, pid):
+    # only the process that created the arena removes it, forked workers just drop their mapping
+    if os.getpid() == pid:
+        shm.unlink()
+
+
+class SharedArena:
+    """
+    Packs a list of arrays into one shared-memory block. The arrays are described by a manifest of
+    (offset, dtype, shape) and read back as read-only views into the block, so DataLoader workers
+    forked from the creating process access them without copy-on-write duplication.
+    """
+
+    def __init__(self, arrays):
+        """
+        Parameters:
+        -----------
+        arrays : list
+            The numpy arrays to copy into the arena.
+        """
+        self.manifest = []
+        size = 0
+        for array in arrays:
+            self.manifest.append((size, array.dtype.str, array.shape))
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._finalizer = weakref.finalize(self, _unlink, self._shm, os.getpid())
+        for idx, array in enumerate(arrays):
+            self._view(idx, writeable=True)[...] = array
+
+    def _view(self, idx, writeable=False):
+        offset, dtype, shape = self.manifest[idx]
+        view = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+        view.flags.writeable = writeable
+        return view
+
+    def __getitem__(self, idx):
+        return self._view(idx)
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @property
+    def nbytes(self):
+        return self._shm.size
+
+    def close(self):
+        self._finalizer()
+
+
+def share_arrays(tree):
+    """
+    Moves all numpy arrays in a nested structure of dicts, lists and tuples into a `SharedArena`.
+
+    Returns:
+    --------
+    tree : dict, list or tuple
+        The same structure with every array replaced by a read-only view into the arena.
+
+    arena : SharedArena
+        The arena, which must be kept alive as long as the views are used.
+    """
+    arrays, leaves = [], {}
+
+    def _collect(node):
+        if isinstance(node, dict):
+            return {key: _collect(value) for key, value in node.items()}
+        if isinstance(node, (list, tuple)):
+            return type(node)(_collect(value) for value in node)
+        # memory-mapped arrays are already shared through the page cache
+        if (
+            isinstance(node, np.ndarray)
+            and not isinstance(node, np.memmap)
+            and node.dtype != object
+        ):
+            # arrays referenced more than once are stored once
+            if id(node) not in leaves:
+                arrays.append(node)
+                leaves[id(node)] = _Leaf(len(arrays) - 1)
+            return leaves[id(node)]
+        return node
+
+    def _replace(node):
+        if isinstance(node, dict):
+            return {key: _replace(value) for key, value in node.items()}
+        if isinstance(node, (list, tuple)):
+            return type(node)(_replace(value) for value in node)
+        if isinstance(node, _Leaf):
+            return arena[node.idx]
+        return node
+
+    tree = _collect(tree)
+    arena = SharedArena(arrays)
+    del arrays[:]
+    leaves.clear()
+    return _replace(tree), arena
+
+
+class _Leaf:
+    def __init__(self, idx):
+        self.idx = idx
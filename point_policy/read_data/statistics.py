@@ -0,0 +1,192 @@
+"""Streaming normalization statistics over episodes, cached next to the data"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from read_data.episode_store import INDEX_FILE, get_store_path
+
+STATS_VERSION = 1
+
+
+class RunningStatistics:
+    """
+    Min, max, mean and std of a stream of arrays, reduced over all but the last `feature_ndim` axes.
+    Batches are merged with the parallel algorithm of Chan et al., so each array is read once.
+    """
+
+    def __init__(self, feature_ndim=1):
+        self.feature_ndim = feature_ndim
+        self.count = 0
+        self.min = self.max = self.mean = self.m2 = None
+
+    def update(self, array):
+        array = np.asarray(array)
+        feature_shape = array.shape[array.ndim - self.feature_ndim :]
+        array = array.reshape((-1,) + feature_shape)
+        if len(array) == 0:
+            return
+
+        batch = RunningStatistics(self.feature_ndim)
+        batch.count = len(array)
+        batch.min, batch.max = array.min(axis=0), array.max(axis=0)
+        batch.mean = array.mean(axis=0, dtype=np.float64)
+        batch.m2 = ((array - batch.mean) ** 2).sum(axis=0)
+        self.merge(batch)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.min, self.max = other.min, other.max
+            self.mean, self.m2 = other.mean, other.m2
+            return
+
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        delta = other.mean - self.mean
+        total = self.count + other.count
+        self.mean = self.mean + delta * other.count / total
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / total
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+def compute_statistics(
+    observations, keys, feature_ndim=1, skip_first_n=None, subsample=None
+):
+    """
+    Compute statistics of observation keys in one pass over the episodes.
+
+    Parameters:
+    -----------
+    observations : list
+        The episodes, each a dict of (memory-mapped) arrays with a leading time axis.
+
+    keys : list
+        The observation keys to compute statistics for.
+
+    feature_ndim : int
+        The number of trailing axes statistics are kept for, e.g. 1 for per-coordinate track
+        statistics and 0 for scalar depth statistics.
+
+    skip_first_n : int
+        The number of frames skipped at the start of each episode.
+
+    subsample : int
+        The stride at which the frames of each episode are subsampled.
+
+    Returns:
+    --------
+    statistics : dict
+        For every key, the min, max, mean and std over all episodes and the min and max of each
+        episode (nan for empty episodes).
+    """
+    statistics = {}
+    for key in keys:
+        total = RunningStatistics(feature_ndim)
+        episode_min, episode_max = [], []
+        for observation in observations:
+            array = np.asarray(observation[key][skip_first_n::subsample])
+            episode = RunningStatistics(feature_ndim)
+            episode.update(array)
+            if episode.count == 0:
+                feature_shape = array.shape[array.ndim - feature_ndim :]
+                episode_min.append(np.full(feature_shape, np.nan))
+                episode_max.append(np.full(feature_shape, np.nan))
+                continue
+            episode_min.append(episode.min)
+            episode_max.append(episode.max)
+            total.merge(episode)
+
+        statistics[key] = {
+            "min": total.min,
+            "max": total.max,
+            "mean": total.mean,
+            "std": total.std,
+            "count": total.count,
+            "episode_min": np.array(episode_min),
+            "episode_max": np.array(episode_max),
+        }
+    return statistics
+
+
+def _fingerprint(pkl_path):
+    """Hash of the episode store index and the size and modification time of the data files"""
+    sha = hashlib.sha1(str(STATS_VERSION).encode())
+    store_path = get_store_path(pkl_path)
+    if store_path.exists():
+        with open(store_path / INDEX_FILE, "rb") as f:
+            sha.update(f.read())
+        paths = sorted(store_path.glob("*.npy"))
+    else:
+        paths = [Path(pkl_path)]
+    for path in paths:
+        stat = os.stat(path)
+        sha.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+def get_stats_path(pkl_path):
+    """The statistics cache next to a {task}.pkl file"""
+    return Path(pkl_path).with_suffix(".stats.json")
+
+
+def load_or_compute_statistics(
+    pkl_path, observations, keys, feature_ndim=1, skip_first_n=None, subsample=None
+):
+    """
+    `compute_statistics` for the episodes of a {task}.pkl file (or its episode store), reusing the
+    statistics cached next to the data if they were computed for the same data and parameters.
+    """
+    stats_path = get_stats_path(pkl_path)
+    fingerprint = _fingerprint(pkl_path)
+    cache = {"fingerprint": fingerprint, "entries": {}}
+    if stats_path.exists():
+        with open(stats_path, "r") as f:
+            cached = json.load(f)
+        if cached.get("fingerprint") == fingerprint:
+            cache = cached
+
+    def _entry(key):
+        return json.dumps(
+            {
+                "key": key,
+                "num_episodes": len(observations),
+                "feature_ndim": feature_ndim,
+                "skip_first_n": skip_first_n,
+                "subsample": subsample,
+            },
+            sort_keys=True,
+        )
+
+    missing = [key for key in keys if _entry(key) not in cache["entries"]]
+    if len(missing) > 0:
+        computed = compute_statistics(
+            observations, missing, feature_ndim, skip_first_n, subsample
+        )
+        for key, stats in computed.items():
+            cache["entries"][_entry(key)] = {
+                name: np.asarray(value).tolist() for name, value in stats.items()
+            }
+        try:
+            tmp_path = stats_path.with_name(f"{stats_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, stats_path)
+        except OSError as e:
+            print(f"could not cache statistics at {stats_path}: {e}")
+
+    return {
+        key: {
+            name: np.array(value, dtype=np.float64)
+            for name, value in cache["entries"][_entry(key)].items()
+        }
+        for key in keys
+    }
@@ -1,22 +1,247 @@
+import json
+import os
 import random
+import time
+from pathlib import Path
 
 import numpy as np
 import torch
+from torch.profiler import record_function
+
+# candidate DataLoader configurations for `tune_expert_replay_loader`
+WORKER_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+PREFETCH_FACTORS = [2, 4, 8]
 
 
 def _worker_init_fn(worker_id):
-    seed = np.random.get_state()[1][0] + worker_id
+    seed = int(np.random.get_state()[1][0]) + worker_id
     np.random.seed(seed)
     random.seed(seed)
 
 
-def make_expert_replay_loader(iterable, batch_size):
+def make_expert_replay_loader(
+    iterable, batch_size, num_workers=32, prefetch_factor=None
+):
+    # datasets that sample whole batches are not batched again by the loader
+    if getattr(iterable, "sample_batch_size", None) is not None:
+        batch_size = None
+
+    # the sampler maps consumed batches to the position of each worker's sample stream
+    sampler = getattr(iterable, "sampler", None)
+    if sampler is not None:
+        sampler.batch_size = 1 if batch_size is None else batch_size
+        sampler.num_workers = num_workers
+
     loader = torch.utils.data.DataLoader(
         iterable,
         batch_size=batch_size,
-        num_workers=32,
-        pin_memory=True,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
         worker_init_fn=_worker_init_fn,
-        persistent_workers=True,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
     )
     return loader
+
+
+def benchmark_replay_loader(
+    iterable, batch_size, num_workers, prefetch_factor, num_batches=50, warmup=5
+):
+    """Returns the number of batches per second a loader configuration delivers"""
+    loader = make_expert_replay_loader(
+        iterable, batch_size, num_workers, prefetch_factor
+    )
+    replay_iter = iter(loader)
+    # the first batches include the worker startup
+    for _ in range(warmup):
+        next(replay_iter)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(replay_iter)
+    throughput = num_batches / (time.perf_counter() - start)
+    del replay_iter, loader
+    return throughput
+
+
+def tune_expert_replay_loader(
+    iterable,
+    batch_size,
+    step_time,
+    cache_path=None,
+    worker_counts=WORKER_COUNTS,
+    prefetch_factors=PREFETCH_FACTORS,
+    num_batches=50,
+):
+    """
+    Picks the cheapest DataLoader configuration that delivers batches at least as fast as the agent
+    consumes them.
+
+    Parameters:
+    -----------
+    iterable : IterableDataset
+        The dataset to benchmark.
+
+    batch_size : int
+        The batch size of the loader.
+
+    step_time : float
+        The measured time of one agent update in seconds.
+
+    cache_path : str
+        A json file with the throughput of previously benchmarked configurations, keyed by dataset,
+        batch size and number of cpus. Only configurations missing from it are benchmarked.
+
+    worker_counts : list
+        The candidate numbers of workers, capped at the number of available cpus.
+
+    prefetch_factors : list
+        The candidate numbers of batches prefetched per worker.
+
+    num_batches : int
+        The number of batches timed per configuration.
+
+    Returns:
+    --------
+    num_workers : int
+        The number of workers.
+
+    prefetch_factor : int
+        The number of batches prefetched per worker.
+    """
+    num_cpus = len(os.sched_getaffinity(0))
+    worker_counts = sorted(set(min(count, num_cpus) for count in worker_counts))
+    # configurations in order of cost, fewer workers first and then less prefetching
+    candidates = [
+        (num_workers, prefetch_factor)
+        for num_workers in worker_counts
+        for prefetch_factor in sorted(prefetch_factors)
+    ]
+
+    profile_key = (
+        f"{type(iterable).__module__}.{type(iterable).__name__}"
+        f":{len(iterable)}:{batch_size}:{num_cpus}"
+    )
+    profiles = {}
+    if cache_path is not None:
+        cache_path = Path(cache_path).expanduser()
+        if cache_path.exists():
+            with open(cache_path, "r") as f:
+                profiles = json.load(f)
+    profile = profiles.setdefault(profile_key, {})
+
+    required_throughput = 1.0 / step_time
+    choice = None
+    for num_workers, prefetch_factor in candidates:
+        config = f"{num_workers}:{prefetch_factor}"
+        if config not in profile:
+            profile[config] = benchmark_replay_loader(
+                iterable, batch_size, num_workers, prefetch_factor, num_batches
+            )
+            print(
+                f"replay loader with {num_workers} workers, prefetch factor {prefetch_factor}: "
+                f"{profile[config]:.1f} batches/s"
+            )
+        if profile[config] >= required_throughput:
+            choice = (num_workers, prefetch_factor)
+            break
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(profiles, f, indent=2)
+
+    if choice is None:
+        # nothing keeps up, take the fastest configuration
+        choice = max(candidates, key=lambda c: profile[f"{c[0]}:{c[1]}"])
+        print(
+            f"no replay loader configuration keeps up with {required_throughput:.1f} updates/s"
+        )
+    throughput = profile[f"{choice[0]}:{choice[1]}"]
+    print(
+        f"using replay loader with {choice[0]} workers, prefetch factor {choice[1]} "
+        f"({throughput:.1f} batches/s for {required_throughput:.1f} updates/s)"
+    )
+    return choice
+
+
+def count_batches(replay_iter, sampler):
+    """Counts the batches handed to the trainer, which is the position stored in snapshots"""
+    replay_iter = iter(replay_iter)
+    while True:
+        # the time the trainer waits for the loader
+        with record_function("data_wait"):
+            batch = next(replay_iter, None)
+        if batch is None:
+            return
+        sampler.num_batches += 1
+        yield batch
+
+
+class DevicePrefetcher:
+    """
+    Hands the trainer batches whose tensors are already on the device, transformed by
+    `transform` (e.g. the batch augmentation of a dataset) if given.
+
+    On cuda, when a batch is handed out the next batch is taken from the loader and its copy from
+    pinned memory is issued on a side stream, so the host to device copy and the transform overlap
+    with the update on the current batch. Taking the batch from the loader is synchronous, so
+    waiting for the loader stays on the critical path and is only hidden by the prefetching of the
+    loader's workers. On cpu each batch is moved and transformed when it is requested.
+
+    The loader is iterated, which starts its workers, on the first `__next__`, so a prefetcher
+    that is replaced before use (e.g. when resuming) does not start the workers.
+    """
+
+    def __init__(self, replay_iter, device, transform=None):
+        self._replay_iterable = replay_iter
+        self._replay_iter = None
+        self.device = torch.device(device)
+        self._transform = transform
+        self._stream = (
+            torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        )
+        self._next = None
+
+    def _load(self):
+        batch = dict(next(self._replay_iter))
+        with record_function("h2d_copy"):
+            for key, value in batch.items():
+                if not isinstance(value, torch.Tensor):
+                    continue
+                if self._stream is not None and not value.is_pinned():
+                    value = value.pin_memory()
+                batch[key] = value.to(self.device, non_blocking=True)
+        if self._transform is not None:
+            with record_function("augment"):
+                batch = self._transform(batch)
+        return batch
+
+    def _preload(self):
+        try:
+            with torch.cuda.stream(self._stream):
+                self._next = self._load()
+        except StopIteration:
+            self._next = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._replay_iter is None:
+            self._replay_iter = iter(self._replay_iterable)
+            if self._stream is not None:
+                self._preload()
+        if self._stream is None:
+            return self._load()
+
+        if self._next is None:
+            raise StopIteration
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_stream(self._stream)
+        batch = self._next
+        # the tensors were allocated on the side stream but are freed after use on this one
+        for value in batch.values():
+            if isinstance(value, torch.Tensor) and value.is_cuda:
+                value.record_stream(stream)
+        self._preload()
+        return batch
@@ -1,3 +1,7 @@
+import sys
+
+sys.path.append("../../")
+
 import argparse
 import pickle as pkl
 from pathlib import Path
@@ -5,6 +9,7 @@ from pathlib import Path
 import cv2
 import numpy as np
 from gripper_points import Tshift, extrapoints
+from read_data.episode_store import get_store_path, write_episode_store
 from scipy.ndimage import zoom
 from scipy.spatial.transform import Rotation as R
 
@@ -34,12 +39,18 @@ parser.add_argument("--task_name", type=str, help="List of task names")
 parser.add_argument(
     "--use_gt_depth", action="store_true", help="Use ground truth depth"
 )
+parser.add_argument(
+    "--save_store",
+    action="store_true",
+    help="Also save a memory-mapped episode store next to the pkl file",
+)
 
 args = parser.parse_args()
 DATA_DIR = Path(args.data_dir)
 CALIB_PATH = Path(args.calib_path)
 task_name = args.task_name
 use_gt_depth = args.use_gt_depth
+save_store = args.save_store
 
 camera_indices = [1, 2]
 image_size = (640, 480)
@@ -179,3 +190,9 @@ DATA["observations"] = observations
 
 # save data
 pkl.dump(DATA, open(SAVE_DIR / f"{task_name}.pkl", "wb"))
+if save_store:
+    write_episode_store(
+        get_store_path(SAVE_DIR / f"{task_name}.pkl"),
+        observations,
+        **{key: value for key, value in DATA.items() if key != "observations"},
+    )
@@ -14,6 +14,7 @@ import yaml
 from gripper_points import Tshift, extrapoints
 from pandas import read_csv
 from point_utils.points_class import PointsClass
+from read_data.episode_store import get_store_path, write_episode_store
 from scipy.spatial.transform import Rotation as R
 
 from utils import (
@@ -38,6 +39,11 @@ parser.add_argument("--process_points", action="store_true", help="Process key p
 parser.add_argument(
     "--use_gt_depth", action="store_true", help="Use ground truth depth"
 )
+parser.add_argument(
+    "--save_store",
+    action="store_true",
+    help="Also save a memory-mapped episode store next to the pkl file",
+)
 
 args = parser.parse_args()
 DATA_DIR = Path(args.data_dir)
@@ -46,6 +52,7 @@ task_names = args.task_names
 NUM_DEMOS = args.num_demos
 process_points = args.process_points
 use_gt_depth = args.use_gt_depth
+save_store = args.save_store
 
 camera_indices = [1, 2]
 original_img_size = (640, 480)
@@ -519,5 +526,14 @@ for TASK_NAME in task_names:
     }
     with open(SAVE_DATA_PATH / f"{TASK_NAME}.pkl", "wb") as f:
         pkl.dump(data, f)
+    if save_store:
+        write_episode_store(
+            get_store_path(SAVE_DATA_PATH / f"{TASK_NAME}.pkl"),
+            observations,
+            max_cartesian=max_cartesian,
+            min_cartesian=min_cartesian,
+            max_gripper=max_gripper,
+            min_gripper=min_gripper,
+        )
 
 print("Processing complete.")
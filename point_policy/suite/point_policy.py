@@ -9,6 +9,7 @@ import torch
 from dm_env import StepType, TimeStep, specs
 from gym import spaces
 from scipy.spatial.transform import Rotation as R
+from torch.profiler import record_function
 
 from robot_utils.franka.gripper_points import Tshift, extrapoints
 from robot_utils.franka.utils import (
@@ -232,15 +233,18 @@ class RGBArrayAsObservationWrapper(dm_env.Environment):
         # robot points
         robot_points, robot_points_3d = self.get_pixel_on_robot()
         self.prev_gripper_points = robot_points_3d
+        if self._use_object_points:
+            with record_function("point_tracking"):
+                for pixel_key in self._pixel_keys:
+                    self._points_class.add_to_image_list(
+                        obs[pixel_key][:, :, ::-1], pixel_key
+                    )
+                self._points_class.track_points_all(self._pixel_keys)
         for pixel_key in self._pixel_keys:
             robot_point = robot_points[pixel_key]
             current_track = robot_point
 
             if self._use_object_points:
-                self._points_class.add_to_image_list(
-                    obs[pixel_key][:, :, ::-1], pixel_key
-                )
-                self._points_class.track_points(pixel_key)
                 object_pts = self._points_class.get_points_on_image(pixel_key).numpy()[
                     0
                 ]
@@ -350,6 +354,18 @@ class RGBArrayAsObservationWrapper(dm_env.Environment):
         # orientation of the robot at the 0th step
         self.robot_base_orientation = R.from_rotvec([np.pi, 0, 0]).as_matrix()
 
+        if self._use_object_points:
+            self._points_class.reset_episode()
+            for pixel_key in self._pixel_keys:
+                frame = obs[pixel_key]
+                self._points_class.add_to_image_list(frame[:, :, ::-1], pixel_key)
+                for object_label in self._object_labels:
+                    self._points_class.find_semantic_similar_points(
+                        pixel_key, object_label
+                    )
+            self._points_class.track_points_all(self._pixel_keys, is_first_step=True)
+            self._points_class.track_points_all(self._pixel_keys)
+
         # grid_pts = None
         self._track_pts = {}
         for pixel_key in self._pixel_keys:
@@ -364,15 +380,6 @@ class RGBArrayAsObservationWrapper(dm_env.Environment):
                 points[0][:, -len(robot_pts[0]) :] = robot_pts
 
             if self._use_object_points:
-                frame = obs[pixel_key]
-                self._points_class.reset_episode()
-                self._points_class.add_to_image_list(frame[:, :, ::-1], pixel_key)
-                for object_label in self._object_labels:
-                    self._points_class.find_semantic_similar_points(
-                        pixel_key, object_label
-                    )
-                self._points_class.track_points(pixel_key, is_first_step=True)
-                self._points_class.track_points(pixel_key)
                 object_pts = self._points_class.get_points_on_image(pixel_key)
                 points.append(object_pts)
 
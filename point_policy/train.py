@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import copy
+import itertools
 import os
+import time
 import warnings
+from collections import defaultdict
 
 os.environ["MKL_SERVICE_FORCE_INTEL"] = "1"
 os.environ["MUJOCO_GL"] = "egl"
@@ -11,8 +15,19 @@ from pathlib import Path
 import hydra
 import numpy as np
 import torch
-from logger import Logger
-from replay_buffer import make_expert_replay_loader
+import torch.distributed as dist
+from agent.ensemble import EnsembleBCAgent
+from checkpoint import AsyncCheckpointer, latest_checkpoint, load_checkpoint
+from logger import AverageMeter, Logger
+from profiling import TrainProfiler
+from read_data.sampler import preserve_rng_state
+from replay_buffer import (
+    DevicePrefetcher,
+    count_batches,
+    make_expert_replay_loader,
+    tune_expert_replay_loader,
+)
+from torch.profiler import record_function
 from video import VideoRecorder
 
 import utils
@@ -33,6 +48,26 @@ def make_agent(obs_spec, action_spec, cfg):
     return hydra.utils.instantiate(cfg.agent)
 
 
+def make_sweep_agent(obs_spec, action_spec, cfg):
+    """One agent per seed and learning rate of the sweep, trained as a vectorized ensemble"""
+    seeds = list(cfg.sweep_seeds or [cfg.seed])
+    lrs = list(cfg.sweep_lrs or [cfg.agent.lr])
+    num_members = max(len(seeds), len(lrs))
+    lengths = [1, num_members]
+    assert (
+        len(seeds) in lengths and len(lrs) in lengths
+    ), "sweep_seeds and sweep_lrs must have the same length or a single value"
+
+    members = []
+    lr = cfg.agent.lr
+    for member in range(num_members):
+        utils.set_seed_everywhere(seeds[member % len(seeds)])
+        cfg.agent.lr = lrs[member % len(lrs)]
+        members.append(make_agent(obs_spec, action_spec, cfg))
+    cfg.agent.lr = lr
+    return EnsembleBCAgent(members, amp=cfg.amp, fused_optimizer=cfg.fused_optimizer)
+
+
 class WorkspaceIL:
     def __init__(self, cfg):
         self.work_dir = Path.cwd()
@@ -40,29 +75,27 @@ class WorkspaceIL:
 
         self.cfg = cfg
         self.cfg.root_dir = os.path.abspath(os.path.expanduser(self.cfg.root_dir))
+        # data-parallel processes, only rank 0 logs, evaluates and saves snapshots
+        self.rank, self.world_size, self.device = utils.init_distributed(
+            cfg.device, timeout=cfg.dist_timeout
+        )
+        self.cfg.device = str(self.device)
+        assert (
+            self.cfg.batch_size % self.world_size == 0
+        ), "batch_size must be divisible by the number of processes"
+        self._batch_size = self.cfg.batch_size // self.world_size
         utils.set_seed_everywhere(cfg.seed)
-        self.device = torch.device(cfg.device)
 
         # load data
         dataset_iterable = hydra.utils.call(self.cfg.expert_dataset)
-        self.expert_replay_loader = make_expert_replay_loader(
-            dataset_iterable, self.cfg.batch_size
-        )
-        self.expert_replay_iter = iter(self.expert_replay_loader)
-        self.stats = self.expert_replay_loader.dataset.stats
+        self.stats = dataset_iterable.stats
 
-        # create logger
-        self.logger = Logger(self.work_dir, use_tb=self.cfg.use_tb)
         # create envs
-        self.cfg.suite.task_make_fn.max_episode_len = (
-            self.expert_replay_loader.dataset._max_episode_len
-        )
-        self.cfg.suite.task_make_fn.max_state_dim = (
-            self.expert_replay_loader.dataset._max_state_dim
-        )
+        self.cfg.suite.task_make_fn.max_episode_len = dataset_iterable._max_episode_len
+        self.cfg.suite.task_make_fn.max_state_dim = dataset_iterable._max_state_dim
         if self.cfg.suite.name == "dmc":
             self.cfg.suite.task_make_fn.max_action_dim = (
-                self.expert_replay_loader.dataset._max_action_dim
+                dataset_iterable._max_action_dim
             )
 
         # load points cfg if using object points
@@ -92,10 +125,62 @@ class WorkspaceIL:
 
         self.env, self.task_descriptions = hydra.utils.call(self.cfg.suite.task_make_fn)
 
-        # create agent
-        self.agent = make_agent(
+        # create agent, or the ensemble of a sweep
+        self.sweep = cfg.sweep_seeds is not None or cfg.sweep_lrs is not None
+        self.agent = (make_sweep_agent if self.sweep else make_agent)(
             self.env[0].observation_spec(), self.env[0].action_spec(), cfg
         )
+        if self.world_size > 1:
+            self.agent.update_step.broadcast_parameters()
+            utils.set_seed_everywhere(cfg.seed + self.rank)
+        elif self.sweep:
+            utils.set_seed_everywhere(cfg.seed)
+
+        # create loggers and checkpointers, one per member of a sweep
+        member_dirs = (
+            [self.work_dir / f"member_{member}" for member in range(len(self.agent))]
+            if self.sweep
+            else [self.work_dir]
+        )
+        self.loggers, self.checkpointers = [], []
+        if self.is_main:
+            for member_dir in member_dirs:
+                member_dir.mkdir(exist_ok=True)
+                self.loggers.append(Logger(member_dir, use_tb=self.cfg.use_tb))
+                self.checkpointers.append(
+                    AsyncCheckpointer(
+                        member_dir / "snapshot",
+                        keep_last=self.cfg.snapshot_keep_last,
+                        keep_best=self.cfg.snapshot_keep_best,
+                        best_metric=self.cfg.snapshot_best_metric,
+                        mode=self.cfg.snapshot_best_mode,
+                    )
+                )
+        # latest eval results and train metrics averaged since the previous snapshot of each
+        # member, to rank snapshots by
+        self._eval_metrics = [{} for _ in member_dirs]
+        self._train_meters = [defaultdict(AverageMeter) for _ in member_dirs]
+
+        # replay loader, tuned to the update time of the agent if num_workers is auto
+        self._num_workers, self._prefetch_factor = self.cfg.num_workers, None
+        if self._num_workers == "auto":
+            # every process takes part in the all-reduce of the timed updates
+            step_time = self._measure_update_time(dataset_iterable)
+            loader_cfg = [None]
+            if self.is_main:
+                loader_cfg[0] = tune_expert_replay_loader(
+                    dataset_iterable,
+                    self._batch_size,
+                    step_time,
+                    cache_path=self.cfg.replay_loader_profile,
+                )
+            if self.world_size > 1:
+                dist.broadcast_object_list(loader_cfg)
+            self._num_workers, self._prefetch_factor = loader_cfg[0]
+        dataset_iterable.sampler.seed = self.cfg.seed
+        dataset_iterable.sampler.rank = self.rank
+        dataset_iterable.sampler.world_size = self.world_size
+        self._make_replay_iter(dataset_iterable)
 
         self.envs_till_idx = self.expert_replay_loader.dataset.envs_till_idx
 
@@ -107,6 +192,63 @@ class WorkspaceIL:
             self.work_dir if self.cfg.save_video else None
         )
 
+    def _make_replay_iter(self, dataset_iterable):
+        # workers start sampling at the position of the dataset's sampler
+        self.expert_replay_loader = make_expert_replay_loader(
+            dataset_iterable,
+            self._batch_size,
+            self._num_workers,
+            self._prefetch_factor,
+        )
+        # batches are counted as the agent takes them, not as they are prefetched
+        self.expert_replay_iter = count_batches(
+            DevicePrefetcher(
+                self.expert_replay_loader,
+                self.device,
+                getattr(dataset_iterable, "batch_augmentation", None),
+            ),
+            dataset_iterable.sampler,
+        )
+
+    def _measure_update_time(self, dataset_iterable, num_batches=4, num_steps=10):
+        """Returns the time of one agent update in seconds, measured on a copy of the agent"""
+        # the measurement draws batches and random numbers, which must not change the seeds
+        with preserve_rng_state():
+            return self._time_updates(dataset_iterable, num_batches, num_steps)
+
+    def _time_updates(self, dataset_iterable, num_batches, num_steps):
+        loader = make_expert_replay_loader(
+            dataset_iterable, self._batch_size, num_workers=0
+        )
+        replay_iter = iter(loader)
+        batches = [next(replay_iter) for _ in range(num_batches)]
+        del replay_iter, loader
+
+        replay_iter = DevicePrefetcher(
+            itertools.cycle(batches),
+            self.device,
+            getattr(dataset_iterable, "batch_augmentation", None),
+        )
+
+        # the copy keeps the updates from changing the weights the agent starts training with
+        agent = copy.deepcopy(self.agent)
+        agent.update(replay_iter, 0)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        start = time.perf_counter()
+        for step in range(num_steps):
+            agent.update(replay_iter, step)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        step_time = (time.perf_counter() - start) / num_steps
+        del agent
+        print(f"agent update: {1000 * step_time:.1f} ms")
+        return step_time
+
+    @property
+    def is_main(self):
+        return self.rank == 0
+
     @property
     def global_step(self):
         return self._global_step
@@ -119,8 +261,12 @@ class WorkspaceIL:
     def global_frame(self):
         return self.global_step * self.cfg.suite.action_repeat
 
-    def eval(self):
-        self.agent.train(False)
+    def eval(self, member=0):
+        # a member of a sweep is evaluated with its own agent, synced from the ensemble
+        agent = self.agent.members[member] if self.sweep else self.agent
+        logger = self.loggers[member]
+        video_prefix = f"member{member}_" if self.sweep else ""
+        agent.train(False)
         episode_rewards = []
         successes = []
 
@@ -133,8 +279,9 @@ class WorkspaceIL:
             success = []
 
             while eval_until_episode(episode):
-                time_step = self.env[env_idx].reset()
-                self.agent.buffer_reset()
+                with record_function("env_reset"):
+                    time_step = self.env[env_idx].reset()
+                agent.buffer_reset()
                 step = 0
 
                 if episode == 0:
@@ -142,24 +289,28 @@ class WorkspaceIL:
 
                 # plot obs with cv2
                 # while not time_step.last():
-                with torch.no_grad(), utils.eval_mode(self.agent):
-                    action = self.agent.act(
-                        time_step.observation,
-                        self.stats,
-                        step,
-                        self.global_step,
-                        eval_mode=True,
-                    )
-                    action = action.reshape(self.cfg.num_queries, self.agent._act_dim)
+                with torch.no_grad(), utils.eval_mode(agent):
+                    with record_function("policy_act"):
+                        action = agent.act(
+                            time_step.observation,
+                            self.stats,
+                            step,
+                            self.global_step,
+                            eval_mode=True,
+                        )
+                    action = action.reshape(self.cfg.num_queries, agent._act_dim)
                     for a in action:  # TODO figure out dimension
-                        time_step = self.env[env_idx].step(a)
+                        with record_function("env_step"):
+                            time_step = self.env[env_idx].step(a)
                         self.video_recorder.record(self.env[env_idx])
                         total_reward += time_step.reward
                         step += 1
 
                 episode += 1
                 success.append(time_step.observation["goal_achieved"])
-            self.video_recorder.save(f"{self.global_step}_env{env_idx}.mp4")
+            self.video_recorder.save(
+                f"{video_prefix}{self.global_step}_env{env_idx}.mp4"
+            )
             episode_rewards.append(total_reward / episode)
             successes.append(np.mean(success))
 
@@ -167,17 +318,21 @@ class WorkspaceIL:
             episode_rewards.append(0)
             successes.append(0)
 
-        with self.logger.log_and_dump_ctx(self.global_step, ty="eval") as log:
+        with logger.log_and_dump_ctx(self.global_step, ty="eval") as log:
             for env_idx, reward in enumerate(episode_rewards):
                 log(f"episode_reward_env{env_idx}", reward)
                 log(f"success_env{env_idx}", successes[env_idx])
             log("episode_reward", np.mean(episode_rewards[:num_envs]))
             log("success", np.mean(successes))
+            self._eval_metrics[member] = {
+                "episode_reward": np.mean(episode_rewards[:num_envs]),
+                "success": np.mean(successes),
+            }
             log("episode_length", step * self.cfg.suite.action_repeat / episode)
             log("episode", self.global_episode)
             log("step", self.global_step)
 
-        self.agent.train(True)
+        agent.train(True)
 
     def train(self):
         # predicates
@@ -186,66 +341,134 @@ class WorkspaceIL:
         eval_every_step = utils.Every(self.cfg.suite.eval_every_steps, 1)
         save_every_step = utils.Every(self.cfg.suite.save_every_steps, 1)
 
+        # traces of a window of steps and the first eval after it, in {work_dir}/profile
+        profiler = TrainProfiler(
+            self.work_dir / "profile",
+            wait=self.cfg.profile_wait,
+            warmup=self.cfg.profile_warmup,
+            active=self.cfg.profile_active,
+            enabled=self.cfg.profile and self.is_main,
+        )
+        profiler.start()
+
         metrics = None
         while train_until_step(self.global_step):
             # try to evaluate
             if (
-                self.cfg.eval
+                self.is_main
+                and self.cfg.eval
                 and eval_every_step(self.global_step)
                 and self.global_step > 0
             ):
-                self.logger.log(
-                    "eval_total_time", self.timer.total_time(), self.global_frame
-                )
-                self.eval()
+                with profiler.eval(), record_function("eval"):
+                    if self.sweep:
+                        self.agent.sync_members()
+                    for member, logger in enumerate(self.loggers):
+                        logger.log(
+                            "eval_total_time",
+                            self.timer.total_time(),
+                            self.global_frame,
+                        )
+                        self.eval(member)
 
             # update
             metrics = self.agent.update(
                 self.expert_replay_iter,
                 self.global_step,
             )
-            self.logger.log_metrics(metrics, self.global_frame, ty="train")
 
-            # log
-            if log_every_step(self.global_step):
-                elapsed_time, total_time = self.timer.reset()
-                with self.logger.log_and_dump_ctx(self.global_frame, ty="train") as log:
-                    log("total_time", total_time)
-                    log("actor_loss", metrics["actor_loss"])
-                    log("step", self.global_step)
-
-            # save snapshot
-            if save_every_step(self.global_step):
-                self.save_snapshot()
+            # rank 0 logs and saves snapshots, the ensemble of a sweep returns the metrics of
+            # each member
+            if self.is_main:
+                member_metrics = metrics if self.sweep else [metrics]
+                if log_every_step(self.global_step):
+                    elapsed_time, total_time = self.timer.reset()
+                if save_every_step(self.global_step) and self.sweep:
+                    self.agent.sync_members()
+
+                for member, logger in enumerate(self.loggers):
+                    metrics = member_metrics[member]
+                    with record_function("logging"):
+                        logger.log_metrics(metrics, self.global_frame, ty="train")
+                        if self.cfg.snapshot_best_metric is not None:
+                            for key, value in metrics.items():
+                                self._train_meters[member][key].update(value)
+
+                        # log
+                        if log_every_step(self.global_step):
+                            with logger.log_and_dump_ctx(
+                                self.global_frame, ty="train"
+                            ) as log:
+                                log("total_time", total_time)
+                                log("actor_loss", metrics["actor_loss"])
+                                log("step", self.global_step)
+                                episode_cache = getattr(
+                                    self.expert_replay_loader.dataset,
+                                    "episode_cache",
+                                    None,
+                                )
+                                if episode_cache is not None:
+                                    log(
+                                        "episode_cache_hit_rate",
+                                        episode_cache.hit_rate,
+                                    )
+
+                    # save snapshot
+                    if save_every_step(self.global_step):
+                        with record_function("snapshot"):
+                            train_metrics = {
+                                key: meter.value()
+                                for key, meter in self._train_meters[member].items()
+                            }
+                            self._train_meters[member].clear()
+                            self.save_snapshot(
+                                member, {**train_metrics, **self._eval_metrics[member]}
+                            )
 
             self._global_step += 1
+            profiler.step()
+
+        profiler.stop()
+        for checkpointer, logger in zip(self.checkpointers, self.loggers):
+            checkpointer.close()
+            logger.close()
 
-    def save_snapshot(self):
-        snapshot_dir = self.work_dir / "snapshot"
-        snapshot_dir.mkdir(exist_ok=True)
-        snapshot = snapshot_dir / f"{self.global_step}.pt"
+    def save_snapshot(self, member=0, metrics=None):
+        # copied to cpu here and written to disk in the background
         self.agent.clear_buffers()
         keys_to_save = ["timer", "_global_step", "_global_episode", "stats"]
         payload = {k: self.__dict__[k] for k in keys_to_save}
-        payload.update(self.agent.save_snapshot())
-        with snapshot.open("wb") as f:
-            torch.save(payload, f)
+        payload["sampler"] = self.expert_replay_loader.dataset.sampler.state_dict()
+        if self.sweep:
+            payload.update(self.agent.save_snapshot(member))
+        else:
+            payload.update(self.agent.save_snapshot())
+        self.checkpointers[member].save(payload, self.global_step, metrics)
 
         self.agent.buffer_reset()
 
-    def load_snapshot(self, snapshots):
+    def load_snapshot(self, snapshots, resume=False):
         # bc
-        with snapshots["bc"].open("rb") as f:
-            payload = torch.load(f)
+        payload = load_checkpoint(snapshots["bc"])
         agent_payload = {}
         for k, v in payload.items():
-            if k not in self.__dict__:
+            if k not in self.__dict__ and k != "sampler":
                 agent_payload[k] = v
         self.agent.load_snapshot(agent_payload, eval=False)
 
+        # continue the run from the step, optimizer state and data order of the snapshot
+        if resume:
+            assert not self.sweep, "a sweep can not be resumed from a single snapshot"
+            self._global_step = payload["_global_step"]
+            self._global_episode = payload["_global_episode"]
+            # the replaced loader was never iterated, so its workers were not started
+            if "sampler" in payload:
+                dataset_iterable = self.expert_replay_loader.dataset
+                dataset_iterable.sampler.load_state_dict(payload["sampler"])
+                self._make_replay_iter(dataset_iterable)
 
-@hydra.main(config_path="cfgs", config_name="config")
-def main(cfg):
+
+def run(cfg):
     from train import WorkspaceIL as W
 
     workspace = W(cfg)
@@ -254,13 +477,42 @@ def main(cfg):
     if cfg.load_bc:
         snapshots = {}
         bc_snapshot = Path(cfg.bc_weight)
+        # a snapshot directory resumes from its latest snapshot
+        if bc_snapshot.is_dir():
+            bc_snapshot = latest_checkpoint(bc_snapshot)
+            if bc_snapshot is None:
+                raise FileNotFoundError(f"no snapshot in: {cfg.bc_weight}")
         if not bc_snapshot.exists():
             raise FileNotFoundError(f"bc weight not found: {bc_snapshot}")
         print(f"loading bc weight: {bc_snapshot}")
         snapshots["bc"] = bc_snapshot
-        workspace.load_snapshot(snapshots)
+        workspace.load_snapshot(snapshots, resume=cfg.resume)
 
     workspace.train()
+    if workspace.world_size > 1:
+        dist.destroy_process_group()
+
+
+def _run_process(rank, cfg, port):
+    os.environ.update(
+        RANK=str(rank),
+        LOCAL_RANK=str(rank),
+        WORLD_SIZE=str(cfg.world_size),
+        MASTER_ADDR="localhost",
+        MASTER_PORT=str(port),
+    )
+    run(cfg)
+
+
+@hydra.main(config_path="cfgs", config_name="config")
+def main(cfg):
+    # processes launched by torchrun already have a rank, otherwise spawn world_size processes
+    if cfg.world_size > 1 and "RANK" not in os.environ:
+        torch.multiprocessing.spawn(
+            _run_process, args=(cfg, utils.find_free_port()), nprocs=cfg.world_size
+        )
+    else:
+        run(cfg)
 
 
 if __name__ == "__main__":
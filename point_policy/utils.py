@@ -1,13 +1,19 @@
+import contextlib
+import datetime
+import os
 import random
 import re
+import socket
 import time
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import distributions as pyd
 from torch.distributions.utils import _standard_normal
+from torch.profiler import record_function
 
 
 class eval_mode:
@@ -34,6 +40,61 @@ def set_seed_everywhere(seed):
     random.seed(seed)
 
 
+def init_distributed(device, timeout=120):
+    """
+    Joins the process group of a data-parallel run, set up from the RANK, LOCAL_RANK, WORLD_SIZE,
+    MASTER_ADDR and MASTER_PORT environment variables (as set by torchrun or `train.py`).
+    Processes use nccl on cuda, with one GPU per local rank, and gloo on cpu.
+
+    Parameters:
+    -----------
+    device : str
+        The device of the run, cuda is mapped to the GPU of the local rank.
+
+    timeout : float
+        The minutes a process waits in a collective before the run is aborted. The other processes
+        wait in their next collective while rank 0 evaluates or tunes the replay loader, so this
+        must cover the longest of those.
+
+    Returns:
+    --------
+    rank : int
+        The rank of this process, 0 outside of a data-parallel run.
+
+    world_size : int
+        The number of processes.
+
+    device : torch.device
+        The device of this process.
+    """
+    device = torch.device(device)
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, device
+
+    rank = int(os.environ["RANK"])
+    if device.type == "cuda":
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", rank)))
+        torch.cuda.set_device(device)
+    dist.init_process_group(
+        "nccl" if device.type == "cuda" else "gloo",
+        rank=rank,
+        world_size=world_size,
+        timeout=datetime.timedelta(minutes=timeout),
+    )
+    return rank, world_size, device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
 def soft_update_params(net, target_net, tau):
     for param, target_param in zip(net.parameters(), target_net.parameters()):
         target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
@@ -59,6 +120,89 @@ def weight_init(m):
             m.bias.data.fill_(0.0)
 
 
+class UpdateStep:
+    """
+    Zeroes the gradients, backpropagates a loss and steps the optimizers of an agent update,
+    optionally with mixed precision. With fp16 the loss is scaled by a GradScaler, bf16 has the range
+    of fp32 and needs no scaling.
+
+    In a data-parallel run the gradients are averaged over the processes before the step, so the
+    parameters of every process stay identical.
+    """
+
+    def __init__(self, optimizers, device, amp=None):
+        assert amp in [None, "bf16", "fp16"], "amp must be None, bf16 or fp16"
+        self.optimizers = optimizers
+        self.device_type = torch.device(device).type
+        self.dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(amp)
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=amp == "fp16")
+
+    @contextlib.contextmanager
+    def forward(self):
+        """The context of the forward pass and loss, autocast and a "forward" profiler range"""
+        with (
+            record_function("forward"),
+            torch.autocast(
+                self.device_type, dtype=self.dtype, enabled=self.dtype is not None
+            ),
+        ):
+            yield
+
+    def __call__(self, loss):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=True)
+        with record_function("backward"):
+            self.scaler.scale(loss).backward()
+        if is_distributed():
+            with record_function("all_reduce"):
+                self.all_reduce_gradients()
+        with record_function("optimizer_step"):
+            for optimizer in self.optimizers:
+                self.scaler.step(optimizer)
+            self.scaler.update()
+
+    @property
+    def parameters(self):
+        return [
+            param
+            for optimizer in self.optimizers
+            for group in optimizer.param_groups
+            for param in group["params"]
+        ]
+
+    def broadcast_parameters(self, src=0):
+        """Copies the parameters of process `src` to all processes"""
+        for param in self.parameters:
+            dist.broadcast(param.data, src)
+
+    def all_reduce_gradients(self):
+        # parameters without a gradient on this process get zeros, so every process reduces the same
+        # flat buffer in a single call. The buffer ends with a has-gradient flag per parameter, and
+        # parameters without a gradient on any process keep none, so the optimizer skips them as in
+        # a single process run.
+        params = [param for param in self.parameters if param.requires_grad]
+        grads = [
+            param.grad if param.grad is not None else torch.zeros_like(param)
+            for param in params
+        ]
+        has_grad = torch.tensor(
+            [param.grad is not None for param in params],
+            dtype=grads[0].dtype,
+            device=grads[0].device,
+        )
+        flat = torch.cat([grad.flatten() for grad in grads] + [has_grad])
+        dist.all_reduce(flat)
+        has_grad = flat[-len(params) :] > 0
+        flat = flat[: -len(params)] / dist.get_world_size()
+        offset = 0
+        for param, reduced in zip(params, has_grad.tolist()):
+            numel = param.numel()
+            param.grad = (
+                flat[offset : offset + numel].view_as(param) if reduced else None
+            )
+            offset += numel
+
+
 class Until:
     def __init__(self, until, action_repeat=1):
         self._until = until